@@ -0,0 +1,205 @@
+from pathlib import Path
+import sqlite3
+
+# Name of the store inside the root of the date/publisher/article tree
+STORE_FILENAME = 'articles.db'
+
+
+class ArticleStore:
+    """
+    SQLite index of the preprocessed articles tree and the publisher
+    labels, built once by preprocess_data. Training selects the articles
+    it needs with a query instead of walking the directory tree, and
+    doesn't parse labels.csv again.
+
+    Two tables:
+
+        publishers - publisher, label (NULL if labels.csv has none)
+        articles   - key, date, publisher, position, length, path, offset
+
+    key is the article key load_articles yields, position the article's
+    place among its publisher's articles of that day (file name or shard
+    line order), length the size of its text in bytes. path is the file
+    holding the article, relative to the tree root, and offset the byte
+    offset of its line for shards (NULL for text files).
+    """
+
+    def __init__(self, path):
+        """
+
+        :param path: database file, created if missing
+        """
+        self.path = str(path)
+        # a selection is streamed, and read_articles iterates it from its
+        # walker thread
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS publishers ("
+            "publisher TEXT PRIMARY KEY, "
+            "label TEXT);"
+            "CREATE TABLE IF NOT EXISTS articles ("
+            "key TEXT PRIMARY KEY, "
+            "date TEXT NOT NULL, "
+            "publisher TEXT NOT NULL, "
+            "position INTEGER NOT NULL, "
+            "length INTEGER NOT NULL, "
+            "path TEXT NOT NULL, "
+            "offset INTEGER);"
+            "CREATE INDEX IF NOT EXISTS articles_by_day "
+            "ON articles (date, publisher, position);"
+            "CREATE INDEX IF NOT EXISTS articles_by_publisher "
+            "ON articles (publisher, date);")
+        self._db.commit()
+
+    @classmethod
+    def open_for(cls, articles_dir):
+        """
+
+        :param articles_dir: root of the date/publisher/article tree
+        :return: the tree's ArticleStore, or None if it has none
+        """
+        path = Path(articles_dir) / STORE_FILENAME
+        if not path.is_file():
+            return None
+        return cls(path)
+
+    def set_labels(self, labels):
+        """
+        Replace the publisher labels.
+
+        :param labels: {publisher: label}, label None or '' for unlabelled
+            publishers
+        :return:
+        """
+        with self._db:
+            self._db.execute("DELETE FROM publishers")
+            self._db.executemany(
+                "INSERT INTO publishers (publisher, label) VALUES (?, ?)",
+                [(publisher, label or None)
+                 for publisher, label in labels.items()])
+
+    def labels(self):
+        """
+
+        :return: {publisher: label} of the labelled publishers
+        """
+        return dict(self._db.execute(
+            "SELECT publisher, label FROM publishers "
+            "WHERE label IS NOT NULL"))
+
+    def replace_articles(self, rows):
+        """
+        Replace the article index, in one transaction.
+
+        :param rows: iterable of (key, date, publisher, position, length,
+            path, offset)
+        :return: number of articles stored
+        """
+        with self._db:
+            self._db.execute("DELETE FROM articles")
+            self._db.executemany(
+                "INSERT INTO articles (key, date, publisher, position, "
+                "length, path, offset) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return self._db.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+
+    def select(self, max_days=None, after_date=None, date_from=None,
+               date_to=None, labels=None, publishers=None,
+               articles_per_publisher=None, labelled_only=True):
+        """
+        Articles of labelled publishers, optionally narrowed down.
+
+        :param max_days: only the first this many days (in date order)
+            left after the date filters
+        :param after_date: only days after this one
+        :param date_from: only days from this one on
+        :param date_to: only days up to and including this one
+        :param labels: only publishers with one of these labels
+        :param publishers: only these publishers
+        :param articles_per_publisher: only the first this many articles
+            of every publisher on each day
+        :param labelled_only: False to include unlabelled publishers too,
+            with a None label
+        :return: iterator of (key, label, date, publisher, path, offset),
+            ordered by date, publisher and position. The rows are fetched
+            as they are iterated, so don't change the store meanwhile.
+        """
+        date_filters = []
+        params = []
+        for condition, value in (("date > ?", after_date),
+                                 ("date >= ?", date_from),
+                                 ("date <= ?", date_to)):
+            if value is not None:
+                date_filters.append("a." + condition)
+                params.append(value)
+
+        filters = list(date_filters)
+        if labelled_only:
+            filters.append("p.label IS NOT NULL")
+        if labels is not None:
+            filters.append("p.label IN ({})".format(
+                ', '.join('?' * len(labels))))
+            params.extend(labels)
+        if publishers is not None:
+            filters.append("a.publisher IN ({})".format(
+                ', '.join('?' * len(publishers))))
+            params.extend(publishers)
+        if articles_per_publisher is not None:
+            filters.append("a.position < ?")
+            params.append(articles_per_publisher)
+        if max_days is not None:
+            filters.append(
+                "a.date IN (SELECT DISTINCT date FROM articles a{} "
+                "ORDER BY date LIMIT ?)".format(
+                    " WHERE " + " AND ".join(date_filters)
+                    if date_filters else ""))
+            params.extend(params[:len(date_filters)])
+            params.append(max_days)
+
+        query = ("SELECT a.key, p.label, a.date, a.publisher, a.path, "
+                 "a.offset FROM articles a "
+                 "LEFT JOIN publishers p ON p.publisher = a.publisher")
+        if filters:
+            query += " WHERE " + " AND ".join(filters)
+        query += " ORDER BY a.date, a.publisher, a.position"
+        return self._db.execute(query, params)
+
+    def dates(self, date_from=None, date_to=None):
+        """
+
+        :param date_from: only days from this one on
+        :param date_to: only days up to and including this one
+        :return: sorted list of the days that have articles
+        """
+        query = "SELECT DISTINCT date FROM articles"
+        filters = []
+        params = []
+        for condition, value in (("date >= ?", date_from),
+                                 ("date <= ?", date_to)):
+            if value is not None:
+                filters.append(condition)
+                params.append(value)
+        if filters:
+            query += " WHERE " + " AND ".join(filters)
+        return [date for date, in self._db.execute(query + " ORDER BY date",
+                                                   params)]
+
+    def summary(self):
+        """
+
+        :return: dict of article, publisher and day counts
+        """
+        articles, publishers, days, first, last, size = self._db.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT publisher), "
+            "COUNT(DISTINCT date), MIN(date), MAX(date), "
+            "COALESCE(SUM(length), 0) FROM articles").fetchone()
+        labelled = self._db.execute(
+            "SELECT COUNT(*) FROM publishers "
+            "WHERE label IS NOT NULL").fetchone()[0]
+        return {'articles': articles, 'publishers': publishers,
+                'labelled_publishers': labelled, 'days': days,
+                'first_date': first, 'last_date': last, 'bytes': size}
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,525 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import redirect_stdout
+from pathlib import Path
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from ArticleStore import ArticleStore
+from LoadModelAndPredict import load_models, load_bundle_models, \
+    get_json_prediction_output_batch, TopKExplanation
+from PredictionCache import json_default, model_version
+from Preprocessing import BACKENDS, Preprocessor
+
+# Progress of a run is kept next to its output, in <output><suffix>
+CHECKPOINT_SUFFIX = '.checkpoint.json'
+
+# Models of a worker process, loaded once by init_worker
+_worker_models = None
+
+
+def archive_rows(articles_dir, date_from=None, date_to=None, publishers=None,
+                 labels=None):
+    """
+    Every article of a preprocessed articles tree, labelled publisher or
+    not, in date, publisher and position order. The order doesn't depend on
+    the file system, so a run can be resumed by position.
+
+    The tree's ArticleStore is read one day at a time if it has one, which
+    also supplies the publisher labels. Otherwise the tree is walked with
+    index_articles.
+
+    The store is opened by the generator and closed when it finishes or
+    is closed. read_articles closes it from the thread that consumed the
+    rows, also when a run stops early.
+
+    :param articles_dir: resolved root of the date/publisher/article tree
+    :param date_from: only days from this one on
+    :param date_to: only days up to and including this one
+    :param publishers: only these publishers
+    :param labels: {publisher: label} to label walked articles with
+    :return: generator of (key, label, date, publisher, path, offset) rows,
+        see ArticleStore.select. label is None for unlabelled publishers.
+    """
+    from BiasDetector import index_articles
+
+    store = ArticleStore.open_for(articles_dir)
+    if store is not None:
+        try:
+            for date in store.dates(date_from, date_to):
+                yield from store.select(date_from=date, date_to=date,
+                                        publishers=publishers,
+                                        labelled_only=False)
+        finally:
+            store.close()
+        return
+
+    labels = labels or {}
+    for key, date, publisher, _, _, path, offset in index_articles(
+            articles_dir, date_from=date_from, date_to=date_to):
+        if publishers is None or publisher in publishers:
+            yield key, labels.get(publisher) or None, date, publisher, path, \
+                offset
+
+
+def read_archive(articles_dir, rows, read_workers=4, max_pending=16):
+    """
+
+    :param articles_dir: resolved root of the date/publisher/article tree
+    :param rows: rows from archive_rows
+    :param read_workers: see read_articles
+    :param max_pending: see read_articles
+    :return: generator of (key, text, label)
+    """
+    from BiasDetector import read_articles, stored_readers
+
+    return read_articles(stored_readers(articles_dir, rows),
+                         read_workers=read_workers, max_pending=max_pending)
+
+
+def read_jsonl(lines):
+    """
+    Articles given as JSON lines, one object per line with the text in
+    'text' (or 'content', so preprocess_data shards can be piped in as they
+    are) and optionally a 'key' (or 'id') and a 'label'. The key defaults
+    to the line number.
+
+    :param lines: iterable of lines, e.g. sys.stdin
+    :return: generator of (key, text, label)
+    """
+    for number, line in enumerate(lines):
+        if not line.strip():
+            continue
+        article = json.loads(line)
+        key = article.get('key', article.get('id', number))
+        text = article['text'] if 'text' in article else article['content']
+        yield str(key), text, article.get('label')
+
+
+def skip_done(items, done, last_key):
+    """
+    Drop the items a previous run already scored. A generator, so the
+    skipping happens in whatever thread consumes the items.
+
+    :param items: rows or articles, the key first
+    :param done: number of items scored before
+    :param last_key: key of the last of them, from the checkpoint
+    :return: generator of the remaining items
+    """
+    items = iter(items)
+    key = None
+    for item in itertools.islice(items, done):
+        key = item[0]
+    if done and key != last_key:
+        raise ValueError("the input changed since the checkpoint was "
+                         "written: article {} is {!r}, expected {!r}".format(
+                             done, key, last_key))
+    yield from items
+
+
+def chunked(items, size):
+    """
+
+    :param items: iterable
+    :param size: items per chunk
+    :return: generator of lists of at most size items
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load_scoring_models(lda_model=None, classifier_model=None, bundle=None,
+                        preprocessing='spacy', top_topics=None, top_words=5,
+                        max_words=25):
+    """
+    Load the models once per process. Their progress messages go to stderr,
+    so the results can be written to stdout.
+
+    :return: (nlp, lda_model, classifier_model, topic_index, explanation)
+    """
+    with redirect_stdout(sys.stderr):
+        if bundle:
+            models = load_bundle_models(bundle, preprocessing=preprocessing)
+        else:
+            models = load_models(lda_model, classifier_model,
+                                 preprocessing=preprocessing)
+
+    explanation = None
+    if top_topics:
+        explanation = TopKExplanation(top_topics=top_topics,
+                                      top_words=top_words,
+                                      max_words=max_words)
+    return models + (explanation,)
+
+
+def init_worker(model_args):
+    """
+    ProcessPoolExecutor initializer, see load_scoring_models.
+    """
+    global _worker_models
+    _worker_models = load_scoring_models(**model_args)
+
+
+def score_batch(articles, models=None, batch_size=64):
+    """
+    Score a batch of articles with get_json_prediction_output_batch.
+
+    :param articles: list of (key, text, label)
+    :param models: from load_scoring_models, the worker's if None
+    :param batch_size: spacy batch size
+    :return: list of JSON lines, one output dict per article with its
+        'key' and, if known, its 'publisher_label' added
+    """
+    nlp, lda, classifier, topic_index, explanation = \
+        models or _worker_models
+    outputs = get_json_prediction_output_batch(
+        nlp, lda, classifier, [text for _, text, _ in articles],
+        batch_size=batch_size, topic_index=topic_index,
+        explanation=explanation)
+
+    lines = []
+    for (key, _, label), output in zip(articles, outputs):
+        record = {'key': key}
+        if label is not None:
+            record['publisher_label'] = label
+        record.update(output)
+        lines.append(json.dumps(record, default=json_default))
+    return lines
+
+
+def read_checkpoint(path, run):
+    """
+
+    :param path: checkpoint file
+    :param run: dict describing the models and input of this run
+    :return: the checkpoint dict, None if there is none
+    """
+    path = Path(path)
+    if not path.is_file():
+        return None
+    with path.open() as f:
+        checkpoint = json.load(f)
+    if checkpoint['run'] != run:
+        raise ValueError("{} was written for other models or another input, "
+                         "score to another output or pass --restart".format(
+                             path))
+    return checkpoint
+
+
+def write_checkpoint(path, run, articles, last_key, output_bytes):
+    """
+    Replace the checkpoint file in one step, so a crash leaves either the
+    old or the new one.
+
+    :param path: checkpoint file
+    :param run: see read_checkpoint
+    :param articles: number of articles scored so far
+    :param last_key: key of the last of them
+    :param output_bytes: size of the output holding exactly their results
+    :return:
+    """
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'run': run, 'articles': articles, 'last_key': last_key,
+                   'output_bytes': output_bytes}, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def score_stream(articles, out, model_args, workers=1, chunk_size=256,
+                 batch_size=64, max_pending=None, checkpoint=None,
+                 checkpoint_every=5000, done=0):
+    """
+    Score a stream of articles and write one JSON line per article to out,
+    in input order.
+
+    Articles are cut into chunks of chunk_size and scored by worker
+    processes, each loading the models once. At most max_pending chunks
+    are in flight, so memory stays flat however long the stream is: once
+    the workers fall behind, reading waits.
+
+    :param articles: iterable of (key, text, label)
+    :param out: binary file to append to
+    :param model_args: keyword arguments of load_scoring_models
+    :param workers: worker processes, 0 to score in this process
+    :param chunk_size: articles per chunk handed to a worker
+    :param batch_size: spacy batch size
+    :param max_pending: chunks in flight, twice the workers if None
+    :param checkpoint: (path, run) to record progress in, see
+        write_checkpoint
+    :param checkpoint_every: articles scored between checkpoints
+    :param done: articles scored by earlier runs into out
+    :return: number of articles scored by this call
+    """
+    if max_pending is None:
+        max_pending = max(2 * workers, 1)
+    models = None
+    executor = None
+    if workers:
+        executor = ProcessPoolExecutor(workers, initializer=init_worker,
+                                       initargs=(model_args,))
+        # start the workers now, before any reading threads exist
+        executor.submit(int).result()
+    else:
+        models = load_scoring_models(**model_args)
+
+    pending = deque()
+    scored = 0
+    last_key = None
+    last_checkpoint = 0
+    start = time.perf_counter()
+
+    def save():
+        out.flush()
+        if checkpoint is not None and last_key is not None:
+            os.fsync(out.fileno())
+            write_checkpoint(checkpoint[0], checkpoint[1], done + scored,
+                             last_key, out.tell())
+
+    def drain(limit):
+        nonlocal scored, last_key, last_checkpoint
+        while len(pending) > limit:
+            future, chunk_last_key = pending.popleft()
+            lines = future.result()
+            out.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+            scored += len(lines)
+            last_key = chunk_last_key
+            if scored - last_checkpoint >= checkpoint_every:
+                save()
+                last_checkpoint = scored
+                print("scored {} articles, {:.1f} per second".format(
+                    done + scored, scored / (time.perf_counter() - start)),
+                    file=sys.stderr)
+
+    try:
+        for chunk in chunked(articles, chunk_size):
+            if executor is not None:
+                future = executor.submit(score_batch, chunk,
+                                         batch_size=batch_size)
+            else:
+                future = Future()
+                future.set_result(score_batch(chunk, models,
+                                              batch_size=batch_size))
+            pending.append((future, chunk[-1][0]))
+            drain(max_pending - 1)
+        drain(0)
+    finally:
+        # whatever was written so far is complete, a rerun picks up there
+        save()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    print("scored {} articles in {:.1f}s, {:.1f} per second".format(
+        scored, elapsed, scored / elapsed if elapsed else 0.0),
+        file=sys.stderr)
+    return scored
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=("Score a whole article archive, or JSON lines from "
+                     "stdin, with worker processes and write one "
+                     "get_json_prediction_output result per article as "
+                     "JSON lines. Runs keep a checkpoint next to their "
+                     "output and resume from it."))
+
+    parser.add_argument("articles",
+                        type=str,
+                        help=("Root of the articles tree written by "
+                              "preprocess_data, or - to read JSON lines "
+                              "with 'text' (or 'content') and optionally "
+                              "'key' and 'label' from stdin."))
+
+    parser.add_argument("output",
+                        type=str,
+                        help=("JSON lines file to write the results to, - "
+                              "for stdout (not resumable)."))
+
+    parser.add_argument("lda_model",
+                        type=str,
+                        nargs='?',
+                        help=("The LDA model file to load"))
+
+    parser.add_argument("classifier_model",
+                        type=str,
+                        nargs='?',
+                        help=("The classifier model file to load"))
+
+    parser.add_argument("--bundle",
+                        type=str,
+                        default=None,
+                        help=("Score with a model bundle directory instead "
+                              "of the two model files. Workers then share "
+                              "its memory mapped arrays."))
+
+    parser.add_argument("--preprocessing",
+                        choices=BACKENDS,
+                        default='spacy',
+                        help=("Tokenizer backend, see Preprocessing.py."))
+
+    parser.add_argument("--workers",
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help=("Number of scoring processes, each loads the "
+                              "models once. 0 scores in this process."))
+
+    parser.add_argument("--read-workers",
+                        type=int,
+                        default=4,
+                        help=("Number of threads reading articles from the "
+                              "tree."))
+
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        default=256,
+                        help=("Number of articles handed to a worker at a "
+                              "time."))
+
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=64,
+                        help=("Number of articles spacy parses per batch."))
+
+    parser.add_argument("--checkpoint-every",
+                        type=int,
+                        default=5000,
+                        help=("Number of articles scored between "
+                              "checkpoints."))
+
+    parser.add_argument("--restart",
+                        action='store_true',
+                        help=("Ignore the checkpoint and overwrite the "
+                              "output."))
+
+    parser.add_argument("--date-from",
+                        type=str,
+                        default=None,
+                        help=("Only score days from this one on, e.g. "
+                              "2018-06-01."))
+
+    parser.add_argument("--date-to",
+                        type=str,
+                        default=None,
+                        help=("Only score days up to and including this "
+                              "one."))
+
+    parser.add_argument("--publishers",
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help=("Only score these publishers."))
+
+    parser.add_argument("--labels-csv",
+                        type=str,
+                        default=None,
+                        help=("labels.csv to add the publisher labels to "
+                              "the results from, when the tree has no "
+                              "article store."))
+
+    parser.add_argument("--top-topics",
+                        type=int,
+                        default=None,
+                        help=("Write bounded explanations, see "
+                              "TopKExplanation. The full output otherwise."))
+
+    parser.add_argument("--top-words",
+                        type=int,
+                        default=5,
+                        help=("Terms and article words per topic with "
+                              "--top-topics."))
+
+    parser.add_argument("--max-words",
+                        type=int,
+                        default=25,
+                        help=("Word contributions with --top-topics."))
+
+    inputs = parser.parse_args()
+    if not inputs.bundle and not (inputs.lda_model and inputs.classifier_model):
+        parser.error("give either both model files or --bundle")
+
+    model_args = {'lda_model': inputs.lda_model,
+                  'classifier_model': inputs.classifier_model,
+                  'bundle': inputs.bundle,
+                  'preprocessing': inputs.preprocessing,
+                  'top_topics': inputs.top_topics,
+                  'top_words': inputs.top_words,
+                  'max_words': inputs.max_words}
+
+    settings = Preprocessor(inputs.preprocessing).fingerprint()
+    if inputs.top_topics:
+        settings += TopKExplanation(inputs.top_topics, inputs.top_words,
+                                    inputs.max_words).settings()
+    if inputs.bundle:
+        version = model_version(inputs.bundle, settings=settings)
+    else:
+        version = model_version(inputs.lda_model, inputs.classifier_model,
+                                settings=settings)
+
+    articles_dir = None
+    if inputs.articles != '-':
+        articles_dir = Path(inputs.articles).resolve()
+    run = {'model_version': version,
+           'articles': str(articles_dir) if articles_dir else '-',
+           'date_from': inputs.date_from,
+           'date_to': inputs.date_to,
+           'publishers': inputs.publishers}
+
+    checkpoint = None
+    state = None
+    if inputs.output == '-':
+        out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    else:
+        checkpoint_path = inputs.output + CHECKPOINT_SUFFIX
+        checkpoint = (checkpoint_path, run)
+        if not inputs.restart:
+            state = read_checkpoint(checkpoint_path, run)
+            if state is None and os.path.exists(inputs.output) \
+                    and os.path.getsize(inputs.output):
+                parser.error("{} exists but has no checkpoint, pass "
+                             "--restart to overwrite it".format(
+                                 inputs.output))
+        if state is not None:
+            out = open(inputs.output, 'r+b')
+            # results written after the checkpoint are scored again
+            out.truncate(state['output_bytes'])
+            out.seek(0, os.SEEK_END)
+            print("resuming after {} articles, at {}".format(
+                state['articles'], state['last_key']), file=sys.stderr)
+        else:
+            out = open(inputs.output, 'wb')
+    done = state['articles'] if state else 0
+    last_key = state['last_key'] if state else None
+
+    if articles_dir is None:
+        articles = skip_done(read_jsonl(sys.stdin), done, last_key)
+    else:
+        labels = None
+        if inputs.labels_csv:
+            from BiasDetector import read_publisher_labels
+            labels = read_publisher_labels(inputs.labels_csv)
+        rows = skip_done(archive_rows(articles_dir,
+                                      date_from=inputs.date_from,
+                                      date_to=inputs.date_to,
+                                      publishers=inputs.publishers,
+                                      labels=labels), done, last_key)
+        articles = read_archive(articles_dir, rows,
+                                read_workers=inputs.read_workers)
+
+    # only results go to stdout
+    with out, redirect_stdout(sys.stderr):
+        score_stream(articles, out, model_args, workers=inputs.workers,
+                     chunk_size=inputs.chunk_size,
+                     batch_size=inputs.batch_size, checkpoint=checkpoint,
+                     checkpoint_every=inputs.checkpoint_every, done=done)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+from pathlib import Path
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import BiasDetector
+import LoadModelAndPredict
+from Profiling import StageProfiler
+
+# Label names as they appear in the real MBFC labels.csv
+BIAS_LABELS = ['least_biased', 'left_bias', 'left_center_bias',
+               'right_bias', 'right_center_bias', 'questionable_source',
+               'conspiracy_pseudoscience', 'satire']
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ren', 'tos', 'vel', 'dar', 'qui', 'bes',
+             'nor', 'pla', 'sun', 'tri', 'gam', 'hol', 'zen', 'fir', 'wex']
+
+
+def make_vocabulary(rng, size):
+    """
+    Made up words, so the benchmark doesn't depend on any real text.
+
+    :param rng: random.Random
+    :param size: number of distinct words
+    :return: list of words
+    """
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def generate_corpus(output_dir, days=5, publishers=8, articles=10,
+                    words_per_article=300, num_topics=10, vocab_size=2000,
+                    seed=0):
+    """
+    Write a synthetic dataverse dump: one <publisher>.json file per
+    publisher in <output_dir>/raw and a matching <output_dir>/labels.csv.
+
+    Every publisher gets a label, and every label prefers a few of
+    num_topics word clusters, so the model has something to learn.
+
+    :param output_dir: directory to write to
+    :param days: number of distinct article dates
+    :param publishers: number of publishers
+    :param articles: articles per publisher per day
+    :param words_per_article: article length in words
+    :param num_topics: number of word clusters the articles are drawn from
+    :param vocab_size: number of distinct words
+    :param seed: random seed, the same arguments always give the same files
+    :return: (raw_dir, data_dir)
+    """
+    rng = random.Random(seed)
+    output_dir = Path(output_dir)
+    raw_dir = output_dir / 'raw'
+    raw_dir.mkdir(parents=True, exist_ok=True)
+
+    vocab = make_vocabulary(rng, vocab_size)
+    clusters = [vocab[i::num_topics] for i in range(num_topics)]
+    label_topics = {label: rng.sample(range(num_topics), min(3, num_topics))
+                    for label in BIAS_LABELS}
+    dates = ['2018-{:02d}-{:02d}'.format(1 + day // 28, 1 + day % 28)
+             for day in range(days)]
+
+    publisher_labels = {}
+    for p in range(publishers):
+        publisher = 'publisher{:03d}'.format(p)
+        label = BIAS_LABELS[p % len(BIAS_LABELS)]
+        publisher_labels[publisher] = label
+
+        all_articles = []
+        for date in dates:
+            for a in range(articles):
+                sentences = []
+                for _ in range(words_per_article // 12):
+                    topic = rng.choice(label_topics[label]) \
+                        if rng.random() < 0.7 else rng.randrange(num_topics)
+                    words = [rng.choice(clusters[topic]) for _ in range(12)]
+                    sentences.append(' '.join(words).capitalize() + '.')
+                all_articles.append({
+                    'date': date,
+                    'title': '{} {} article {}'.format(publisher, date, a),
+                    'content': '\n'.join(' '.join(sentences[i:i + 5])
+                                         for i in range(0, len(sentences), 5))})
+
+        with (raw_dir / (publisher + '.json')).open('w') as f:
+            json.dump(all_articles, f)
+
+    # same layout load_labels expects from the real labels.csv
+    with (output_dir / 'labels.csv').open('w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['', 'Media Bias / Fact Check, label'])
+        for publisher, label in publisher_labels.items():
+            writer.writerow([publisher, label])
+
+    return raw_dir, output_dir
+
+
+def git_commit():
+    """
+
+    :return: current git commit of the repo, or None outside of git
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(output_dir, config):
+    """
+    Time the full pipeline on a synthetic corpus.
+
+    :param output_dir: scratch directory for the corpus, models and cache
+    :param config: dict of generate_corpus arguments plus 'lda_topics',
+        'passes', 'workers' and 'batch_texts'
+    :return: benchmark result dict
+    """
+    output_dir = Path(output_dir).resolve()
+    profiler = StageProfiler()
+
+    with profiler.stage('generate_corpus'):
+        raw_dir, data_dir = generate_corpus(
+            output_dir,
+            days=config['days'],
+            publishers=config['publishers'],
+            articles=config['articles'],
+            words_per_article=config['words_per_article'],
+            seed=config['seed'])
+
+    articles_dir = data_dir / 'articles' / 'articles'
+    with profiler.stage('preprocess_data',
+                        items=(config['days'] * config['publishers']
+                               * config['articles'])):
+        BiasDetector.preprocess_data(str(raw_dir), str(articles_dir),
+                                     workers=config['workers'],
+                                     labels_path=str(data_dir / 'labels.csv'))
+
+    id2word, corpus, labels, onehot_enc, _ = BiasDetector.load_data(
+        str(data_dir), str(articles_dir), str(output_dir / 'corpus.mm'),
+        max_days=None, profiler=profiler)
+
+    with profiler.stage('train_model', items=len(corpus)):
+        BiasDetector.train_model(id2word, corpus, onehot_enc, labels,
+                                 eval_every=0,
+                                 profiler=profiler,
+                                 num_topics=config['lda_topics'],
+                                 passes=config['passes'],
+                                 output_dir=str(output_dir))
+
+    with profiler.stage('load_models'):
+        nlp, lda, classifier, topic_index = LoadModelAndPredict.load_models(
+            str(output_dir / 'trained_ldamodel.model'),
+            str(output_dir / 'trained_logreg_model.pkl'))
+
+    texts = [path.read_text()
+             for path in sorted(articles_dir.rglob('*.txt'))[:config['batch_texts']]]
+
+    with profiler.stage('predict_single', items=len(texts)):
+        for text in texts:
+            LoadModelAndPredict.get_json_prediction_output(
+                nlp, lda, classifier, text, topic_index=topic_index)
+
+    with profiler.stage('predict_batch', items=len(texts)):
+        LoadModelAndPredict.get_json_prediction_output_batch(
+            nlp, lda, classifier, texts, topic_index=topic_index,
+            profiler=profiler)
+
+    result = profiler.report()
+    result['config'] = config
+    result['git_commit'] = git_commit()
+    return result
+
+
+def compare(result, baseline, threshold=0.2):
+    """
+    Print the wall time of every stage against a saved baseline.
+
+    :param result: benchmark result dict
+    :param baseline: earlier benchmark result dict
+    :param threshold: relative slowdown reported as a regression
+    :return: list of regressed stage names
+    """
+    if result['config'] != baseline['config']:
+        print("WARNING: baseline was run with a different config:",
+              baseline['config'])
+
+    old = {stage['name']: stage['wall_s'] for stage in baseline['stages']}
+    regressions = []
+    print("{:<50} {:>10} {:>10} {:>8}".format('stage', 'baseline', 'now',
+                                              'ratio'))
+    for stage in result['stages']:
+        name = stage['name']
+        if name not in old:
+            continue
+        ratio = stage['wall_s'] / old[name] if old[name] else float('inf')
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print("{:<50} {:>10.4f} {:>10.4f} {:>8.2f}{}".format(
+            name, old[name], stage['wall_s'], ratio, flag))
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=("Benchmark the training and prediction pipeline on a "
+                     "synthetic news corpus. Runs offline, only needs the "
+                     "spacy model installed."))
+
+    parser.add_argument("output_dir",
+                        type=str,
+                        help=("Scratch directory for the generated corpus "
+                              "and models."))
+
+    parser.add_argument("--days", type=int, default=5,
+                        help=("Number of days of articles."))
+    parser.add_argument("--publishers", type=int, default=8,
+                        help=("Number of publishers."))
+    parser.add_argument("--articles", type=int, default=10,
+                        help=("Articles per publisher per day."))
+    parser.add_argument("--words-per-article", type=int, default=300,
+                        help=("Article length in words."))
+    parser.add_argument("--lda-topics", type=int, default=10,
+                        help=("Number of LDA topics to train."))
+    parser.add_argument("--passes", type=int, default=2,
+                        help=("Number of LDA passes."))
+    parser.add_argument("--workers", type=int, default=None,
+                        help=("Processes used by preprocess_data."))
+    parser.add_argument("--batch-texts", type=int, default=50,
+                        help=("Number of texts scored one by one and as a "
+                              "batch."))
+    parser.add_argument("--seed", type=int, default=0,
+                        help=("Random seed of the generated corpus."))
+
+    parser.add_argument("--save",
+                        type=str,
+                        default=None,
+                        help=("Write the results to this JSON file, to use "
+                              "as a baseline later."))
+
+    parser.add_argument("--compare",
+                        type=str,
+                        default=None,
+                        help=("Baseline JSON file to compare against."))
+
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=0.2,
+                        help=("Relative slowdown reported as a regression."))
+
+    inputs = parser.parse_args()
+
+    config = {'days': inputs.days,
+              'publishers': inputs.publishers,
+              'articles': inputs.articles,
+              'words_per_article': inputs.words_per_article,
+              'lda_topics': inputs.lda_topics,
+              'passes': inputs.passes,
+              'workers': inputs.workers,
+              'batch_texts': inputs.batch_texts,
+              'seed': inputs.seed}
+
+    result = run_benchmark(inputs.output_dir, config)
+
+    if inputs.save:
+        with open(inputs.save, 'w') as f:
+            json.dump(result, f, indent=2)
+        print("wrote benchmark results to", inputs.save)
+
+    if inputs.compare:
+        with open(inputs.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, inputs.threshold):
+            raise SystemExit(1)
+    else:
+        for stage in result['stages']:
+            print("{:<50} {:>10.4f}s".format(stage['name'], stage['wall_s']))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,133 +1,659 @@
 from pathlib import Path
 from gensim.models.ldamodel import  LdaModel
-# from gensim.models.ldamulticore import LdaMulticore
+from gensim.models.ldamulticore import LdaMulticore
 import gensim.corpora as corpora
+from gensim.utils import grouper
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.preprocessing import LabelBinarizer
 import csv
 import numpy as np
-import spacy
 #import en_core_web_md
 import argparse
 import json
 #import sqlite3
 from sklearn.linear_model import SGDClassifier, LogisticRegression
-from sklearn.metrics import f1_score
 import pickle
 import pdb
 import os
 import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+from functools import partial
+import itertools
+import queue
+import threading
+from TokenCache import TokenCache
+from ArticleStore import ArticleStore, STORE_FILENAME
+from Preprocessing import BACKENDS, Preprocessor
+from PhraseModel import PhraseModel
+from Profiling import StageProfiler, NO_PROFILER
+from ModelBundle import BUNDLE_DTYPES, export_bundle
+from Evaluation import classification_metrics, evaluate_model, \
+    split_by_date, summary_line, write_evaluation
+
+try:
+    # streaming JSON parser, keeps memory flat on the big publisher files
+    import ijson
+except ImportError:
+    ijson = None
+
+# single:      LdaModel on one core
+# multicore:   LdaMulticore, E-steps run in `workers` local processes
+# distributed: LdaModel(distributed=True), needs a running gensim
+#              lda_dispatcher and lda_worker processes (Pyro4)
+LDA_ENGINES = ('single', 'multicore', 'distributed')
+
+# Classifiers trained on the LDA topic vectors, see train_classifier
+CLASSIFIERS = ('logreg', 'sgd')
+
+# files:  <date>/<publisher>/<title>.txt, one file per article
+# shards: <date>/<publisher>.jsonl, one JSON line per article
+ARTICLE_LAYOUTS = ('files', 'shards')
+SHARD_SUFFIX = '.jsonl'
+
+# labels.csv column holding the label of every publisher
+MBFC_LABEL_COLUMN = 'Media Bias / Fact Check, label'
+
+
+def lemmatize_texts(preprocessor, texts, batch_size=64, n_process=1):
+    """
+    Stream (text, context) tuples through spacy in batches, yielding
+    (lemmas, context) for each of them in input order.
+
+    :param preprocessor: Preprocessor
+    :param texts: iterable of (text, context) tuples
+    :param batch_size: number of texts spacy buffers per batch
+    :param n_process: number of worker processes, -1 for all cores
+    :return: generator of (lemmas, context)
+    """
+    num_docs = 0
+    start = time.perf_counter()
+    for lem_text, context in preprocessor.pipe(texts,
+                                               as_tuples=True,
+                                               batch_size=batch_size,
+                                               n_process=n_process):
+        num_docs += 1
+        yield lem_text, context
+
+    elapsed = time.perf_counter() - start
+    print("lemmatized {} documents in {:.1f}s ({:.1f} docs/sec)".format(
+        num_docs, elapsed, num_docs / elapsed if elapsed else 0.0))
 
-# Constants
-STOPWORDS = {
-    'say', 'not', 'like', 'go', "be", "have", "s", #original
-    "and", "when", "where", "who", "let", "look", "time", "use", "him", "her",
-    "she", "he"
-}
 
+def iter_json_array(path):
+    """
+    Yield the items of the JSON array stored in path. Uses ijson when it is
+    installed so the file never has to fit in memory.
 
-def preprocess_data(article_directory, dest_root_dir):
+    :param path: JSON file holding a single array
+    :return: generator of items
     """
+    with open(path, 'rb') as f:
+        if ijson is not None:
+            yield from ijson.items(f, 'item')
+        else:
+            yield from json.load(f)
+
 
-    :param article_directory:
+def article_file_id(article):
+    """
+    File name safe id for an article, based on its title.
+
+    :param article: article dict from the dataverse files
+    :return: str
+    """
+    article_id = article['title'][:200] if len(article['title']) > 200 else article['title']
+    return article_id.replace('/', '_')
+
+
+def extract_publisher(publisher_file, dest_root_dir, layout='files'):
+    """
+    Write out every article of a single dataverse publisher file. Running it
+    again on the same input leaves the output unchanged.
+
+    :param publisher_file: path of the <publisher>.json file
+    :param dest_root_dir: root of the date/publisher tree
+    :param layout: one of ARTICLE_LAYOUTS
+    :return: number of articles in the file
+    """
+    publisher = os.path.basename(publisher_file).split('.')[0]
+    num_articles = 0
+    created_dirs = set()
+    # date -> (open temporary shard file, ids written to it)
+    shards = {}
+
+    try:
+        for article in iter_json_array(publisher_file):
+            num_articles += 1
+            date = article['date']
+            article_id = article_file_id(article)
+
+            if layout == 'shards':
+                if date not in shards:
+                    date_dir = os.path.join(dest_root_dir, date)
+                    if date_dir not in created_dirs:
+                        os.makedirs(date_dir, mode=0o777, exist_ok=True)
+                        created_dirs.add(date_dir)
+                    shard_file = os.path.join(date_dir,
+                                              publisher + SHARD_SUFFIX)
+                    shards[date] = (open(shard_file + '.tmp', 'w'), set())
+
+                out, written_ids = shards[date]
+                # first article with a given id wins, same as with files
+                if article_id not in written_ids:
+                    written_ids.add(article_id)
+                    out.write(json.dumps({'id': article_id,
+                                          'content': article['content']}))
+                    out.write('\n')
+                continue
+
+            # Check if dirs exist
+            publisher_dir = os.path.join(dest_root_dir, date, publisher)
+            if publisher_dir not in created_dirs:
+                os.makedirs(publisher_dir, mode=0o777, exist_ok=True)
+                created_dirs.add(publisher_dir)
+
+            # Write article content to text file
+            try:
+                article_file = os.path.join(publisher_dir, article_id+'.txt')
+                if not os.path.isfile(article_file):
+                    with open(article_file, 'w') as out:
+                        out.write(article['content'])
+            except Exception as e:
+                print("ERROR:", e)
+    finally:
+        for out, _ in shards.values():
+            out.close()
+
+    # only replace the shards once the whole file was read
+    for out, _ in shards.values():
+        os.replace(out.name, out.name[:-len('.tmp')])
+
+    return num_articles
+
+
+def preprocess_data(article_directory, dest_root_dir, workers=None,
+                    layout='files', labels_path=None):
+    """
+    Split the dataverse publisher files into the date/publisher tree that
+    load_articles reads, one process per publisher file, then index the
+    tree in its ArticleStore.
+
+    :param article_directory: directory of <publisher>.json files
+    :param dest_root_dir: root of the date/publisher tree
+    :param workers: number of processes, None for one per core
+    :param layout: 'files' for one text file per article, 'shards' for one
+        JSON lines file per publisher per date
+    :param labels_path: labels.csv to store in the ArticleStore as well
     :return:
     """
-    date_to_article = {}
-    dir = os.fsencode(article_directory)
-
-    for file in os.listdir(dir):
-        filename = os.fsdecode(file)
-        publisher = filename.split('.')[0]
-        with open(os.path.join(article_directory, filename)) as f:
-            all_articles = json.load(f)
-            for article in all_articles:
-                date = article['date']
-                article_id = article['title'][:200] if len(article['title']) > 200 else article['title']
-                article_id = article_id.replace('/', '_')
-                date_to_article[date] = article
-
-                # Check if dirs exist
-                date_dir = os.path.join(dest_root_dir, date)
-                publisher_dir = os.path.join(dest_root_dir, date, publisher)
-                if not os.path.exists(date_dir):
-                    os.makedirs(date_dir, mode=0o777)
-
-                if not os.path.exists(publisher_dir):
-                    os.makedirs(publisher_dir, mode=0o777)
-
-                # Write article content to text file
-                try:
-                    article_file = os.path.join(publisher_dir, article_id+'.txt')
-                    if not os.path.isfile(article_file):
-                        with open(article_file, 'w') as out:
-                            out.write(article['content'])
-                except Exception as e:
-                    print("ERROR:", e)
+    if layout not in ARTICLE_LAYOUTS:
+        raise ValueError("unknown layout {!r}, expected one of {}".format(
+            layout, ARTICLE_LAYOUTS))
+
+    publisher_files = [os.path.join(article_directory, os.fsdecode(file))
+                       for file in os.listdir(os.fsencode(article_directory))]
+
+    start = time.perf_counter()
+    num_articles = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(extract_publisher, publisher_file,
+                               dest_root_dir, layout): publisher_file
+                   for publisher_file in publisher_files}
+        for future in as_completed(futures):
+            try:
+                num_articles += future.result()
+            except Exception as e:
+                print("ERROR:", futures[future], e)
+
+    print("extracted {} articles from {} files in {:.1f}s".format(
+        num_articles, len(publisher_files), time.perf_counter() - start))
+
+    build_article_store(dest_root_dir, labels_path=labels_path).close()
 
     return
 
 
 def predict_bias(model, topic_vecs, labels):
     """
+    Score the classifier on the documents it was trained on, in one batched
+    pass. This is only a sanity check, see evaluate_model for held out
+    metrics.
+
+    :param model: fitted classifier
+    :param topic_vecs: its training topic vectors
+    :param labels: their labels
+    :return: metrics dict from classification_metrics
+    """
+    metrics = classification_metrics(model, topic_vecs, labels)
+    print("on training data:", summary_line(metrics))
+    return metrics
 
-    :param model:
-    :param topic_vecs:
-    :param labels:
+
+def build_corpus(documents, corpus_path, id2word=None):
+    """
+    Build the dictionary and the bag of words corpus in a single pass over
+    a stream of documents. The corpus is serialized to disk in Matrix Market
+    format as it is built, so neither the token lists nor the bag of words
+    vectors are ever held in memory together.
+
+    If id2word carries phrases (see PhraseModel) they are joined in every
+    document before it is counted.
+
+    :param documents: iterable of (lemmas, label, key), see load_articles
+    :param corpus_path: file to serialize the corpus to
+    :param id2word: existing Dictionary to extend with new terms, a new one
+        is started if None
+    :return: (id2word, corpus, labels, keys) where corpus is a restartable,
+        disk backed MmCorpus and keys are the article keys
+    """
+    if id2word is None:
+        id2word = corpora.Dictionary()
+    phrases = PhraseModel.for_vocabulary(id2word)
+    labels = []
+    keys = []
+
+    def bows():
+        for lem_text, label, key in documents:
+            labels.append(label)
+            keys.append(key)
+            if phrases is not None:
+                lem_text = phrases.apply(lem_text)
+            yield id2word.doc2bow(lem_text, allow_update=True)
+
+    corpora.MmCorpus.serialize(corpus_path, bows())
+    corpus = corpora.MmCorpus(corpus_path)
+
+    return id2word, corpus, labels, keys
+
+
+def training_ids(keys, validation_fraction=None):
+    """
+    Positions of the documents the models get to train on, everything but
+    the days split_by_date holds out.
+
+    :param keys: article keys of the documents
+    :param validation_fraction: see split_by_date, None to hold out nothing
+    :return: array of positions, None for all of them
+    """
+    if not validation_fraction:
+        return None
+    try:
+        train_ids, _, _ = split_by_date(keys, validation_fraction)
+    except ValueError:
+        return None
+    return train_ids
+
+
+def learn_phrases(documents, spool_path, min_count=5, threshold=10.0,
+                  validation_fraction=None):
+    """
+    Learn bigram phrases from a stream of documents. The documents are
+    spooled to a JSON lines file first, so the phrases can be learned on
+    the training days only and every document replayed afterwards without
+    parsing the articles again.
+
+    :param documents: iterable of (lemmas, label, key), see load_articles
+    :param spool_path: temporary file, removed once replayed
+    :param min_count: see PhraseModel.train
+    :param threshold: see PhraseModel.train
+    :param validation_fraction: leave the days held out by split_by_date
+        out of the phrase counts
+    :return: (PhraseModel, generator replaying the documents)
+    """
+    keys = []
+    with open(spool_path, 'w', encoding='utf-8') as f:
+        for lem_text, label, key in documents:
+            f.write(json.dumps([lem_text, label, key]))
+            f.write('\n')
+            keys.append(key)
+    train_ids = training_ids(keys, validation_fraction)
+    train_ids = None if train_ids is None else set(train_ids.tolist())
+
+    def spooled():
+        with open(spool_path, encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                if train_ids is None or i in train_ids:
+                    yield json.loads(line)[0]
+
+    phrases = PhraseModel.train(spooled(), min_count=min_count,
+                                threshold=threshold)
+
+    def replay():
+        try:
+            with open(spool_path, encoding='utf-8') as f:
+                for line in f:
+                    yield tuple(json.loads(line))
+        finally:
+            os.remove(spool_path)
+
+    return phrases, replay()
+
+
+def rewrite_corpus(corpus, corpus_path, new_ids):
+    """
+    Rewrite a serialized corpus in place with remapped term ids.
+
+    :param corpus: MmCorpus serialized at corpus_path
+    :param corpus_path: file the corpus is serialized to
+    :param new_ids: old term id -> new term id, terms missing from it are
+        dropped
+    :return: (MmCorpus, number of entries written)
+    """
+    entries = 0
+
+    def bows():
+        nonlocal entries
+        for bow in corpus:
+            bow = [(new_ids[term_id], count) for term_id, count in bow
+                   if term_id in new_ids]
+            entries += len(bow)
+            yield bow
+
+    tmp_path = corpus_path + '.tmp'
+    corpora.MmCorpus.serialize(tmp_path, bows())
+    os.replace(tmp_path, corpus_path)
+    os.replace(tmp_path + '.index', corpus_path + '.index')
+    return corpora.MmCorpus(corpus_path), entries
+
+
+def prune_new_terms(id2word, corpus, corpus_path, num_trained_terms,
+                    no_below=2, keep_n=100000):
+    """
+    Drop the rare terms build_corpus added to a trained dictionary, with the
+    same rules prune_vocabulary applied at training time. The trained terms
+    are all kept with their ids, since the LDA model has a column for each.
+
+    :param id2word: trained Dictionary extended by build_corpus
+    :param corpus: MmCorpus of the new documents, serialized at corpus_path
+    :param corpus_path: file the corpus is serialized to, rewritten in place
+    :param num_trained_terms: dictionary size before it was extended, the
+        added terms have the ids from here on
+    :param no_below: keep added terms found in at least this many of the
+        new documents
+    :param keep_n: keep at most this many terms in total, None for no limit
+    :return: (id2word, corpus)
+    """
+    added = sorted(range(num_trained_terms, len(id2word)),
+                   key=lambda term_id: -id2word.dfs.get(term_id, 0))
+    keep = [term_id for term_id in added
+            if id2word.dfs.get(term_id, 0) >= no_below]
+    if keep_n is not None:
+        keep = keep[:max(keep_n - num_trained_terms, 0)]
+    keep = set(keep)
+    bad_ids = [term_id for term_id in added if term_id not in keep]
+    if not bad_ids:
+        return id2word, corpus
+
+    old_ids = dict(id2word.token2id)
+    id2word.filter_tokens(bad_ids=bad_ids)
+    new_ids = {old_ids[token]: new_id
+               for token, new_id in id2word.token2id.items()}
+    corpus, _ = rewrite_corpus(corpus, corpus_path, new_ids)
+    print("dropped {} of {} new terms below {} documents or beyond {} "
+          "terms".format(len(bad_ids), len(added), no_below, keep_n))
+    return id2word, corpus
+
+
+def prune_vocabulary(id2word, corpus, corpus_path, no_below=2, no_above=1.0,
+                     keep_n=100000, doc_ids=None):
+    """
+    Drop rare and overly common terms from the dictionary and rewrite the
+    serialized corpus with the compacted term ids. Every removed term is a
+    column less in the topic-word matrices LDA keeps and updates on every
+    pass.
+
+    :param id2word: Dictionary built by build_corpus
+    :param corpus: MmCorpus serialized at corpus_path
+    :param corpus_path: file the corpus is serialized to, rewritten in place
+    :param no_below: keep terms found in at least this many documents
+    :param no_above: keep terms found in at most this fraction of documents
+    :param keep_n: keep at most this many of the most frequent terms, None
+        for no limit
+    :param doc_ids: positions of the training documents, the document
+        frequencies are counted on these only and terms only they lack are
+        dropped. None counts every document.
+    :return: (id2word, corpus, stats dict of the sizes before and after)
+    """
+    stats = {'terms_before': len(id2word),
+             'entries_before': int(id2word.num_nnz)}
+
+    old_ids = dict(id2word.token2id)
+    if doc_ids is not None:
+        dfs = Counter(term_id for bow in corpus[doc_ids]
+                      for term_id, _ in bow)
+        id2word.dfs = dict(dfs)
+        id2word.num_docs = len(doc_ids)
+        id2word.filter_tokens(bad_ids=[term_id for term_id in id2word.keys()
+                                       if term_id not in dfs])
+    id2word.filter_extremes(no_below=no_below, no_above=no_above,
+                            keep_n=keep_n)
+    new_ids = {old_ids[token]: new_id
+               for token, new_id in id2word.token2id.items()}
+
+    if all(old == new for old, new in new_ids.items()) \
+            and len(new_ids) == stats['terms_before']:
+        entries = stats['entries_before']
+    else:
+        corpus, entries = rewrite_corpus(corpus, corpus_path, new_ids)
+
+    stats['terms_after'] = len(id2word)
+    stats['entries_after'] = entries
+    stats['terms_removed_pct'] = round(
+        100.0 * (1 - stats['terms_after'] / max(stats['terms_before'], 1)), 1)
+    stats['entries_removed_pct'] = round(
+        100.0 * (1 - entries / max(stats['entries_before'], 1)), 1)
+    print("pruned vocabulary from {} to {} terms ({}% less topic-word "
+          "memory), corpus entries from {} to {} ({}% less E-step work per "
+          "pass)".format(stats['terms_before'], stats['terms_after'],
+                         stats['terms_removed_pct'], stats['entries_before'],
+                         entries, stats['entries_removed_pct']))
+    return id2word, corpus, stats
+
+
+def fit_lda(id2word, corpus, num_topics, passes=50, eval_every=1,
+            engine='single', workers=None):
+    """
+    Train an LDA model with the chosen engine. All engines produce an
+    LdaModel (LdaMulticore is a subclass), so the saved model loads the
+    same way in LoadModelAndPredict.
+
+    :param id2word: gensim Dictionary
+    :param corpus: bag of words corpus
+    :param num_topics: number of topics to extract
+    :param passes: number of passes over the corpus
+    :param eval_every: log perplexity every this many updates, 0 to never
+        evaluate. Evaluating is expensive, every update can double the
+        training time.
+    :param engine: one of LDA_ENGINES
+    :param workers: worker processes for the multicore engine, None for
+        one less than the number of cores
+    :return: trained LdaModel
+    """
+    eval_every = eval_every or None
+    if engine == 'single':
+        return LdaModel(num_topics=num_topics,
+                        id2word=id2word,
+                        corpus=corpus,
+                        passes=passes,
+                        eval_every=eval_every)
+    elif engine == 'multicore':
+        return LdaMulticore(num_topics=num_topics,
+                            id2word=id2word,
+                            corpus=corpus,
+                            passes=passes,
+                            eval_every=eval_every,
+                            workers=workers)
+    elif engine == 'distributed':
+        return LdaModel(num_topics=num_topics,
+                        id2word=id2word,
+                        corpus=corpus,
+                        passes=passes,
+                        eval_every=eval_every,
+                        distributed=True)
+    else:
+        raise ValueError("unknown LDA engine {!r}, expected one of {}".format(
+            engine, LDA_ENGINES))
+
+
+def get_topic_vecs(lda, corpus, chunksize=2000, sparse_threshold=None):
+    """
+    Topic distribution of every document in corpus, as one matrix.
+
+    The corpus is streamed through LdaModel.inference a chunk at a time and
+    each chunk is written straight into a preallocated float32 array, so
+    neither per document topic lists nor a float64 copy are ever built.
+
+    :param lda: trained LdaModel
+    :param corpus: bag of words corpus
+    :param chunksize: documents inferred per call
+    :param sparse_threshold: if given, drop probabilities below it and
+        return a scipy csr_matrix instead. Worth it with many topics, where
+        most of every row is close to zero.
+    :return: (len(corpus), num_topics) float32 array or csr_matrix
+    """
+    num_docs = len(corpus)
+    if sparse_threshold is None:
+        topic_vecs = np.empty((num_docs, lda.num_topics), dtype=np.float32)
+    else:
+        blocks = []
+
+    row = 0
+    for chunk in grouper(corpus, chunksize):
+        gamma, _ = lda.inference(chunk)
+        chunk_vecs = gamma / gamma.sum(axis=1)[:, np.newaxis]
+        if sparse_threshold is None:
+            topic_vecs[row:row + len(chunk)] = chunk_vecs
+        else:
+            chunk_vecs[chunk_vecs < sparse_threshold] = 0
+            blocks.append(sparse.csr_matrix(chunk_vecs, dtype=np.float32))
+        row += len(chunk)
+
+    if sparse_threshold is None:
+        return topic_vecs
+    if not blocks:
+        return sparse.csr_matrix((0, lda.num_topics), dtype=np.float32)
+    return sparse.vstack(blocks, format='csr')
+
+
+def save_topic_matrix(path, topic_vecs, labels):
+    """
+    Save the classifier's training matrix, so the classifier can be refitted
+    without running LDA inference again.
+
+    :param path: .npz file to write
+    :param topic_vecs: array or csr_matrix from get_topic_vecs
+    :param labels: label of every row
     :return:
     """
+    if sparse.issparse(topic_vecs):
+        np.savez(path, data=topic_vecs.data, indices=topic_vecs.indices,
+                 indptr=topic_vecs.indptr, shape=topic_vecs.shape,
+                 labels=np.asarray(labels))
+    else:
+        np.savez(path, topic_vecs=topic_vecs, labels=np.asarray(labels))
+    print("saved topic matrix to", path)
 
-    pred_labels = model.predict(topic_vecs)
 
-    # get accuracy from the training data, just to look at whether this even seems feasible...
-    # 0.3 f1 score on the training, using 12123 documents. not great results for now.
-    print("Topic Vectors:")
-    print(topic_vecs)
-    print("Compare truth to prediction (truth, prediction)")
-    # for i in range(0, len(labels)):
-    #     print("({}, {})".format(labels[i], pred_labels[i]))
-    #print("Truth Labels:")
-    #print(labels)
-    #print("Predicted Labels:")
-    #print(pred_labels)
-    print("accuracy on training data: ",
-          f1_score(labels, pred_labels, average='weighted'))
+def load_topic_matrix(path):
+    """
 
-    return
+    :param path: .npz file written by save_topic_matrix
+    :return: (topic_vecs, labels)
+    """
+    with np.load(path) as f:
+        labels = f['labels'].tolist()
+        if 'topic_vecs' in f:
+            return f['topic_vecs'], labels
+        return sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                 shape=tuple(f['shape'])), labels
 
 
-def train_model(documents, onehot_enc, labels):
+def train_classifier(topic_vecs, labels, classifier='logreg'):
+    """
+
+    :param topic_vecs: array or csr_matrix from get_topic_vecs
+    :param labels: label of every row
+    :param classifier: one of CLASSIFIERS
+    :return: fitted classifier, both kinds support predict_proba
+    """
+    if classifier == 'logreg':
+        model = LogisticRegression(class_weight='balanced')
+    elif classifier == 'sgd':
+        model = SGDClassifier(loss='log_loss', class_weight='balanced')
+    else:
+        raise ValueError("unknown classifier {!r}, expected one of {}".format(
+            classifier, CLASSIFIERS))
+    return model.fit(topic_vecs, labels)
+
+
+def train_model(id2word, corpus, onehot_enc, labels, engine='single',
+                workers=None, eval_every=1, profiler=NO_PROFILER,
+                num_topics=400, passes=50, output_dir='.', bundle_dir=None,
+                sparse_threshold=None, classifier='logreg', validation=None,
+                bundle_dtype=None, bundle_top_n=None):
     """
 
-    :param documents:
+    :param id2word: gensim Dictionary
+    :param corpus: restartable bag of words corpus, see build_corpus
     :param onehot_enc:
     :param labels:
-    :return:
+    :param engine: LDA training engine, see fit_lda
+    :param workers: worker processes for the multicore engine
+    :param eval_every: perplexity evaluation interval, 0 to disable
+    :param profiler: StageProfiler to record the training stages in
+    :param num_topics: how many topics will we attempt to extract from our
+        documents
+    :param passes: LDA passes over the corpus
+    :param output_dir: directory the trained models are saved to
+    :param bundle_dir: also export the models as a ModelBundle here, for
+        fast startup at inference time
+    :param sparse_threshold: train the classifier on a sparse topic matrix
+        without the probabilities below this, see get_topic_vecs
+    :param classifier: one of CLASSIFIERS
+    :param validation: (corpus, labels, keys) of held out documents. The
+        classifier is calibrated on the earlier of their days and the
+        metrics of the later ones are written to evaluation.json in
+        output_dir, see evaluate_model.
+    :param bundle_dtype: dtype to store the bundle's weights in, see
+        export_bundle
+    :param bundle_top_n: only keep the top N topics of every term in the
+        bundle
+    :return: (classifier, topic matrix)
     """
-    # Configuration variables, how many topics will we attempt to extract from
-    # our documents.
-    num_topics = 400
-
     # Start
-    print('number of documents: ', len(documents))
-
-    id2word = corpora.Dictionary(documents)
+    print('number of documents: ', len(corpus))
 
-    corpus = [id2word.doc2bow(doc) for doc in documents]
     onehot_labels = onehot_enc.transform(labels)
 
     print("starting LDA model")
     # plug into LDA model.
     # this can take a while with larger number of documents
-    lda = LdaModel(num_topics=num_topics,
-                   id2word=id2word,
-                   corpus=corpus,
-                   passes=50,
-                   eval_every=1)
+    start = time.perf_counter()
+    with profiler.stage('lda', items=len(corpus)) as stage:
+        lda = fit_lda(id2word, corpus, num_topics,
+                      passes=passes,
+                      eval_every=eval_every,
+                      engine=engine,
+                      workers=workers)
+        # every topic-word array LDA keeps (sstats, expElogbeta, ...) is
+        # num_topics x terms, see prune_vocabulary
+        stage['terms'] = len(id2word)
+        stage['topic_word_mb'] = round(
+            lda.expElogbeta.nbytes / (1024.0 * 1024.0), 2)
+        stage['per_pass_s'] = round((time.perf_counter() - start) / passes, 3)
+    print("LDA: {} terms, {:.1f}MB per topic-word array, {:.2f}s per "
+          "pass".format(stage['terms'], stage['topic_word_mb'],
+                        stage['per_pass_s']))
     print("topics:")
     for topic in lda.show_topics(num_topics=num_topics,
                                  num_words=20):  # print_topics():
         print(topic)
-    lda.save("trained_ldamodel.model")
+    with profiler.stage('save_lda'):
+        lda.save(os.path.join(output_dir, "trained_ldamodel.model"))
 
     # print("getting topics for testing document")
     # topic_prediction = lda.get_document_topics(bow=corpus[0])
@@ -139,118 +665,656 @@ def train_model(documents, onehot_enc, labels):
     print(
         "starting setup to train a classifier based on LDA topics for each document")
 
-    topic_vecs = []
-
-    # get topic matches and put them into vectors
-    for i in range(len(documents)):
-        top_topics = lda.get_document_topics(corpus[i],
-                                             minimum_probability=0)
-
-        #print(len(top_topics))
-        topic_vec = [top_topics[i][1] for i in range(num_topics)]
-        topic_vecs.append(topic_vec)
+    with profiler.stage('topic_vecs', items=len(corpus)):
+        topic_vecs = get_topic_vecs(lda, corpus,
+                                    sparse_threshold=sparse_threshold)
+    save_topic_matrix(os.path.join(output_dir, 'training_topics.npz'),
+                      topic_vecs, labels)
 
     # train basic logistic regression
-    model = LogisticRegression(class_weight='balanced').fit(topic_vecs, labels)
-    with open('trained_logreg_model.pkl', 'wb') as f:
+    with profiler.stage('classifier', items=len(corpus)):
+        model = train_classifier(topic_vecs, labels, classifier=classifier)
+
+    if validation is not None:
+        validation_corpus, validation_labels, validation_keys = validation
+        with profiler.stage('evaluate', items=len(validation_labels)):
+            validation_vecs = get_topic_vecs(lda, validation_corpus,
+                                             sparse_threshold=sparse_threshold)
+            report = evaluate_model(model, topic_vecs, labels,
+                                    validation_vecs, validation_labels,
+                                    validation_keys)
+        if report.get('calibration', {}).get('skipped'):
+            print("WARNING: not calibrating,",
+                  report['calibration']['skipped'])
+        print("on validation data:", summary_line(report['validation']))
+        write_evaluation(os.path.join(output_dir, 'evaluation.json'), report)
+    with open(os.path.join(output_dir, 'trained_logreg_model.pkl'), 'wb') as f:
         pickle.dump(model, f)
 
+    if bundle_dir:
+        with profiler.stage('export_bundle'):
+            check_corpus = None
+            if bundle_dtype or bundle_top_n:
+                # checked against full precision on the first training
+                # documents
+                check_corpus = [list(bow)
+                                for bow in itertools.islice(corpus, 500)]
+            export_bundle(lda, model, bundle_dir, dtype=bundle_dtype,
+                          top_n=bundle_top_n, check_corpus=check_corpus)
+
     return model, topic_vecs
 
 
-def load_articles(articles_dir, mbfc_labels):
+def extend_lda_vocabulary(lda, num_terms):
     """
+    Grow a trained LdaModel to num_terms terms, after new terms were added to
+    its id2word. The new terms start out with no counts, so their topic-word
+    weights are just the eta prior until LdaModel.update sees them.
 
-    :param articles_dir:
+    :param lda: trained LdaModel
+    :param num_terms: new vocabulary size
     :return:
     """
-    # initialize return values.
-    documents = []
-    labels = []
-    # store raw text / processed text to use later to look at result example
-    testing_text_raw = []
-    PROJ_ROOT = Path(__file__).parent.parent
-    print(articles_dir)
-    articles_dir = (PROJ_ROOT / articles_dir).resolve()
-    print("--")
-    print(articles_dir)
+    num_new_terms = num_terms - lda.num_terms
+    if num_new_terms <= 0:
+        return
+
+    state = lda.state
+    state.sstats = np.hstack([
+        state.sstats,
+        np.zeros((lda.num_topics, num_new_terms), dtype=state.sstats.dtype)])
+
+    # new terms get the same prior as the last existing one, which is the
+    # prior of every term for the default symmetric eta
+    if lda.eta.ndim == 1:
+        new_eta = np.repeat(lda.eta[-1:], num_new_terms)
+    else:
+        new_eta = np.repeat(lda.eta[:, -1:], num_new_terms, axis=1)
+    lda.eta = np.concatenate([lda.eta, new_eta], axis=-1)
+    state.eta = lda.eta.astype(state.sstats.dtype, copy=False)
+
+    lda.num_terms = num_terms
+    lda.sync_state()
 
-    # load our spacy model
-    nlp = spacy.load('en_core_web_md')
 
-    # use 10 days as a prototype
-    dates = [f for f in Path(articles_dir).iterdir() if f.is_dir()]
+def next_model_version(output_dir):
+    """
+    Pick the next unused version number for a model pair in output_dir.
+
+    :param output_dir: directory the versioned models are written to
+    :return: int
+    """
+    versions = [0]
+    for path in Path(output_dir).glob('trained_ldamodel.v*.model'):
+        version = path.name[len('trained_ldamodel.v'):-len('.model')]
+        if version.isdigit():
+            versions.append(int(version))
+    return max(versions) + 1
+
+
+def topic_matrix_path(classifier_model_path):
+    """
+    The topic matrix saved next to a classifier, training_topics.npz for
+    trained_logreg_model.pkl and training_topics.vN.npz for the versioned
+    classifiers update_model writes.
 
-    with nlp.disable_pipes("ner"):
-        for date in dates[:30]:  # parsing documents can take a while.
-            smalltest_dir = (articles_dir / date).resolve()
+    :param classifier_model_path: pickled classifier
+    :return: path of its topic matrix
+    """
+    name = os.path.basename(classifier_model_path)
+    version = ''
+    if name.startswith('trained_logreg_model.v') and name.endswith('.pkl'):
+        version = '.' + name[len('trained_logreg_model.'):-len('.pkl')]
+    return os.path.join(os.path.dirname(classifier_model_path),
+                        'training_topics{}.npz'.format(version))
 
-            publishers = [f for f in smalltest_dir.iterdir() if f.is_dir()]
 
-            for pub_articles in publishers:
-                articles = [f for f in pub_articles.iterdir() if f.is_file()]
+def update_model(lda_model_path, classifier_model_path, documents,
+                 corpus_path, output_dir='.', passes=None, eval_every=1,
+                 no_below=2, keep_n=100000):
+    """
+    Incrementally update a trained LDA model and classifier with new
+    documents, instead of retraining on the whole history.
+
+    The dictionary is extended with the new documents' terms, pruned like
+    at training time, and LdaModel.update runs on the new documents only.
+    The classifier is refitted on the saved topic matrix of the earlier
+    documents stacked with the new documents' topic vectors, so it keeps
+    the whole history. The earlier rows aren't inferred again with the
+    updated topics, an update keeps every topic's id and only moves it
+    towards the new documents. The result is written as a new versioned
+    model pair and topic matrix next to the old ones, which are left
+    untouched.
+
+    :param lda_model_path: saved LdaModel to start from
+    :param classifier_model_path: pickled classifier to start from, with
+        its topic matrix next to it, see topic_matrix_path
+    :param documents: iterable of (lemmas, label, key) of the new documents
+        only
+    :param corpus_path: file to serialize the new documents' corpus to
+    :param output_dir: directory to write the new model pair to
+    :param passes: LDA passes over the new documents, None to use the
+        number the model was trained with
+    :param eval_every: perplexity evaluation interval, 0 to disable
+    :param no_below: see prune_new_terms
+    :param keep_n: see prune_new_terms
+    :return: (lda, classifier, version)
+    """
+    lda = LdaModel.load(lda_model_path)
+    with open(classifier_model_path, 'rb') as f:
+        classifier = pickle.load(f)
+
+    old_num_terms = len(lda.id2word)
+    id2word, corpus, labels, _ = build_corpus(documents, corpus_path,
+                                              id2word=lda.id2word)
+    print('number of new documents: ', len(corpus))
+    if not len(corpus):
+        raise ValueError("no new documents to update the model with")
+    id2word, corpus = prune_new_terms(id2word, corpus, corpus_path,
+                                      old_num_terms, no_below=no_below,
+                                      keep_n=keep_n)
+    print('new terms: ', len(id2word) - old_num_terms)
+
+    extend_lda_vocabulary(lda, len(id2word))
+
+    print("updating LDA model")
+    # set on the model rather than passed to update, LdaMulticore.update
+    # only reads them from there
+    if passes:
+        lda.passes = passes
+    lda.eval_every = eval_every or None
+    lda.update(corpus)
+
+    topic_vecs = get_topic_vecs(lda, corpus)
+    old_topics_path = topic_matrix_path(classifier_model_path)
+    if os.path.exists(old_topics_path):
+        old_vecs, old_labels = load_topic_matrix(old_topics_path)
+        if sparse.issparse(old_vecs):
+            topic_vecs = sparse.vstack([old_vecs,
+                                        sparse.csr_matrix(topic_vecs)],
+                                       format='csr')
+        else:
+            topic_vecs = np.vstack([old_vecs, topic_vecs])
+        labels = old_labels + labels
+        print("refitting the classifier on {} earlier and {} new "
+              "documents".format(len(old_labels), len(corpus)))
+    else:
+        print("WARNING: no topic matrix at {}, refitting the classifier on "
+              "the new documents only".format(old_topics_path))
+    classifier.fit(topic_vecs, labels)
+
+    version = next_model_version(output_dir)
+    save_topic_matrix(os.path.join(output_dir,
+                                   'training_topics.v{}.npz'.format(version)),
+                      topic_vecs, labels)
+    lda.save(os.path.join(output_dir,
+                          'trained_ldamodel.v{}.model'.format(version)))
+    with open(os.path.join(output_dir,
+                           'trained_logreg_model.v{}.pkl'.format(version)),
+              'wb') as f:
+        pickle.dump(classifier, f)
+    print("wrote model version", version)
+
+    return lda, classifier, version
+
+
+def publisher_readers(articles_dir, mbfc_labels, max_days=30, after_date=None,
+                      articles_per_publisher=1, date_from=None, date_to=None):
+    """
+    Walk the preprocessed articles tree and yield one reader per labelled
+    publisher and day. Calling a reader loads that publisher's articles,
+    so the walk itself only lists directories and the reading can be
+    spread over threads, see read_articles. Both layouts written by
+    preprocess_data are understood, and give the same keys.
+
+    :param articles_dir: resolved root of the date/publisher/article tree
+    :param mbfc_labels: publisher -> label dict from load_labels
+    :param max_days: only walk this many days, None for all of them
+    :param after_date: only walk days whose directory name sorts after this
+        one, e.g. '2018-06-30'
+    :param articles_per_publisher: articles read per publisher and day, in
+        file name (or shard line) order, None for all of them
+    :param date_from: only walk days from this one on
+    :param date_to: only walk days up to and including this one
+    :return: generator of readers, each returning a list of
+        (key, text, label)
+    """
+    dates = [f for f in Path(articles_dir).iterdir() if f.is_dir()
+             and (after_date is None or f.name > after_date)
+             and (date_from is None or f.name >= date_from)
+             and (date_to is None or f.name <= date_to)]
+
+    def read_files(paths, label):
+        return [(str(path.relative_to(articles_dir)), path.read_text(), label)
+                for path in paths]
+
+    def read_shard(shard, date, publisher, label):
+        articles = []
+        with shard.open() as f:
+            for line in f:
+                if articles_per_publisher is not None \
+                        and len(articles) >= articles_per_publisher:
+                    break
+                article = json.loads(line)
+                key = os.path.join(date, publisher, article['id'] + '.txt')
+                articles.append((key, article['content'], label))
+        return articles
+
+    for date in dates[:max_days]:
+        smalltest_dir = (articles_dir / date).resolve()
+
+        for entry in smalltest_dir.iterdir():
+            if entry.is_dir():
+                this_publisher = entry.name
+                # skip if no label for publisher
+                if this_publisher not in mbfc_labels:
+                    continue
+                articles = sorted(f for f in entry.iterdir() if f.is_file())
                 if articles:
-                    this_publisher = str(
-                        articles[0].parent.relative_to(smalltest_dir))
-                    # print(this_publisher)
-                    # skip if no label for publisher
-                    if str(this_publisher) not in mbfc_labels.keys():
-                        continue
-                    else:
-                        text = articles[0].read_text()
-
-                        # save raw text of first document, just for looking at results later
-                        if not testing_text_raw:
-                            testing_text_raw = text
-
-                        text = text.replace("\n", " ")
-
-                        # preprocessing text
-                        lem_text = [token.lemma_.lower() for token in nlp(text)
-                                    if not token.is_stop
-                                    and not token.is_punct
-                                    and not token.is_space
-                                    and not token.lemma_.lower() in STOPWORDS
-                                    and not token.pos_ == 'SYM'
-                                    and not token.pos_ == 'NUM']
-                        # print(lem_text)
-                        documents.append(lem_text)
-                        labels.append(mbfc_labels[this_publisher])
-    return documents, labels
-
-
-def load_labels(path):
+                    yield partial(read_files,
+                                  articles[:articles_per_publisher],
+                                  mbfc_labels[this_publisher])
+
+            elif entry.name.endswith(SHARD_SUFFIX):
+                this_publisher = entry.name[:-len(SHARD_SUFFIX)]
+                if this_publisher not in mbfc_labels:
+                    continue
+                yield partial(read_shard, entry, date.name, this_publisher,
+                              mbfc_labels[this_publisher])
+
+
+def read_articles(readers, read_workers=4, max_pending=64):
+    """
+    Run the readers from publisher_readers and yield their articles in
+    walk order.
+
+    With read_workers > 0 a thread walks the tree and hands the readers to
+    a pool of reading threads, so the disk keeps reading while the caller
+    parses what was read before. At most max_pending readers are queued or
+    in flight at a time: once the caller falls behind, the walk blocks
+    instead of piling up article texts in memory.
+
+    :param readers: iterable of readers, see publisher_readers. A
+        generator is closed, in the thread that iterated it, once the walk
+        ends or is stopped early.
+    :param read_workers: reading threads, 0 to read one reader at a time
+        in the calling thread
+    :param max_pending: most readers queued ahead of the caller
+    :return: generator of (key, text, label)
+    """
+    close_readers = getattr(readers, 'close', lambda: None)
+    if not read_workers:
+        try:
+            for reader in readers:
+                yield from reader()
+        finally:
+            close_readers()
+        return
+
+    pending = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # blocks while the queue is full, unless the caller went away
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def walk(executor):
+        try:
+            for reader in readers:
+                if stop.is_set():
+                    return
+                put(executor.submit(reader))
+        except BaseException as e:
+            put(e)
+        finally:
+            close_readers()
+            put(done)
+
+    num_articles = 0
+    waited = 0.0
+    with ThreadPoolExecutor(read_workers) as executor:
+        walker = threading.Thread(target=walk, args=(executor,), daemon=True)
+        walker.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = pending.get()
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                articles = item.result()
+                waited += time.perf_counter() - start
+                num_articles += len(articles)
+                yield from articles
+        finally:
+            stop.set()
+            walker.join()
+            executor.shutdown(cancel_futures=True)
+
+    print("read {} articles with {} threads, {:.1f}s spent waiting on "
+          "the disk".format(num_articles, read_workers, waited))
+
+
+def stored_readers(articles_dir, rows):
+    """
+    Readers for articles selected from an ArticleStore, one per publisher
+    and day like publisher_readers gives. Shard lines are read by their
+    stored offset, without scanning the shard.
+
+    :param articles_dir: resolved root of the date/publisher/article tree
+    :param rows: rows from ArticleStore.select, closed with the generator
+        if they are a generator themselves
+    :return: generator of readers, each returning a list of
+        (key, text, label)
+    """
+    def read_stored(day_rows):
+        articles = []
+        shard = None
+        try:
+            for key, label, _, _, path, offset in day_rows:
+                if offset is None:
+                    text = (articles_dir / path).read_text()
+                else:
+                    if shard is None:
+                        shard = (articles_dir / path).open('rb')
+                    shard.seek(offset)
+                    text = json.loads(shard.readline())['content']
+                articles.append((key, text, label))
+        finally:
+            if shard is not None:
+                shard.close()
+        return articles
+
+    try:
+        for _, day_rows in itertools.groupby(rows,
+                                             key=lambda row: row[2:4]):
+            yield partial(read_stored, list(day_rows))
+    finally:
+        if hasattr(rows, 'close'):
+            rows.close()
+
+
+def iter_articles(articles_dir, mbfc_labels, max_days=30, after_date=None,
+                  articles_per_publisher=1, read_workers=0, store=None,
+                  subset=None):
+    """
+    Yield (key, text, label) for the first articles_per_publisher articles
+    of every labelled publisher on each day.
+
+    :param articles_dir: resolved root of the date/publisher/article tree
+    :param mbfc_labels: publisher -> label dict from load_labels
+    :param max_days: only walk this many days, None for all of them
+    :param after_date: only walk days whose directory name sorts after this
+        one, e.g. '2018-06-30'
+    :param articles_per_publisher: see publisher_readers
+    :param read_workers: see read_articles
+    :param store: ArticleStore of the tree, to select the articles from
+        instead of walking the tree. Days then come in date order.
+    :param subset: dict narrowing down the articles, with any of
+        date_from, date_to (inclusive, e.g. '2018-06-30'), labels and
+        publishers (lists)
+    :return: generator of (key, text, label), key is the article path
+        relative to articles_dir
+    """
+    subset = dict(subset or {})
+    if store is not None:
+        rows = store.select(max_days=max_days, after_date=after_date,
+                            articles_per_publisher=articles_per_publisher,
+                            **subset)
+        rows = (row for row in rows if row[3] in mbfc_labels)
+        print("selecting articles from", store.path)
+        readers = stored_readers(articles_dir, rows)
+    else:
+        labels = subset.pop('labels', None)
+        publishers = subset.pop('publishers', None)
+        mbfc_labels = {publisher: label
+                       for publisher, label in mbfc_labels.items()
+                       if (labels is None or label in labels)
+                       and (publishers is None or publisher in publishers)}
+        readers = publisher_readers(articles_dir, mbfc_labels,
+                                    max_days=max_days, after_date=after_date,
+                                    articles_per_publisher=articles_per_publisher,
+                                    **subset)
+    return read_articles(readers, read_workers=read_workers)
+
+
+def index_articles(articles_dir, date_from=None, date_to=None):
+    """
+    Walk the whole articles tree, in either layout, and describe every
+    article in it for the ArticleStore.
+
+    :param articles_dir: resolved root of the date/publisher/article tree
+    :param date_from: only walk days from this one on
+    :param date_to: only walk days up to and including this one
+    :return: generator of (key, date, publisher, position, length, path,
+        offset) rows, see ArticleStore, in date, publisher and position
+        order
     """
+    for date in sorted(f for f in Path(articles_dir).iterdir() if f.is_dir()
+                       and (date_from is None or f.name >= date_from)
+                       and (date_to is None or f.name <= date_to)):
+        for entry in sorted(date.iterdir()):
+            if entry.is_dir():
+                articles = sorted(f for f in entry.iterdir() if f.is_file())
+                for position, article in enumerate(articles):
+                    key = str(article.relative_to(articles_dir))
+                    yield (key, date.name, entry.name, position,
+                           article.stat().st_size, key, None)
+
+            elif entry.name.endswith(SHARD_SUFFIX):
+                publisher = entry.name[:-len(SHARD_SUFFIX)]
+                path = str(entry.relative_to(articles_dir))
+                offset = 0
+                with entry.open('rb') as f:
+                    for position, line in enumerate(f):
+                        article = json.loads(line)
+                        key = os.path.join(date.name, publisher,
+                                           article['id'] + '.txt')
+                        yield (key, date.name, publisher, position,
+                               len(article['content'].encode('utf-8')), path,
+                               offset)
+                        offset += len(line)
+
+
+def build_article_store(articles_dir, labels_path=None):
+    """
+    (Re)build the ArticleStore of an articles tree, see index_articles.
 
-    :param path:
-    :return:
+    :param articles_dir: root of the date/publisher/article tree
+    :param labels_path: labels.csv to store the publisher labels from, the
+        labels already in the store are kept if None
+    :return: ArticleStore
+    """
+    articles_dir = Path(articles_dir).resolve()
+    start = time.perf_counter()
+    store = ArticleStore(articles_dir / STORE_FILENAME)
+    if labels_path is not None:
+        store.set_labels(read_publisher_labels(labels_path))
+    store.replace_articles(index_articles(articles_dir))
+    print("indexed articles in {:.1f}s: {}".format(
+        time.perf_counter() - start, store.summary()))
+    return store
+
+
+def lemmatize_articles(articles, token_cache=None, batch_size=64,
+                       n_process=1, preprocessor=None):
+    """
+    Yield (lemmas, label, key) for every (key, text, label) in articles, in
+    order.
+
+    Articles found in token_cache are not parsed again. Everything else is
+    streamed through a single lemmatize_texts run, and spacy is only loaded
+    once the first uncached article shows up.
+
+    :param articles: iterable of (key, text, label), see iter_articles
+    :param token_cache: TokenCache or None
+    :param batch_size: spacy batch size
+    :param n_process: spacy worker processes, -1 for all cores
+    :param preprocessor: Preprocessor, the spacy backend if None
+    :return: generator of (lemmas, label, key)
     """
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+
+    def read_entries():
+        for seq, (key, text, label) in enumerate(articles):
+            digest = lemmas = None
+            if token_cache is not None:
+                digest = TokenCache.content_digest(text)
+                lemmas = token_cache.get(key, digest)
+            yield text, (seq, key, digest, label, lemmas)
+
+    entries = read_entries()
+
+    # cached articles before the first miss don't need spacy at all
+    for text, entry in entries:
+        if entry[4] is None:
+            first_miss = (text, entry[0])
+            break
+        yield entry[4], entry[3], entry[1]
+    else:
+        return
+
+    # entries waiting for spacy to catch up, in article order. Cache hits
+    # sit here until every miss in front of them has been parsed.
+    pending = deque([entry])
+
+    def texts():
+        yield first_miss
+        for text, entry in entries:
+            pending.append(entry)
+            if entry[4] is None:
+                yield text, entry[0]
+
+    for lem_text, seq in lemmatize_texts(preprocessor, texts(),
+                                         batch_size=batch_size,
+                                         n_process=n_process):
+        while pending[0][0] != seq:
+            hit = pending.popleft()
+            yield hit[4], hit[3], hit[1]
+
+        _, key, digest, label, _ = pending.popleft()
+        if token_cache is not None:
+            token_cache.put(key, digest, lem_text)
+        yield lem_text, label, key
+
+    for hit in pending:
+        yield hit[4], hit[3], hit[1]
+
+
+def resolve_articles_dir(articles_dir):
+    """
+
+    :param articles_dir: articles tree root, relative paths are taken
+        relative to the project root
+    :return: absolute Path
+    """
+    PROJ_ROOT = Path(__file__).parent.parent
+    return (PROJ_ROOT / articles_dir).resolve()
+
 
-    # get data from labels csv into a couple dictionaries
-    labels = dict()
-    # publisher data keys should match the folder names for each publisher for a given day
-    publisher_data = dict()
-    #with (path / 'labels.csv').resolve().open() as f:
-    with open(os.path.join(path, 'labels.csv')) as f:
+def open_article_store(articles_dir):
+    """
+
+    :param articles_dir: articles tree root, see resolve_articles_dir
+    :return: the tree's ArticleStore, None if preprocess_data didn't build
+        one
+    """
+    store = ArticleStore.open_for(resolve_articles_dir(articles_dir))
+    if store is not None:
+        print("using article store", store.path)
+    return store
+
+
+def load_articles(articles_dir, mbfc_labels, max_days=30, batch_size=64,
+                  n_process=1, token_cache=None, after_date=None,
+                  articles_per_publisher=1, read_workers=4, preprocessor=None,
+                  store=None, subset=None):
+    """
+    Stream the lemmatized articles and their labels from the articles tree.
+
+    :param articles_dir:
+    :param mbfc_labels:
+    :param max_days: number of days to load, None for the full corpus
+    :param batch_size: spacy batch size
+    :param n_process: spacy worker processes, -1 for all cores
+    :param token_cache: TokenCache to reuse lemmatized articles from
+    :param after_date: only load days after this one
+    :param articles_per_publisher: articles loaded per publisher and day,
+        None for all of them
+    :param read_workers: threads reading articles ahead of spacy, 0 to
+        read them in between parsing
+    :param preprocessor: Preprocessor, the spacy backend if None
+    :param store: ArticleStore to select the articles from, see
+        iter_articles
+    :param subset: see iter_articles
+    :return: generator of (lemmas, label, key), key is the article path
+        relative to articles_dir
+    """
+    print(articles_dir)
+    articles_dir = resolve_articles_dir(articles_dir)
+    print("--")
+    print(articles_dir)
+
+    articles = iter_articles(articles_dir, mbfc_labels, max_days,
+                             after_date=after_date,
+                             articles_per_publisher=articles_per_publisher,
+                             read_workers=read_workers,
+                             store=store,
+                             subset=subset)
+    yield from lemmatize_articles(articles,
+                                  token_cache=token_cache,
+                                  batch_size=batch_size,
+                                  n_process=n_process,
+                                  preprocessor=preprocessor)
+
+    if token_cache is not None:
+        print("token cache: {} hits, {} misses".format(token_cache.hits,
+                                                       token_cache.misses))
+        token_cache.save()
+
+
+def read_publisher_labels(labels_path):
+    """
+    Read the MBFC label column of labels.csv, without keeping the rest of
+    the rows.
+
+    :param labels_path: labels.csv file
+    :return: {publisher: label}, label is '' for unlabelled publishers
+    """
+    with open(labels_path) as f:
         labelreader = csv.reader(f, delimiter=',')
-        firstrow = True
-        for row in labelreader:
-            if firstrow:
-                for ind in range(len(row)):
-                    labels[row[ind]] = ind - 1
-                firstrow = False
-                continue
-            publisher_data[row[0]] = row[1:]
+        header = next(labelreader)
+        label_ind = header.index(MBFC_LABEL_COLUMN)
+        # publisher keys should match the folder names for each publisher
+        # for a given day
+        return {row[0]: row[label_ind] for row in labelreader}
 
 
-    label_ind = labels['Media Bias / Fact Check, label']
-    mbfc_labels = dict()
-    for pub in publisher_data.keys():
-        bias_label = publisher_data[pub][label_ind]
-        if bias_label != '':
-            # print(pub, ':', bias_label)
-            mbfc_labels[pub] = bias_label
-    # print(publisher_data.keys())
+def load_labels(path, store=None):
+    """
+
+    :param path: directory holding labels.csv
+    :param store: ArticleStore to take the labels from instead. If it has
+        none yet, the labels read from labels.csv are stored in it.
+    :return: (publisher -> label dict of the labelled publishers,
+        LabelBinarizer fitted on the labels)
+    """
+    mbfc_labels = store.labels() if store is not None else None
+    if not mbfc_labels:
+        publisher_labels = read_publisher_labels(
+            os.path.join(path, 'labels.csv'))
+        if store is not None:
+            store.set_labels(publisher_labels)
+        mbfc_labels = {publisher: bias_label for publisher, bias_label
+                       in publisher_labels.items() if bias_label != ''}
     print(set(mbfc_labels.values()))
     print(len(set(mbfc_labels.values())))
     onehot_enc = LabelBinarizer().fit(list(mbfc_labels.values()))
@@ -258,24 +1322,86 @@ def load_labels(path):
     return mbfc_labels, onehot_enc
 
 
-def load_data(data_dir, article_dir):
+def load_data(data_dir, article_dir, corpus_path, max_days=30, batch_size=64,
+              n_process=1, token_cache=None, after_date=None,
+              profiler=NO_PROFILER, no_below=2, no_above=1.0, keep_n=100000,
+              phrases=False, phrase_min_count=5, phrase_threshold=10.0,
+              articles_per_publisher=1, read_workers=4, preprocessor=None,
+              use_store=True, subset=None, validation_fraction=None):
     """
     This method will load in our biased news dataset, either as a json blob
     or as a sqlite database.
 
     :param path:
     :param mode:
-    :return:
+    :param no_below: see prune_vocabulary
+    :param no_above: see prune_vocabulary
+    :param keep_n: see prune_vocabulary
+    :param phrases: learn bigram phrases and join them in every document,
+        see PhraseModel
+    :param phrase_min_count: see PhraseModel.train
+    :param phrase_threshold: see PhraseModel.train
+    :param articles_per_publisher: see load_articles
+    :param read_workers: see load_articles
+    :param preprocessor: see load_articles
+    :param use_store: select the articles and labels from the tree's
+        ArticleStore if it has one, instead of walking the tree and
+        reading labels.csv
+    :param subset: see iter_articles
+    :param validation_fraction: fraction of the latest days the caller
+        holds out, see split_by_date. The phrases and the vocabulary are
+        only learned from the other days.
+    :return: (id2word, corpus, labels, onehot_enc, keys)
     """
     raw_data = None
+    store = open_article_store(article_dir) if use_store else None
 
     # load our news source labels
-    mbfc_labels, onehot_enc = load_labels(data_dir)
-
-    # Load the articles into memory
-    documents, labels = load_articles(article_dir, mbfc_labels)
-
-    return documents, labels, onehot_enc
+    with profiler.stage('load_labels') as stage:
+        mbfc_labels, onehot_enc = load_labels(data_dir, store=store)
+        stage['items'] = len(mbfc_labels)
+
+    # Stream the articles into a corpus on disk. Reading, parsing and
+    # writing the corpus are interleaved, so they are timed as one stage.
+    with profiler.stage('load_articles') as stage:
+        documents = load_articles(article_dir, mbfc_labels,
+                                  max_days=max_days,
+                                  batch_size=batch_size,
+                                  n_process=n_process,
+                                  token_cache=token_cache,
+                                  after_date=after_date,
+                                  articles_per_publisher=articles_per_publisher,
+                                  read_workers=read_workers,
+                                  preprocessor=preprocessor,
+                                  store=store,
+                                  subset=subset)
+        id2word = None
+        if phrases:
+            with profiler.stage('learn_phrases'):
+                phrase_model, documents = learn_phrases(
+                    documents, corpus_path + '.tokens.jsonl',
+                    min_count=phrase_min_count, threshold=phrase_threshold,
+                    validation_fraction=validation_fraction)
+            print("learned {} phrases".format(len(phrase_model)))
+            id2word = corpora.Dictionary()
+            id2word.phrasegrams = phrase_model.phrasegrams
+        id2word, corpus, labels, keys = build_corpus(documents, corpus_path,
+                                                     id2word=id2word)
+        stage['items'] = len(labels)
+    if store is not None:
+        store.close()
+
+    with profiler.stage('prune_vocabulary') as stage:
+        id2word, corpus, stats = prune_vocabulary(id2word, corpus, corpus_path,
+                                                  no_below=no_below,
+                                                  no_above=no_above,
+                                                  keep_n=keep_n,
+                                                  doc_ids=training_ids(
+                                                      keys,
+                                                      validation_fraction))
+        stage.update(stats)
+
+    return id2word, corpus, labels, onehot_enc, keys
 
 
 def main():
@@ -301,11 +1427,289 @@ def main():
                               "format this program can use. Warning! This "
                               "will take up ~4GB of space on this disk."))
 
+    parser.add_argument("--layout",
+                        choices=ARTICLE_LAYOUTS,
+                        default='files',
+                        help=("How -p writes the articles: one text file "
+                              "per article, or one JSON lines shard per "
+                              "publisher per day."))
+
+    parser.add_argument("--extract-workers",
+                        type=int,
+                        default=None,
+                        help=("Number of processes -p uses, defaults to "
+                              "one per core."))
+
+    parser.add_argument("--max-days",
+                        type=int,
+                        default=30,
+                        help=("Number of days of articles to train on, "
+                              "0 for the full corpus."))
+
+    parser.add_argument("--articles-per-publisher",
+                        type=int,
+                        default=1,
+                        help=("Number of articles to load per publisher "
+                              "and day, 0 for all of them."))
+
+    parser.add_argument("--read-workers",
+                        type=int,
+                        default=4,
+                        help=("Threads reading articles from disk while "
+                              "spacy parses, 0 to read them in between."))
+
+    parser.add_argument("--preprocessing",
+                        choices=BACKENDS,
+                        default='spacy',
+                        help=("Tokenizer backend: the full spacy tagger and "
+                              "lemmatizer, or the much faster lookup table "
+                              "lemmatizer. See Preprocessing.py."))
+
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=64,
+                        help=("Number of articles spacy parses per batch."))
+
+    parser.add_argument("--n-process",
+                        type=int,
+                        default=1,
+                        help=("Number of spacy worker processes, -1 to use "
+                              "all cores."))
+
+    parser.add_argument("--corpus",
+                        type=str,
+                        default='training_corpus.mm',
+                        help=("File to serialize the bag of words training "
+                              "corpus to."))
+
+    parser.add_argument("--engine",
+                        choices=LDA_ENGINES,
+                        default='single',
+                        help=("LDA training engine. 'multicore' trains with "
+                              "--workers local processes, 'distributed' "
+                              "needs gensim's lda_dispatcher and lda_worker "
+                              "processes running."))
+
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help=("Worker processes for the multicore engine, "
+                              "defaults to one less than the number of "
+                              "cores."))
+
+    parser.add_argument("--no-below",
+                        type=int,
+                        default=2,
+                        help=("Drop terms found in fewer documents than "
+                              "this before training LDA."))
+
+    parser.add_argument("--no-above",
+                        type=float,
+                        default=1.0,
+                        help=("Drop terms found in more than this fraction "
+                              "of the documents, e.g. 0.5."))
+
+    parser.add_argument("--keep-n",
+                        type=int,
+                        default=100000,
+                        help=("Keep at most this many of the most frequent "
+                              "terms, 0 for no limit."))
+
+    parser.add_argument("--phrases",
+                        action='store_true',
+                        help=("Learn bigram phrases (e.g. white_house) and "
+                              "use them as terms. They are stored with the "
+                              "dictionary and applied at prediction time "
+                              "as well."))
+
+    parser.add_argument("--phrase-min-count",
+                        type=int,
+                        default=5,
+                        help=("Ignore word pairs seen fewer times than "
+                              "this when learning phrases."))
+
+    parser.add_argument("--phrase-threshold",
+                        type=float,
+                        default=10.0,
+                        help=("Minimum phrase score, higher gives fewer "
+                              "phrases."))
+
+    parser.add_argument("--num-topics",
+                        type=int,
+                        default=400,
+                        help=("Number of LDA topics to extract."))
+
+    parser.add_argument("--passes",
+                        type=int,
+                        default=None,
+                        help=("Number of LDA passes over the corpus, 50 by "
+                              "default. With --update, defaults to the "
+                              "number the model was trained with."))
+
+    parser.add_argument("--classifier",
+                        choices=CLASSIFIERS,
+                        default='logreg',
+                        help=("Classifier trained on the topic vectors."))
+
+    parser.add_argument("--eval-every",
+                        type=int,
+                        default=1,
+                        help=("Log perplexity every N model updates, 0 to "
+                              "skip evaluation entirely."))
+
+    parser.add_argument("--validation-fraction",
+                        type=float,
+                        default=0.2,
+                        help=("Fraction of the days, the most recent ones, "
+                              "held out to evaluate and calibrate the "
+                              "classifier on. The metrics are written to "
+                              "evaluation.json. 0 to train on everything."))
+
+    parser.add_argument("--update",
+                        nargs=2,
+                        metavar=('LDA_MODEL', 'CLASSIFIER'),
+                        default=None,
+                        help=("Incrementally update this model pair with "
+                              "the days after --after-date instead of "
+                              "training from scratch. Writes a new "
+                              "versioned model pair."))
+
+    parser.add_argument("--after-date",
+                        type=str,
+                        default=None,
+                        help=("Only load days whose directory name sorts "
+                              "after this one, e.g. 2018-06-30."))
+
+    parser.add_argument("--date-from",
+                        type=str,
+                        default=None,
+                        help=("Only load days from this one on, e.g. "
+                              "2018-03-01."))
+
+    parser.add_argument("--date-to",
+                        type=str,
+                        default=None,
+                        help=("Only load days up to and including this "
+                              "one."))
+
+    parser.add_argument("--labels",
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help=("Only load publishers with one of these "
+                              "labels."))
+
+    parser.add_argument("--publishers",
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help=("Only load these publishers."))
+
+    parser.add_argument("--index-articles",
+                        action='store_true',
+                        help=("(Re)build the article store (articles.db) of "
+                              "article_dir before loading. -p builds it "
+                              "too."))
+
+    parser.add_argument("--walk-articles",
+                        action='store_true',
+                        help=("Walk the articles tree and read labels.csv "
+                              "even if the tree has an article store."))
+
+    parser.add_argument("--export-bundle",
+                        type=str,
+                        default=None,
+                        help=("Also export the trained models as a memory "
+                              "mapped inference bundle to this directory."))
+
+    parser.add_argument("--bundle-dtype",
+                        type=str,
+                        choices=BUNDLE_DTYPES,
+                        default=None,
+                        help=("Store the bundle's topic-word weights and "
+                              "classifier coefficients in this dtype. "
+                              "float16 halves the bundle, see ModelBundle.py "
+                              "compare for what it costs."))
+
+    parser.add_argument("--bundle-top-n",
+                        type=int,
+                        default=None,
+                        help=("Only keep the N largest topic weights of "
+                              "every term in the bundle. This can cost a lot "
+                              "of accuracy: on a 10 topic model, N=3 changed "
+                              "28%% of the labels. The bundle is checked "
+                              "against full precision on the training "
+                              "documents, with a warning when more than 1%% "
+                              "of the labels change."))
+
+    parser.add_argument("--sparse-topics",
+                        type=float,
+                        default=None,
+                        metavar='THRESHOLD',
+                        help=("Train the classifier on a sparse topic "
+                              "matrix, dropping topic probabilities below "
+                              "THRESHOLD, e.g. 0.001."))
+
+    parser.add_argument("--refit-classifier",
+                        type=str,
+                        default=None,
+                        metavar='TOPICS_NPZ',
+                        help=("Only refit the classifier on a topic matrix "
+                              "saved by an earlier training run "
+                              "(training_topics.npz), skipping LDA."))
+
+    parser.add_argument("--profile-report",
+                        type=str,
+                        default=None,
+                        help=("Write wall time, CPU time, memory and "
+                              "throughput of every stage to this JSON "
+                              "file."))
+
+    parser.add_argument("--cprofile-dir",
+                        type=str,
+                        default=None,
+                        help=("Also run every top level stage under "
+                              "cProfile and dump the stats here."))
+
+    parser.add_argument("--token-cache",
+                        type=str,
+                        default=None,
+                        help=("Directory to cache lemmatized articles in. "
+                              "Unchanged articles are not parsed again on "
+                              "later runs."))
+
+    parser.add_argument("--clear-token-cache",
+                        action='store_true',
+                        help=("Empty the token cache before loading."))
+
     inputs = parser.parse_args()
 
+    profiler = StageProfiler(cprofile_dir=inputs.cprofile_dir)
+    try:
+        run(inputs, profiler)
+    finally:
+        if inputs.profile_report:
+            profiler.write_report(inputs.profile_report)
+
+    return
+
+
+def run(inputs, profiler):
+    """
+    Run the steps selected by the parsed command line.
+
+    :param inputs: argparse namespace from main
+    :param profiler: StageProfiler the steps are recorded in
+    :return:
+    """
     if inputs.p:
-        preprocess_data(inputs.article_dir,
-                        os.path.join(inputs.data_dir, 'articles', 'articles'))
+        with profiler.stage('preprocess_data'):
+            preprocess_data(inputs.article_dir,
+                            os.path.join(inputs.data_dir, 'articles', 'articles'),
+                            workers=inputs.extract_workers,
+                            layout=inputs.layout,
+                            labels_path=os.path.join(inputs.data_dir,
+                                                     'labels.csv'))
 
     ###########################################################################
     # This problem can be broken into the following steps:
@@ -316,14 +1720,130 @@ def main():
     #        phrases and topics for the biases present in the document
     ###########################################################################
 
+    if inputs.refit_classifier:
+        topic_vecs, labels = load_topic_matrix(inputs.refit_classifier)
+        with profiler.stage('classifier', items=len(labels)):
+            model = train_classifier(topic_vecs, labels,
+                                     classifier=inputs.classifier)
+        classifier_path = os.path.join(
+            os.path.dirname(inputs.refit_classifier) or '.',
+            'trained_logreg_model.pkl')
+        with open(classifier_path, 'wb') as f:
+            pickle.dump(model, f)
+        print("wrote", classifier_path)
+        with profiler.stage('predict_bias', items=len(labels)):
+            predict_bias(model, topic_vecs, labels)
+        return
+
+    if inputs.index_articles:
+        with profiler.stage('index_articles'):
+            build_article_store(
+                resolve_articles_dir(inputs.article_dir),
+                labels_path=os.path.join(inputs.data_dir, 'labels.csv')).close()
+
+    # date range, label and publisher selection, see iter_articles
+    subset = {name: getattr(inputs, name)
+              for name in ('date_from', 'date_to', 'labels', 'publishers')
+              if getattr(inputs, name) is not None}
+
+    preprocessor = Preprocessor(inputs.preprocessing)
+    token_cache = None
+    if inputs.token_cache:
+        token_cache = TokenCache(inputs.token_cache, preprocessor.fingerprint())
+        if inputs.clear_token_cache:
+            token_cache.clear()
+
+    if inputs.update:
+        store = None
+        if not inputs.walk_articles:
+            store = open_article_store(inputs.article_dir)
+        with profiler.stage('load_labels'):
+            mbfc_labels, _ = load_labels(inputs.data_dir, store=store)
+        documents = load_articles(inputs.article_dir, mbfc_labels,
+                                  max_days=inputs.max_days or None,
+                                  batch_size=inputs.batch_size,
+                                  n_process=inputs.n_process,
+                                  token_cache=token_cache,
+                                  after_date=inputs.after_date,
+                                  articles_per_publisher=(
+                                      inputs.articles_per_publisher or None),
+                                  read_workers=inputs.read_workers,
+                                  preprocessor=preprocessor,
+                                  store=store,
+                                  subset=subset)
+        with profiler.stage('update_model'):
+            update_model(inputs.update[0], inputs.update[1], documents,
+                         inputs.corpus,
+                         output_dir=os.path.dirname(inputs.update[0]) or '.',
+                         passes=inputs.passes,
+                         eval_every=inputs.eval_every,
+                         no_below=inputs.no_below,
+                         keep_n=inputs.keep_n or None)
+        if store is not None:
+            store.close()
+        return
+
     # Step 1) load our label data, form of a tuple of (lables, publisher_data)
-    documents, labels, onehot_enc = load_data(inputs.data_dir, inputs.article_dir)
+    id2word, corpus, labels, onehot_enc, keys = load_data(
+        inputs.data_dir,
+        inputs.article_dir,
+        inputs.corpus,
+        max_days=inputs.max_days or None,
+        batch_size=inputs.batch_size,
+        n_process=inputs.n_process,
+        token_cache=token_cache,
+        after_date=inputs.after_date,
+        profiler=profiler,
+        no_below=inputs.no_below,
+        no_above=inputs.no_above,
+        keep_n=inputs.keep_n or None,
+        phrases=inputs.phrases,
+        phrase_min_count=inputs.phrase_min_count,
+        phrase_threshold=inputs.phrase_threshold,
+        articles_per_publisher=inputs.articles_per_publisher or None,
+        read_workers=inputs.read_workers,
+        preprocessor=preprocessor,
+        use_store=not inputs.walk_articles,
+        subset=subset,
+        validation_fraction=inputs.validation_fraction)
+
+    # hold out the latest days, the models never see them during training
+    validation = None
+    if inputs.validation_fraction:
+        try:
+            train_ids, validation_ids, validation_dates = split_by_date(
+                keys, inputs.validation_fraction)
+        except ValueError as e:
+            print("WARNING: training without a validation set,", e)
+        else:
+            validation = (corpus[validation_ids],
+                          [labels[i] for i in validation_ids],
+                          [keys[i] for i in validation_ids])
+            corpus = corpus[train_ids]
+            labels = [labels[i] for i in train_ids]
+            print("holding out {} documents from {} to {}".format(
+                len(validation_ids), validation_dates[0],
+                validation_dates[-1]))
 
     # Step 2) Train our model
-    model, topic_vector = train_model(documents, onehot_enc, labels)
+    with profiler.stage('train_model', items=len(corpus)):
+        model, topic_vector = train_model(id2word, corpus, onehot_enc, labels,
+                                          engine=inputs.engine,
+                                          workers=inputs.workers,
+                                          eval_every=inputs.eval_every,
+                                          profiler=profiler,
+                                          bundle_dir=inputs.export_bundle,
+                                          bundle_dtype=inputs.bundle_dtype,
+                                          bundle_top_n=inputs.bundle_top_n,
+                                          sparse_threshold=inputs.sparse_topics,
+                                          num_topics=inputs.num_topics,
+                                          passes=inputs.passes or 50,
+                                          classifier=inputs.classifier,
+                                          validation=validation)
 
     # Step 2 TEST STEP, confirm that our prediction is good
-    predict_bias(model, topic_vector, labels)
+    with profiler.stage('predict_bias', items=len(labels)):
+        predict_bias(model, topic_vector, labels)
 
     # Step 3) Extract the words
 
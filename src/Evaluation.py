@@ -0,0 +1,238 @@
+import json
+import numpy as np
+from scipy.optimize import minimize_scalar
+from sklearn.metrics import accuracy_score, confusion_matrix, f1_score, \
+    log_loss, precision_recall_fscore_support
+
+
+def article_date(key):
+    """
+
+    :param key: article key from iter_articles, <date>/<publisher>/<file>
+    :return: the date directory name
+    """
+    return key.replace('\\', '/').split('/', 1)[0]
+
+
+def split_by_date(keys, validation_fraction=0.2):
+    """
+    Hold out the most recent days. Articles of one day share stories
+    across publishers, so splitting inside a day would leak them between
+    training and validation.
+
+    :param keys: article key of every document
+    :param validation_fraction: fraction of the days to hold out, at least
+        one
+    :return: (train positions, validation positions, validation dates)
+    """
+    dates = [article_date(key) for key in keys]
+    unique_dates = sorted(set(dates))
+    if len(unique_dates) < 2:
+        raise ValueError("need articles from at least two days to split "
+                         "by date, got {}".format(len(unique_dates)))
+
+    num_validation = min(len(unique_dates) - 1,
+                         max(1, int(round(len(unique_dates)
+                                          * validation_fraction))))
+    validation_dates = set(unique_dates[-num_validation:])
+    is_validation = np.array([date in validation_dates for date in dates])
+    return (np.flatnonzero(~is_validation), np.flatnonzero(is_validation),
+            sorted(validation_dates))
+
+
+def expected_calibration_error(proba, labels, classes, bins=10):
+    """
+    Gap between the confidence of the predicted class and how often it is
+    right, averaged over equal width confidence bins.
+
+    :param proba: (num_docs, num_classes) predicted probabilities
+    :param labels: true labels
+    :param classes: class of every proba column
+    :param bins: number of confidence bins
+    :return: float
+    """
+    confidence = proba.max(axis=1)
+    correct = np.asarray(classes)[proba.argmax(axis=1)] == np.asarray(labels)
+    bin_ids = np.minimum((confidence * bins).astype(int), bins - 1)
+    counts = np.bincount(bin_ids, minlength=bins)
+    gaps = np.abs(np.bincount(bin_ids, weights=correct, minlength=bins)
+                  - np.bincount(bin_ids, weights=confidence, minlength=bins))
+    return float(gaps.sum() / max(counts.sum(), 1))
+
+
+def known_labels(labels, classes):
+    """
+    Which documents carry a label the classifier was trained on. A label
+    only seen on held out days has no probability column, so the log loss
+    can't score it.
+
+    :param labels: true labels
+    :param classes: classes of a fitted classifier
+    :return: boolean array, True for the known labels
+    """
+    return np.isin(np.asarray(labels), classes)
+
+
+def classification_metrics(classifier, topic_vecs, labels):
+    """
+    Score a classifier with a single batched predict_proba call.
+
+    :param classifier: fitted classifier with predict_proba
+    :param topic_vecs: array or csr_matrix of topic vectors
+    :param labels: true labels
+    :return: dict of overall metrics, per class metrics and the confusion
+        matrix (rows are true classes, columns predicted ones, both in
+        'classes' order). The log loss only covers the documents whose
+        label the classifier knows, see known_labels, and is None if there
+        are none.
+    """
+    classes = classifier.classes_
+    proba = classifier.predict_proba(topic_vecs)
+    pred_labels = classes[proba.argmax(axis=1)]
+    known = known_labels(labels, classes)
+    loss = None
+    if known.any():
+        loss = round(float(log_loss(np.asarray(labels)[known], proba[known],
+                                    labels=classes)), 4)
+
+    precision, recall, f1, support = precision_recall_fscore_support(
+        labels, pred_labels, labels=classes, zero_division=0)
+    return {'documents': len(labels),
+            'accuracy': round(float(accuracy_score(labels, pred_labels)), 4),
+            'f1_weighted': round(float(f1_score(labels, pred_labels,
+                                                average='weighted')), 4),
+            'f1_macro': round(float(f1_score(labels, pred_labels,
+                                             average='macro')), 4),
+            'log_loss': loss,
+            'unknown_label_documents': int((~known).sum()),
+            'ece': round(expected_calibration_error(proba, labels, classes), 4),
+            'classes': classes.tolist(),
+            'per_class': {str(c): {'precision': round(float(p), 4),
+                                   'recall': round(float(r), 4),
+                                   'f1': round(float(f), 4),
+                                   'support': int(s)}
+                          for c, p, r, f, s in zip(classes, precision, recall,
+                                                   f1, support)},
+            'confusion_matrix': confusion_matrix(labels, pred_labels,
+                                                 labels=classes).tolist()}
+
+
+def calibrate_temperature(classifier, topic_vecs, labels):
+    """
+    Temperature scaling: divide the classifier's coefficients and
+    intercepts by the T that minimizes the log loss on held out data.
+
+    Predicted labels don't change, only how confident predict_proba is.
+    The classifier stays a plain linear model, so it still pickles and
+    exports to a ModelBundle as before.
+
+    :param classifier: fitted linear classifier, changed in place
+    :param topic_vecs: held out topic vectors
+    :param labels: held out labels, documents with labels the classifier
+        doesn't know are left out
+    :return: the temperature, 1.0 if no label is known
+    """
+    coef = classifier.coef_.copy()
+    intercept = classifier.intercept_.copy()
+    classes = classifier.classes_
+    known = np.flatnonzero(known_labels(labels, classes))
+    if not len(known):
+        return 1.0
+    topic_vecs = topic_vecs[known]
+    labels = np.asarray(labels)[known]
+
+    def scaled_log_loss(log_temperature):
+        temperature = np.exp(log_temperature)
+        classifier.coef_ = coef / temperature
+        classifier.intercept_ = intercept / temperature
+        return log_loss(labels, classifier.predict_proba(topic_vecs),
+                        labels=classes)
+
+    best = minimize_scalar(scaled_log_loss, bounds=(-4.0, 4.0),
+                           method='bounded')
+    temperature = float(np.exp(best.x))
+    classifier.coef_ = coef / temperature
+    classifier.intercept_ = intercept / temperature
+    return temperature
+
+
+def evaluate_model(classifier, train_vecs, train_labels, validation_vecs,
+                   validation_labels, validation_keys, calibrate=True,
+                   calibration_fraction=0.5):
+    """
+    Training and validation metrics, optionally calibrating the classifier
+    in between.
+
+    The temperature is fitted on the earlier held out days and the
+    validation metrics only cover the later ones, so they stay an estimate
+    on days neither the models nor the calibration have seen. Calibration
+    is skipped if the held out documents come from a single day.
+
+    :param classifier: fitted classifier, recalibrated in place
+    :param train_vecs: topic vectors the classifier was trained on
+    :param train_labels: their labels
+    :param validation_vecs: held out topic vectors
+    :param validation_labels: their labels
+    :param validation_keys: their article keys, for their dates
+    :param calibrate: fit a temperature on the earlier held out days
+    :param calibration_fraction: fraction of the held out days, the later
+        ones, to report on when calibrating
+    :return: report dict
+    """
+    report = {'train': classification_metrics(classifier, train_vecs,
+                                              train_labels)}
+    report_ids = np.arange(len(validation_labels))
+    if calibrate:
+        try:
+            calibration_ids, report_ids, _ = split_by_date(
+                validation_keys, calibration_fraction)
+        except ValueError as e:
+            report['calibration'] = {'method': None, 'skipped': str(e)}
+        else:
+            report_vecs = validation_vecs[report_ids]
+            report_labels = [validation_labels[i] for i in report_ids]
+            uncalibrated = classification_metrics(classifier, report_vecs,
+                                                  report_labels)
+            temperature = calibrate_temperature(
+                classifier, validation_vecs[calibration_ids],
+                [validation_labels[i] for i in calibration_ids])
+            report['calibration'] = {
+                'method': 'temperature',
+                'temperature': round(temperature, 4),
+                'documents': len(calibration_ids),
+                'dates': sorted({article_date(validation_keys[i])
+                                 for i in calibration_ids}),
+                'log_loss_before': uncalibrated['log_loss'],
+                'ece_before': uncalibrated['ece']}
+    report['validation'] = classification_metrics(
+        classifier, validation_vecs[report_ids],
+        [validation_labels[i] for i in report_ids])
+    report['validation_dates'] = sorted({article_date(validation_keys[i])
+                                         for i in report_ids})
+    return report
+
+
+def write_evaluation(path, report):
+    """
+    Write an evaluation report as JSON.
+
+    :param path: output file
+    :param report: dict from evaluate_model
+    :return:
+    """
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("wrote evaluation report to", path)
+
+
+def summary_line(metrics):
+    """
+
+    :param metrics: dict from classification_metrics
+    :return: one line summary for the console
+    """
+    return "{} documents, accuracy {:.4f}, weighted f1 {:.4f}, " \
+           "log loss {}".format(metrics['documents'], metrics['accuracy'],
+                                metrics['f1_weighted'],
+                                '-' if metrics['log_loss'] is None
+                                else '{:.4f}'.format(metrics['log_loss']))
@@ -1,70 +1,480 @@
-from gensim.models.ldamodel import LdaModel
 import argparse
-import spacy
+import json
 import numpy as np
 import pickle
-from nltk.util import ngrams
+from Profiling import StageProfiler, NO_PROFILER
+from PredictionCache import text_key
+from PhraseModel import PhraseModel
+from Preprocessing import BACKENDS, Preprocessor
 
 
-STOPWORDS = {
-    'say', 'not', 'like', 'go', "be", "have", "s", #original
-    "and", "when", "where", "who", "let", "look", "time", "use", "him", "her",
-    "she", "he"
-}
+class TopicTermIndex:
+    """
+    Precomputed answers to the two per-request LdaModel lookups in
+    get_json_prediction_output:
+
+        lda_model.get_term_topics(word_id) -> term_topics(word_id)
+        lda_model.get_topic_terms(topic, topn) -> topic_terms(topic)
+
+    Both gensim calls scan the full topic-word matrix every time. Here the
+    term -> topics table is kept in CSR form (term_topic_ptr /
+    term_topic_ids) and the top terms of every topic are stored up front,
+    so both lookups are array slices.
+    """
+
+    def __init__(self, lda_model, topn=20):
+        """
+
+        :param lda_model: trained LdaModel
+        :param topn: number of top terms kept per topic
+        """
+        self.topn = topn
+        expElogbeta = lda_model.expElogbeta
+        num_terms = expElogbeta.shape[1]
+
+        # get_term_topics keeps every topic whose expElogbeta reaches the
+        # model's minimum probability, in topic order. np.nonzero on the
+        # transposed mask gives exactly that order, grouped by term.
+        minimum_probability = max(lda_model.minimum_probability, 1e-8)
+        word_ids, topic_ids = np.nonzero(expElogbeta.T >= minimum_probability)
+        self.term_topic_ids = topic_ids.astype(np.int32)
+        self.term_topic_ptr = np.zeros(num_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(word_ids, minlength=num_terms),
+                  out=self.term_topic_ptr[1:])
 
-def preprocess_text(nlp, input_raw_text):
-    text = input_raw_text.replace("\n", " ")
+        # same partial sort as gensim's matutils.argsort, for all topics at
+        # once, so ties come out in the same order as get_topic_terms
+        neg_topics = -lda_model.get_topics()
+        if topn >= num_terms:
+            top_ids = np.argsort(neg_topics, axis=1)[:, :topn]
+        else:
+            top_ids = np.argpartition(neg_topics, topn, axis=1)[:, :topn]
+            order = np.argsort(np.take_along_axis(neg_topics, top_ids, axis=1),
+                               axis=1)
+            top_ids = np.take_along_axis(top_ids, order, axis=1)
+        self.topic_term_ids = top_ids
+        self._topic_terms = [[lda_model.id2word[term_id] for term_id in row]
+                             for row in top_ids.tolist()]
 
-    # # preprocessing text
-    lem_text = [token.lemma_.lower() for token in nlp(text)
-                if not token.is_stop
-                and not token.is_punct
-                and not token.is_space
-                and not token.lemma_.lower() in STOPWORDS
-                and not token.pos_ == 'SYM'
-                and not token.pos_ == 'NUM']
+    def term_topics(self, word_id):
+        """
 
-    lem_text += ["_".join(w) for w in ngrams(lem_text, 2)]
+        :param word_id: id of a term in the model's dictionary
+        :return: list of topic ids the term is relevant to
+        """
+        return self.term_topic_ids[self.term_topic_ptr[word_id]:
+                                   self.term_topic_ptr[word_id + 1]].tolist()
+
+    def topic_terms(self, topic_id):
+        """
+
+        :param topic_id: topic id
+        :return: list of the topic's topn most probable terms
+        """
+        return list(self._topic_terms[topic_id])
+
+def preprocess_text(nlp, input_raw_text, phrases=None):
+    lem_text = nlp(input_raw_text)
+
+    # join the phrases the model was trained with, see PhraseModel
+    if phrases is not None:
+        lem_text = phrases.apply(lem_text)
 
     return lem_text
 
-def get_json_prediction_output(nlp, lda_model, classifier_model, input_raw_text):
+def preprocess_texts(nlp, input_raw_texts, batch_size=64, phrases=None):
+    """
+    Streaming version of preprocess_text, runs the texts through spacy in
+    batches.
+
+    :param nlp: Preprocessor
+    :param input_raw_texts: iterable of raw texts
+    :param batch_size: number of texts spacy parses per batch
+    :param phrases: PhraseModel of the LDA model's dictionary, if it has one
+    :return: generator of token lists, in input order
+    """
+    for lem_text in nlp.pipe(input_raw_texts, batch_size=batch_size):
+        if phrases is not None:
+            lem_text = phrases.apply(lem_text)
+        yield lem_text
+
+def infer_topic_matrix(lda_model, corpus):
+    """
+    Topic distribution of every document in corpus, inferred in one call.
+
+    Row i is what lda_model.get_document_topics(corpus[i],
+    minimum_probability=0) returns, as a dense vector.
+
+    :param lda_model: trained LdaModel
+    :param corpus: list of bag of words documents
+    :return: (len(corpus), num_topics) numpy array
+    """
+    gamma, _ = lda_model.inference(corpus)
+    return gamma / gamma.sum(axis=1)[:, np.newaxis]
+
+def predict_labels(classifier_model, topic_matrix):
+    """
+    Classify every row of topic_matrix in a single call.
+
+    :param classifier_model: fitted sklearn classifier
+    :param topic_matrix: (num_docs, num_topics) array
+    :return: (labels, probabilities) where probabilities is None if the
+        classifier doesn't support predict_proba
+    """
+    if hasattr(classifier_model, 'predict_proba'):
+        proba = classifier_model.predict_proba(topic_matrix)
+        return classifier_model.classes_[proba.argmax(axis=1)], proba
+
+    return classifier_model.predict(topic_matrix), None
+
+def get_json_prediction_output_batch(nlp, lda_model, classifier_model,
+                                     input_raw_texts, batch_size=64,
+                                     topic_index=None, profiler=NO_PROFILER,
+                                     cache=None, explanation=None):
+    """
+    Batch version of get_json_prediction_output: one spacy stream, one topic
+    inference call and one classifier call for all of input_raw_texts.
+
+    :param nlp: Preprocessor, see load_models
+    :param lda_model: trained LdaModel, or a ModelBundle
+    :param classifier_model: fitted classifier
+    :param input_raw_texts: iterable of raw texts
+    :param batch_size: number of texts spacy parses per batch
+    :param topic_index: TopicTermIndex of lda_model, built on the fly if
+        not given. Long running callers should build it once.
+    :param profiler: StageProfiler to record the individual steps in
+    :param cache: PredictionCache for the models and explanation given.
+        Only the texts missing from it are scored, each distinct text once.
+    :param explanation: TopKExplanation for bounded output, None for the
+        full output of explain_predictions
+    :return: list with one output dict per text, in input order
+    """
+    if cache is not None:
+        return cached_prediction_outputs(nlp, lda_model, classifier_model,
+                                         input_raw_texts, cache,
+                                         batch_size=batch_size,
+                                         topic_index=topic_index,
+                                         profiler=profiler,
+                                         explanation=explanation)
+
+    with profiler.stage('preprocess') as stage:
+        phrases = PhraseModel.for_vocabulary(lda_model.id2word)
+        documents = list(preprocess_texts(nlp, input_raw_texts, batch_size,
+                                          phrases=phrases))
+        stage['items'] = len(documents)
+    if not documents:
+        return []
+
+    with profiler.stage('doc2bow', items=len(documents)):
+        corpus = [lda_model.id2word.doc2bow(doc) for doc in documents]
+
+    if topic_index is None:
+        with profiler.stage('topic_index'):
+            topic_index = TopicTermIndex(lda_model)
+
+    with profiler.stage('topic_inference', items=len(corpus)):
+        topic_matrix = infer_topic_matrix(lda_model, corpus)
+    with profiler.stage('classify', items=len(corpus)):
+        pred_labels, pred_proba = predict_labels(classifier_model, topic_matrix)
+
+    with profiler.stage('explain', items=len(corpus)):
+        explain = explain_predictions if explanation is None \
+            else explanation.explain
+        outputs = explain(lda_model, classifier_model, topic_index, corpus,
+                          topic_matrix, pred_labels, pred_proba)
+
+    return outputs
+
+def cached_prediction_outputs(nlp, lda_model, classifier_model,
+                              input_raw_texts, cache, batch_size=64,
+                              topic_index=None, profiler=NO_PROFILER,
+                              explanation=None):
+    """
+    get_json_prediction_output_batch through a PredictionCache.
 
-    pp_text = preprocess_text(nlp, input_raw_text)
+    Fresh outputs are returned the way a cache hit would return them,
+    decoded from their JSON, so the output doesn't depend on the cache
+    state and repeated texts don't share one dict.
+    """
+    input_raw_texts = list(input_raw_texts)
+    with profiler.stage('cache_lookup') as stage:
+        keys = [text_key(text) for text in input_raw_texts]
+        outputs = [cache.get(key) for key in keys]
+        stage['items'] = len(keys)
 
-    documents = [pp_text]
+    # first position of every distinct text that missed
+    missing = {}
+    for i, output in enumerate(outputs):
+        if output is None and keys[i] not in missing:
+            missing[keys[i]] = i
+    if missing:
+        scored = get_json_prediction_output_batch(
+            nlp, lda_model, classifier_model,
+            [input_raw_texts[i] for i in missing.values()],
+            batch_size=batch_size, topic_index=topic_index, profiler=profiler,
+            explanation=explanation)
+        serialized = cache.put_many(zip(missing, scored))
+        outputs = [json.loads(serialized[key]) if output is None else output
+                   for key, output in zip(keys, outputs)]
 
-    corpus = [lda_model.id2word.doc2bow(doc) for doc in documents]
-    topic_vecs = []
-    output_overall_topics = []
-    output_word_topics = []
-    relevant_topic_details = []
-    for doc_as_corpus in corpus:
-        top_topics = lda_model.get_document_topics(doc_as_corpus,
-                                             minimum_probability=0)
-        topic_vec = [top_topics[i][1] for i in range(lda_model.num_topics)]
-        topic_vecs.append(topic_vec)
+    return outputs
 
-        relevant_topics = lda_model.get_document_topics(doc_as_corpus)
-        output_overall_topics.append([topic[0] for topic in relevant_topics])
-        for topic in relevant_topics:
-            top_term_ids = lda_model.get_topic_terms(topic[0], topn=20)
-            top_terms = [lda_model.id2word[tup[0]] for tup in top_term_ids]
-            relevant_topic_details.append((topic[0], top_terms))
+def explain_predictions(lda_model, classifier_model, topic_index, corpus,
+                        topic_matrix, pred_labels, pred_proba):
+    """
+    Build the output dicts of get_json_prediction_output_batch from its
+    intermediate results.
+    """
+    # same cut off get_document_topics uses for the relevant topics
+    minimum_probability = max(lda_model.minimum_probability, 1e-8)
+
+    outputs = []
+    for i, doc_as_corpus in enumerate(corpus):
+        output_word_topics = []
+        relevant_topic_details = []
+
+        relevant_topics = np.flatnonzero(topic_matrix[i] >= minimum_probability)
+        output_overall_topics = [[int(topic) for topic in relevant_topics]]
+        for topic in output_overall_topics[0]:
+            relevant_topic_details.append((topic,
+                                           topic_index.topic_terms(topic)))
 
         for word_tuple in doc_as_corpus:
-            word_topics = lda_model.get_term_topics(word_tuple[0])
+            word_topics = topic_index.term_topics(word_tuple[0])
             if word_topics:
-                output_word_topics.append((lda_model.id2word[word_tuple[0]], [wt[0] for wt in word_topics]))
+                output_word_topics.append((lda_model.id2word[word_tuple[0]], word_topics))
+
+        output_dict = {'pred_label': pred_labels[i],
+                       'overall_doc_topics': output_overall_topics,
+                       'relevant_topic_terms': relevant_topic_details,
+                       'per_word_topics': output_word_topics}
+        if pred_proba is not None:
+            output_dict['pred_proba'] = dict(zip(classifier_model.classes_,
+                                                 pred_proba[i].tolist()))
+        outputs.append(output_dict)
 
-    output_pred_label = classifier_model.predict(topic_vecs)[0]
+    return outputs
+
+def label_weights(classifier_model, label):
+    """
+    How much each topic speaks for label in a linear classifier.
+
+    :param classifier_model: fitted linear classifier (coef_, classes_)
+    :param label: one of its classes
+    :return: (num_topics,) array
+    """
+    coef = np.asarray(classifier_model.coef_, dtype=np.float64)
+    classes = list(classifier_model.classes_)
+    if coef.shape[0] == 1:
+        # binary: the single row scores classes_[1] against classes_[0]
+        return coef[0] if label == classes[1] else -coef[0]
+    row = classes.index(label)
+    # the probabilities only depend on how the class scores differ
+    return coef[row] - np.delete(coef, row, axis=0).mean(axis=0)
+
+def group_words_by_topic(per_word_topics, topic_ids=None):
+    """
+    Invert per_word_topics in one pass.
+
+    :param per_word_topics: list of (word, [topic ids])
+    :param topic_ids: only group these topics, all of them if None
+    :return: {topic id: [words]}, words in per_word_topics order
+    """
+    if topic_ids is None:
+        groups = {}
+        for word, word_topics in per_word_topics:
+            for topic in word_topics:
+                groups.setdefault(topic, []).append(word)
+        return groups
+
+    groups = {topic: [] for topic in topic_ids}
+    for word, word_topics in per_word_topics:
+        for topic in word_topics:
+            words = groups.get(topic)
+            if words is not None:
+                words.append(word)
+    return groups
+
+class TopKExplanation:
+    """
+    Bounded explanation mode for get_json_prediction_output_batch, for
+    callers that only highlight a few things per article. The default
+    output lists all 20 terms of every relevant topic and the topics of
+    every vocabulary hit, so it grows with the length of the text. This
+    one is capped:
+
+        overall_doc_topics    the top_topics most probable topics
+        relevant_topic_terms  top_words terms of each of those topics
+        topic_words           the top_words article words of each of those
+                              topics, by how much of the topic they make up
+        word_contributions    max_words (word, score) pairs with the largest
+                              contribution to the predicted label's score
+        per_word_topics       for each of those words, the top_topics
+                              topics most of its counts went to
+        truncated             how many topics and words there were in all
+
+    A word's contribution is the part of the classifier score w . theta
+    that comes from its counts: its counts are spread over the topics by
+    p(topic | word, document) ~ theta_k * beta_kw, the per-word update of
+    the E-step, and weighted with the classifier's weights for the
+    predicted label (see label_weights). The contributions add up to the
+    score, up to the Dirichlet prior's share of theta.
+    """
 
-    output_dict = {'pred_label': output_pred_label,
-                   'overall_doc_topics': output_overall_topics,
-                   'relevant_topic_terms': relevant_topic_details,
-                   'per_word_topics': output_word_topics}
+    def __init__(self, top_topics=3, top_words=5, max_words=25):
+        """
 
-    return output_dict
+        :param top_topics: most topics returned
+        :param top_words: most terms and article words returned per topic
+        :param max_words: most word contributions returned
+        """
+        self.top_topics = top_topics
+        self.top_words = top_words
+        self.max_words = max_words
+
+    def settings(self):
+        """
+
+        :return: string identifying the output format, for the cache
+            version
+        """
+        return 'topk:{}:{}:{}'.format(self.top_topics, self.top_words,
+                                      self.max_words)
+
+    def explain(self, lda_model, classifier_model, topic_index, corpus,
+                topic_matrix, pred_labels, pred_proba):
+        """
+        Same arguments and output list as explain_predictions.
+        """
+        minimum_probability = max(lda_model.minimum_probability, 1e-8)
+        expElogbeta = lda_model.expElogbeta
+        id2word = lda_model.id2word
+
+        outputs = []
+        for i, doc_as_corpus in enumerate(corpus):
+            theta = topic_matrix[i]
+            relevant_topics = np.flatnonzero(theta >= minimum_probability)
+            top = relevant_topics[np.argsort(-theta[relevant_topics],
+                                             kind='stable')]
+            top = top[:self.top_topics].tolist()
+
+            output_dict = {'pred_label': pred_labels[i],
+                           'overall_doc_topics': [top],
+                           'relevant_topic_terms':
+                               [(topic, topic_index.topic_terms(topic)
+                                 [:self.top_words]) for topic in top],
+                           'topic_words': [(topic, []) for topic in top],
+                           'word_contributions': [],
+                           'per_word_topics': [],
+                           'truncated': {'topics': len(relevant_topics),
+                                         'words': len(doc_as_corpus)}}
+            if pred_proba is not None:
+                output_dict['pred_proba'] = dict(zip(
+                    classifier_model.classes_, pred_proba[i].tolist()))
+            outputs.append(output_dict)
+            if not doc_as_corpus:
+                continue
+
+            ids, cts = (np.array(column) for column in zip(*doc_as_corpus))
+            words = [id2word[word_id] for word_id in ids.tolist()]
+            # (num_words, num_topics) share of every word's counts per topic
+            word_topics = np.asarray(expElogbeta[:, ids],
+                                     dtype=np.float64).T * theta
+            word_topics *= (cts / np.maximum(word_topics.sum(axis=1),
+                                             1e-100))[:, np.newaxis]
+
+            contributions = word_topics @ label_weights(classifier_model,
+                                                        pred_labels[i])
+            contributions /= cts.sum()
+            strongest = np.argsort(-np.abs(contributions),
+                                   kind='stable')[:self.max_words]
+            output_dict['word_contributions'] = [
+                (words[j], round(float(contributions[j]), 6))
+                for j in strongest.tolist()]
+
+            # the article words making up most of each top topic, by their
+            # share of it; words with no share of a topic are left out
+            output_dict['topic_words'] = []
+            for topic in top:
+                shares = word_topics[:, topic]
+                best = np.argsort(-shares, kind='stable')[:self.top_words]
+                output_dict['topic_words'].append(
+                    (topic, [words[j] for j in best.tolist()
+                             if shares[j] > 0]))
+
+            # the topics each shown word's counts went to the most
+            output_dict['per_word_topics'] = []
+            for j in strongest.tolist():
+                shares = word_topics[j]
+                best = np.argsort(-shares, kind='stable')[:self.top_topics]
+                output_dict['per_word_topics'].append(
+                    (words[j], [int(topic) for topic in best.tolist()
+                                if shares[topic] > 0]))
+
+        return outputs
+
+def get_json_prediction_output(nlp, lda_model, classifier_model, input_raw_text,
+                               topic_index=None, profiler=NO_PROFILER,
+                               cache=None, explanation=None):
+
+    return get_json_prediction_output_batch(nlp, lda_model, classifier_model,
+                                            [input_raw_text],
+                                            topic_index=topic_index,
+                                            profiler=profiler,
+                                            cache=cache,
+                                            explanation=explanation)[0]
+
+def load_models(lda_model_path, classifier_model_path, preprocessing='spacy'):
+    """
+    Load everything get_json_prediction_output needs. This is the slow part
+    of a prediction, so long running callers should only do it once.
+
+    :param lda_model_path: saved LdaModel file
+    :param classifier_model_path: pickled classifier file
+    :param preprocessing: Preprocessor backend, see Preprocessing.BACKENDS
+    :return: (nlp, lda_model, classifier_model, topic_index) where nlp is
+        the Preprocessor
+    """
+    from gensim.models.ldamodel import LdaModel
+
+    print("loading LDA model")
+    lda = LdaModel.load(lda_model_path)
+    topic_index = TopicTermIndex(lda)
+    print("finished loading lda model")
+
+    print("loading logistic regression model")
+    with open(classifier_model_path, 'rb') as f:
+        classifier = pickle.load(f)
+    print("finished logistic regression model")
+
+    print("loading spacy")
+    nlp = Preprocessor(preprocessing).load()
+    print("finished loading spacy")
+
+    return nlp, lda, classifier, topic_index
+
+def load_bundle_models(bundle_dir, preprocessing='spacy'):
+    """
+    Same as load_models, but serves from a bundle written by export_bundle:
+    topic inference runs on the numpy engine and neither gensim nor sklearn
+    is imported.
+
+    :param bundle_dir: model bundle directory
+    :param preprocessing: see load_models
+    :return: (nlp, bundle, bundle.classifier, bundle), the bundle stands in
+        for the LDA model and the topic index
+    """
+    from ModelBundle import ModelBundle
+
+    print("loading model bundle")
+    bundle = ModelBundle(bundle_dir)
+    print("finished loading model bundle")
+
+    print("loading spacy")
+    nlp = Preprocessor(preprocessing).load()
+    print("finished loading spacy")
+
+    return nlp, bundle, bundle.classifier, bundle
 
 def main():
 
@@ -72,28 +482,72 @@ def main():
 
     parser.add_argument("lda_model",
                         type=str,
+                        nargs='?',
                         help=("The LDA model file to load"))
 
     parser.add_argument("classifier_model",
                         type=str,
+                        nargs='?',
                         help=("The classifier model file to load"))
 
+    parser.add_argument("--bundle",
+                        type=str,
+                        default=None,
+                        help=("Load a model bundle directory instead of the "
+                              "two model files and use the numpy inference "
+                              "engine."))
 
-    inputs = parser.parse_args()
+    parser.add_argument("--preprocessing",
+                        choices=BACKENDS,
+                        default='spacy',
+                        help=("Tokenizer backend, see Preprocessing.py."))
 
-    print("loading LDA model")
-    lda = LdaModel.load(inputs.lda_model)
-    id2word = lda.id2word
-    print("finished loading lda model")
+    parser.add_argument("--top-topics",
+                        type=int,
+                        default=None,
+                        help=("Only explain this many topics, with "
+                              "--top-words words each and per word "
+                              "contributions to the label, see "
+                              "TopKExplanation."))
 
-    print("loading logistic regression model")
-    with open(inputs.classifier_model, 'rb') as f:
-        classifier = pickle.load(f)
-    print("finished logistic regression model")
+    parser.add_argument("--top-words",
+                        type=int,
+                        default=5,
+                        help=("Terms and article words shown per topic "
+                              "with --top-topics."))
 
-    print("loading spacy")
-    nlp = spacy.load('en_core_web_md')
-    print("finished loading spacy")
+    parser.add_argument("--max-words",
+                        type=int,
+                        default=25,
+                        help=("Word contributions shown with "
+                              "--top-topics."))
+
+    parser.add_argument("--profile-report",
+                        type=str,
+                        default=None,
+                        help=("Write the time spent loading the models and "
+                              "in every prediction step to this JSON file."))
+
+    parser.add_argument("--cprofile-dir",
+                        type=str,
+                        default=None,
+                        help=("Also run every top level stage under "
+                              "cProfile and dump the stats here."))
+
+    inputs = parser.parse_args()
+    if not inputs.bundle and not (inputs.lda_model and inputs.classifier_model):
+        parser.error("give either both model files or --bundle")
+
+    profiler = StageProfiler(cprofile_dir=inputs.cprofile_dir)
+
+    with profiler.stage('load_models'):
+        if inputs.bundle:
+            nlp, lda, classifier, topic_index = load_bundle_models(
+                inputs.bundle, preprocessing=inputs.preprocessing)
+        else:
+            nlp, lda, classifier, topic_index = load_models(
+                inputs.lda_model, inputs.classifier_model,
+                preprocessing=inputs.preprocessing)
 
     DUMMY_TEXT = """
     Russia has appointed the US actor Steven Seagal as a special envoy to improve ties with the United States.
@@ -106,7 +560,14 @@ def main():
     Seagal was also granted Serbian citizenship in 2016, following several visits to the Balkan country.
     """
 
-    pred_output_res = get_json_prediction_output(nlp=nlp, lda_model=lda, classifier_model=classifier, input_raw_text=DUMMY_TEXT)
+    explanation = None
+    if inputs.top_topics:
+        explanation = TopKExplanation(top_topics=inputs.top_topics,
+                                      top_words=inputs.top_words,
+                                      max_words=inputs.max_words)
+
+    with profiler.stage('get_json_prediction_output', items=1):
+        pred_output_res = get_json_prediction_output(nlp=nlp, lda_model=lda, classifier_model=classifier, input_raw_text=DUMMY_TEXT, topic_index=topic_index, profiler=profiler, explanation=explanation)
 
     ### example usage below
     print("----------")
@@ -119,14 +580,23 @@ def main():
         topic_ids.append(terms[0])
     print("---")
     print("words matching topics in input text: ---")
+    if 'topic_words' in pred_output_res:
+        words_by_topic = dict(pred_output_res['topic_words'])
+    else:
+        words_by_topic = group_words_by_topic(
+            pred_output_res['per_word_topics'], topic_ids)
     for id in topic_ids:
-        relevant_words = []
-        for word_topic in pred_output_res['per_word_topics']:
-            if id in word_topic[1]:
-                relevant_words.append(word_topic[0])
-        print(id, ':', relevant_words)
+        print(id, ':', words_by_topic.get(id, []))
     print("---")
+    if 'word_contributions' in pred_output_res:
+        print("words for and against the prediction: ---")
+        for word, contribution in pred_output_res['word_contributions']:
+            print("{:>+.4f} {}".format(contribution, word))
+        print("---")
+
+    if inputs.profile_report:
+        profiler.write_report(inputs.profile_report)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
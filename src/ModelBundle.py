@@ -0,0 +1,544 @@
+from pathlib import Path
+import argparse
+import itertools
+import json
+import tempfile
+import time
+import numpy as np
+from NumpyInference import SparseTermWeights, TopicInferencer, \
+    quantize_topic_words
+from PhraseModel import PhraseModel
+
+# Bump this whenever the layout of the bundle changes.
+BUNDLE_FORMAT_VERSION = 2
+# Older layouts ModelBundle can still load. Version 1 bundles are version 2
+# ones with full precision, dense topic-word weights.
+SUPPORTED_FORMATS = (1, 2)
+
+# dtypes the topic-word weights and classifier coefficients can be stored in
+BUNDLE_DTYPES = ('float32', 'float16')
+
+# Least share of labels a float16 or top_n bundle should predict the same as
+# the full precision export, see check_reduced_bundle
+MIN_LABEL_AGREEMENT = 0.99
+
+
+class LinearClassifier:
+    """
+    Logistic regression rebuilt from its exported coefficients. Implements
+    the part of the sklearn API the prediction code uses (classes_,
+    decision_function, predict_proba, predict) without needing sklearn.
+    """
+
+    def __init__(self, coef, intercept, classes, multi_class):
+        """
+
+        :param coef: (num_classes, num_features) array, (1, num_features)
+            for binary problems
+        :param intercept: (num_classes,) array, (1,) for binary problems
+        :param classes: array of class labels
+        :param multi_class: 'multinomial' or 'ovr', how probabilities of
+            more than two classes are computed
+        """
+        self.coef_ = coef
+        self.intercept_ = intercept
+        self.classes_ = np.asarray(classes)
+        self.multi_class = multi_class
+
+    def decision_function(self, X):
+        scores = np.asarray(X) @ self.coef_.T + self.intercept_
+        if scores.shape[1] == 1:
+            return scores[:, 0]
+        return scores
+
+    def predict_proba(self, X):
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            positive = 1.0 / (1.0 + np.exp(-scores))
+            return np.column_stack([1.0 - positive, positive])
+
+        if self.multi_class == 'ovr':
+            proba = 1.0 / (1.0 + np.exp(-scores))
+        else:
+            proba = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return proba / proba.sum(axis=1, keepdims=True)
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            return self.classes_[(scores > 0).astype(int)]
+        return self.classes_[scores.argmax(axis=1)]
+
+
+def classifier_multi_class(classifier):
+    """
+    How a fitted linear classifier turns scores into probabilities for more
+    than two classes.
+
+    :param classifier: fitted sklearn LogisticRegression or SGDClassifier
+    :return: 'multinomial' or 'ovr'
+    """
+    if not hasattr(classifier, 'solver'):
+        # SGDClassifier always trains one-vs-rest
+        return 'ovr'
+    multi_class = getattr(classifier, 'multi_class', 'auto')
+    if multi_class == 'ovr' or classifier.solver == 'liblinear':
+        return 'ovr'
+    return 'multinomial'
+
+
+class Vocabulary:
+    """
+    Read only stand in for a gensim Dictionary: id -> token lookups and
+    doc2bow.
+    """
+
+    def __init__(self, tokens, phrasegrams=None):
+        """
+
+        :param tokens: list of tokens, the index is the term id
+        :param phrasegrams: phrases joined before lookup, see PhraseModel
+        """
+        self.tokens = tokens
+        self.token2id = {token: i for i, token in enumerate(tokens)}
+        self.phrasegrams = phrasegrams
+
+    def __getitem__(self, term_id):
+        return self.tokens[term_id]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def doc2bow(self, document):
+        """
+        Same as gensim's Dictionary.doc2bow without allow_update.
+
+        :param document: list of tokens
+        :return: list of (term id, count), sorted by term id
+        """
+        counts = {}
+        token2id = self.token2id
+        for token in document:
+            term_id = token2id.get(token)
+            if term_id is not None:
+                counts[term_id] = counts.get(term_id, 0) + 1
+        return sorted(counts.items())
+
+
+class ModelBundle:
+    """
+    Everything needed at inference time, loaded from the directory written
+    by export_bundle:
+
+        meta.json           - sizes, LDA settings, classifier classes
+        expElogbeta.npy     - (num_topics, num_terms) topic-word weights,
+                              stored term-major, or instead
+        term_weight_ids.npy - (num_terms, top_n) topics and weights of the
+        term_weights.npy      top_n topics of every term, see
+                              SparseTermWeights
+        alpha.npy           - (num_topics,) document-topic prior
+        term_topic_ptr.npy  - term -> topics table in CSR form, see
+        term_topic_ids.npy    TopicTermIndex
+        topic_term_ids.npy  - (num_topics, topn) most probable terms per topic
+        vocab.txt           - one term per line, line number is the term id
+        phrases.json        - optional, phrases of the vocabulary, see
+                              PhraseModel
+        coef.npy            - classifier coefficients
+        intercept.npy       - classifier intercepts
+
+    The arrays are memory mapped, so loading is close to free and every
+    process serving from the same bundle shares one copy in the page cache.
+    The topic-word weights and classifier coefficients can be stored in
+    float16 and the weights cut down to the top topics of every term
+    (meta dtype and top_n), see export_bundle. They are widened to float32
+    for the arithmetic.
+
+    The bundle also stands in for the LdaModel itself (id2word, inference,
+    see NumpyInference) and for its TopicTermIndex (term_topics,
+    topic_terms), so it can be handed to get_json_prediction_output_batch
+    without gensim or sklearn installed.
+    """
+
+    def __init__(self, bundle_dir, mmap=True):
+        """
+
+        :param bundle_dir: directory written by export_bundle
+        :param mmap: memory map the arrays instead of reading them in
+        """
+        self.bundle_dir = Path(bundle_dir)
+        with (self.bundle_dir / 'meta.json').open() as f:
+            self.meta = json.load(f)
+        if self.meta['format'] not in SUPPORTED_FORMATS:
+            raise ValueError("unsupported bundle format {} in {}".format(
+                self.meta['format'], bundle_dir))
+
+        mmap_mode = 'r' if mmap else None
+        for name in ('alpha', 'term_topic_ptr', 'term_topic_ids',
+                     'topic_term_ids', 'coef', 'intercept'):
+            setattr(self, name, np.load(self.bundle_dir / (name + '.npy'),
+                                        mmap_mode=mmap_mode))
+        if self.meta.get('top_n'):
+            self.expElogbeta = SparseTermWeights(
+                np.load(self.bundle_dir / 'term_weight_ids.npy',
+                        mmap_mode=mmap_mode),
+                np.load(self.bundle_dir / 'term_weights.npy',
+                        mmap_mode=mmap_mode),
+                self.meta['num_topics'])
+        else:
+            self.expElogbeta = np.load(self.bundle_dir / 'expElogbeta.npy',
+                                       mmap_mode=mmap_mode)
+
+        phrasegrams = None
+        if (self.bundle_dir / 'phrases.json').is_file():
+            phrasegrams = PhraseModel.load(
+                self.bundle_dir / 'phrases.json').phrasegrams
+        with (self.bundle_dir / 'vocab.txt').open(encoding='utf-8') as f:
+            self.id2word = Vocabulary(
+                f.read().split('\n')[:self.meta['num_terms']], phrasegrams)
+
+        self.num_topics = self.meta['num_topics']
+        self.num_terms = self.meta['num_terms']
+        self.minimum_probability = self.meta['minimum_probability']
+        # the coefficients are tiny, widening them costs nothing
+        self.classifier = LinearClassifier(np.asarray(self.coef, np.float64),
+                                           np.asarray(self.intercept,
+                                                      np.float64),
+                                           self.meta['classes'],
+                                           self.meta['multi_class'])
+        self.inferencer = TopicInferencer.from_bundle(self)
+
+    def doc2bow(self, document):
+        return self.id2word.doc2bow(document)
+
+    def inference(self, corpus):
+        """
+        Same as LdaModel.inference, computed by the numpy engine.
+
+        :param corpus: list of bag of words documents
+        :return: (gamma, None)
+        """
+        return self.inferencer.inference(corpus)
+
+    def term_topics(self, word_id):
+        return self.term_topic_ids[self.term_topic_ptr[word_id]:
+                                   self.term_topic_ptr[word_id + 1]].tolist()
+
+    def topic_terms(self, topic_id):
+        return [self.id2word[term_id]
+                for term_id in self.topic_term_ids[topic_id].tolist()]
+
+
+def export_bundle(lda_model, classifier_model, bundle_dir, topic_index=None,
+                  dtype=None, top_n=None, check_corpus=None):
+    """
+    Write a trained model pair out as a ModelBundle.
+
+    :param lda_model: trained gensim LdaModel
+    :param classifier_model: fitted sklearn LogisticRegression
+    :param bundle_dir: directory to write to, created if missing
+    :param topic_index: TopicTermIndex of lda_model, built if not given
+    :param dtype: one of BUNDLE_DTYPES to store the topic-word weights and
+        classifier coefficients in, the model's own if None. float16 halves
+        the size, check what it costs with compare_bundles
+    :param top_n: only keep the top_n largest topic weights of every term.
+        Small values can change many predictions, check what it costs with
+        check_corpus
+    :param check_corpus: bag of words documents, e.g. from the training
+        corpus, to check a float16 or top_n bundle against the full
+        precision one on, see check_reduced_bundle
+    :return: bundle_dir as a Path
+    """
+    if topic_index is None:
+        from LoadModelAndPredict import TopicTermIndex
+        topic_index = TopicTermIndex(lda_model)
+
+    bundle_dir = Path(bundle_dir)
+    bundle_dir.mkdir(parents=True, exist_ok=True)
+
+    if top_n is not None and not 0 < top_n < lda_model.num_topics:
+        raise ValueError("top_n must be between 1 and {}, got {}".format(
+            lda_model.num_topics - 1, top_n))
+    weights, term_scaled = quantize_topic_words(lda_model.expElogbeta,
+                                                dtype=dtype, top_n=top_n)
+    coef_dtype = dtype or classifier_model.coef_.dtype
+
+    arrays = {'alpha': lda_model.alpha,
+              'term_topic_ptr': topic_index.term_topic_ptr,
+              'term_topic_ids': topic_index.term_topic_ids,
+              'topic_term_ids': topic_index.topic_term_ids.astype(np.int32),
+              'coef': classifier_model.coef_.astype(coef_dtype),
+              'intercept': classifier_model.intercept_.astype(coef_dtype)}
+    if top_n:
+        arrays.update({'term_weight_ids': weights.topic_ids,
+                       'term_weights': weights.weights})
+    for name, array in arrays.items():
+        np.save(bundle_dir / (name + '.npy'), np.ascontiguousarray(array))
+    if not top_n:
+        # kept term-major (Fortran order), np.load gives it back as is
+        np.save(bundle_dir / 'expElogbeta.npy', weights)
+
+    # a re-export must not leave the other layout's weights behind
+    stale = ('expElogbeta',) if top_n else ('term_weight_ids', 'term_weights')
+    for name in stale:
+        if (bundle_dir / (name + '.npy')).exists():
+            (bundle_dir / (name + '.npy')).unlink()
+
+    id2word = lda_model.id2word
+    with (bundle_dir / 'vocab.txt').open('w', encoding='utf-8') as f:
+        f.write('\n'.join(id2word[term_id] for term_id in range(len(id2word))))
+    phrases = PhraseModel.for_vocabulary(id2word)
+    if phrases is not None:
+        phrases.save(bundle_dir / 'phrases.json')
+    elif (bundle_dir / 'phrases.json').exists():
+        (bundle_dir / 'phrases.json').unlink()
+
+    meta = {'format': BUNDLE_FORMAT_VERSION,
+            'num_topics': int(lda_model.num_topics),
+            'num_terms': int(lda_model.num_terms),
+            'minimum_probability': float(lda_model.minimum_probability),
+            'iterations': int(lda_model.iterations),
+            'gamma_threshold': float(lda_model.gamma_threshold),
+            'topn': int(topic_index.topn),
+            'dtype': str(weights.dtype),
+            'top_n': top_n,
+            'term_scaled': bool(term_scaled),
+            'classes': classifier_model.classes_.tolist(),
+            'multi_class': classifier_multi_class(classifier_model)}
+    with (bundle_dir / 'meta.json').open('w') as f:
+        json.dump(meta, f, indent=2)
+
+    print("exported model bundle to", bundle_dir)
+    if check_corpus is not None and (dtype or top_n):
+        check_reduced_bundle(lda_model, classifier_model, bundle_dir,
+                             check_corpus)
+    return bundle_dir
+
+
+def check_reduced_bundle(lda_model, classifier_model, bundle_dir, corpus,
+                         min_label_agreement=MIN_LABEL_AGREEMENT):
+    """
+    Compare a float16 or top_n bundle against a full precision export of
+    the same models, written to a temporary directory. The results are
+    saved as check.json in the bundle, and a warning is printed if too many
+    labels change.
+
+    :param lda_model: trained gensim LdaModel the bundle was exported from
+    :param classifier_model: classifier the bundle was exported from
+    :param bundle_dir: the reduced bundle
+    :param corpus: list of bag of words documents
+    :param min_label_agreement: warn below this share of unchanged labels
+    :return: dict from compare_bundles
+    """
+    with tempfile.TemporaryDirectory() as reference_dir:
+        export_bundle(lda_model, classifier_model, reference_dir)
+        results = compare_bundles(ModelBundle(reference_dir, mmap=False),
+                                  ModelBundle(bundle_dir), corpus)
+
+    with (Path(bundle_dir) / 'check.json').open('w') as f:
+        json.dump(dict(results, documents=len(corpus)), f, indent=1)
+    print("bundle against full precision on {} documents: label agreement "
+          "{:.4f}, max proba diff {:.5f}".format(
+              len(corpus), results['label_agreement'],
+              results['max_proba_diff']))
+    if results['label_agreement'] < min_label_agreement:
+        print("WARNING: the bundle in {} changes {:.1%} of the predicted "
+              "labels, use a larger top_n or float32".format(
+                  bundle_dir, 1.0 - results['label_agreement']))
+    return results
+
+
+def load_check_corpus(corpus_path, num_docs=500):
+    """
+
+    :param corpus_path: Matrix Market corpus, e.g. training_corpus.mm
+    :param num_docs: documents to take from its start
+    :return: list of bag of words documents
+    """
+    from gensim.corpora import MmCorpus
+
+    return [[(int(term_id), count) for term_id, count in bow]
+            for bow in itertools.islice(MmCorpus(corpus_path), num_docs)]
+
+
+def bundle_size(bundle_dir):
+    """
+
+    :param bundle_dir: bundle directory
+    :return: total size of its files in bytes
+    """
+    return sum(path.stat().st_size for path in Path(bundle_dir).iterdir()
+               if path.is_file())
+
+
+def compare_bundles(reference, bundle, corpus, chunk_size=64):
+    """
+    What a reduced precision or top_n bundle costs against the full
+    precision export of the same model pair: topic and probability
+    differences, label agreement, size and latency.
+
+    Both are inferred from the deterministic start used when serving, so the
+    differences come from the stored weights alone.
+
+    :param reference: ModelBundle exported at full precision
+    :param bundle: ModelBundle of the same models to check
+    :param corpus: list of bag of words documents
+    :param chunk_size: documents per numpy chunk
+    :return: dict of results
+    """
+    from NumpyInference import benchmark
+
+    reference_topics = TopicInferencer.from_bundle(
+        reference, chunk_size=chunk_size).topic_matrix(corpus)
+    topics = TopicInferencer.from_bundle(
+        bundle, chunk_size=chunk_size).topic_matrix(corpus)
+    topic_diff = np.abs(topics - reference_topics).max(axis=1)
+    proba_diff = np.abs(bundle.classifier.predict_proba(topics)
+                        - reference.classifier.predict_proba(
+                            reference_topics))
+
+    results = {}
+    for name, model in (('reference', reference), ('bundle', bundle)):
+        results[name] = {'dtype': model.meta.get('dtype', 'float32'),
+                         'top_n': model.meta.get('top_n'),
+                         'disk_mb': round(bundle_size(model.bundle_dir)
+                                          / 2 ** 20, 2),
+                         'topic_words_mb': round(model.expElogbeta.nbytes
+                                                 / 2 ** 20, 2)}
+        results[name].update(
+            {key: round(value, 4) for key, value in
+             benchmark(model, corpus, chunk_size=chunk_size).items()})
+    results['max_topic_diff'] = float(topic_diff.max())
+    results['mean_topic_diff'] = float(topic_diff.mean())
+    results['max_proba_diff'] = float(proba_diff.max())
+    results['label_agreement'] = float(np.mean(
+        bundle.classifier.predict(topics)
+        == reference.classifier.predict(reference_topics)))
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=("Export a trained model pair as a memory mapped "
+                     "inference bundle, time loading one, or compare a "
+                     "reduced precision bundle against the full one."))
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser(
+        'export', help=("Export an LDA model and classifier as a bundle."))
+    export_parser.add_argument("lda_model",
+                               type=str,
+                               help=("The LDA model file to load"))
+    export_parser.add_argument("classifier_model",
+                               type=str,
+                               help=("The classifier model file to load"))
+    export_parser.add_argument("bundle_dir",
+                               type=str,
+                               help=("Directory to write the bundle to"))
+    export_parser.add_argument("--dtype",
+                               type=str,
+                               choices=BUNDLE_DTYPES,
+                               default=None,
+                               help=("Store the topic-word weights and "
+                                     "classifier coefficients in this dtype, "
+                                     "the model's own by default"))
+    export_parser.add_argument("--top-n",
+                               type=int,
+                               default=None,
+                               help=("Only keep the top N topic weights of "
+                                     "every term. Small values change many "
+                                     "predictions, check with --corpus or "
+                                     "the compare command"))
+    export_parser.add_argument("--corpus",
+                               type=str,
+                               default=None,
+                               help=("Check a --dtype or --top-n bundle "
+                                     "against full precision on the first "
+                                     "documents of this Matrix Market "
+                                     "corpus, e.g. training_corpus.mm"))
+
+    check_parser = subparsers.add_parser(
+        'check', help=("Load a bundle and report how long it took."))
+    check_parser.add_argument("bundle_dir",
+                              type=str,
+                              help=("The bundle directory to load"))
+
+    compare_parser = subparsers.add_parser(
+        'compare', help=("Compare a float16 or top-n bundle against the "
+                         "full precision bundle of the same models."))
+    compare_parser.add_argument("reference_dir",
+                                type=str,
+                                help=("The full precision bundle"))
+    compare_parser.add_argument("bundle_dir",
+                                type=str,
+                                help=("The bundle to check"))
+    compare_parser.add_argument("--corpus",
+                                type=str,
+                                default=None,
+                                help=("Score the documents of this Matrix "
+                                      "Market corpus, e.g. the "
+                                      "training_corpus.mm preprocess_data "
+                                      "wrote, instead of random ones"))
+    compare_parser.add_argument("--docs",
+                                type=int,
+                                default=500,
+                                help=("Number of documents to score"))
+    compare_parser.add_argument("--doc-length",
+                                type=int,
+                                default=300,
+                                help=("Tokens per random document"))
+    compare_parser.add_argument("--output",
+                                type=str,
+                                default=None,
+                                help=("Also write the report to this JSON "
+                                      "file"))
+
+    inputs = parser.parse_args()
+
+    if inputs.command == 'export':
+        from gensim.models.ldamodel import LdaModel
+        import pickle
+
+        lda = LdaModel.load(inputs.lda_model)
+        with open(inputs.classifier_model, 'rb') as f:
+            classifier = pickle.load(f)
+        check_corpus = None
+        if inputs.corpus:
+            check_corpus = load_check_corpus(inputs.corpus)
+        export_bundle(lda, classifier, inputs.bundle_dir,
+                      dtype=inputs.dtype, top_n=inputs.top_n,
+                      check_corpus=check_corpus)
+
+    elif inputs.command == 'check':
+        start = time.perf_counter()
+        bundle = ModelBundle(inputs.bundle_dir)
+        elapsed = time.perf_counter() - start
+        print("loaded bundle with {} topics and {} terms in {:.3f}s".format(
+            bundle.num_topics, bundle.num_terms, elapsed))
+
+    elif inputs.command == 'compare':
+        from NumpyInference import random_corpus
+
+        reference = ModelBundle(inputs.reference_dir)
+        bundle = ModelBundle(inputs.bundle_dir)
+        if inputs.corpus:
+            corpus = load_check_corpus(inputs.corpus, inputs.docs)
+        else:
+            corpus = random_corpus(bundle.num_terms, inputs.docs,
+                                   inputs.doc_length)
+
+        results = compare_bundles(reference, bundle, corpus)
+        for name in ('reference', 'bundle'):
+            print("{:>9}: {}".format(name, results[name]))
+        print("max topic diff {:.5f}, mean topic diff {:.5f}, max proba "
+              "diff {:.5f}, label agreement {:.4f}".format(
+                  results['max_topic_diff'], results['mean_topic_diff'],
+                  results['max_proba_diff'], results['label_agreement']))
+        if inputs.output:
+            with open(inputs.output, 'w') as f:
+                json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
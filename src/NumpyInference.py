@@ -0,0 +1,422 @@
+import argparse
+import time
+import numpy as np
+
+try:
+    from scipy.special import psi
+except ImportError:
+    # the numpy fallback below is slower per call, but needs nothing else
+    psi = None
+
+
+def digamma(x):
+    """
+    Digamma function for positive arguments, numpy only.
+
+    Uses psi(x) = psi(x + 6) - sum(1 / (x + k) for k in 0..5) to move every
+    value to where the asymptotic series is accurate to ~1e-12. Shifting
+    everything, rather than just the small values, avoids masked updates.
+
+    :param x: array of positive values
+    :return: array of psi(x), float64
+    """
+    x = np.array(x, dtype=np.float64)
+    result = -(1.0 / x + 1.0 / (x + 1.0) + 1.0 / (x + 2.0) + 1.0 / (x + 3.0)
+               + 1.0 / (x + 4.0) + 1.0 / (x + 5.0))
+    x += 6.0
+
+    inv = 1.0 / x
+    inv2 = inv * inv
+    result += (np.log(x) - 0.5 * inv
+               - inv2 * (1.0 / 12 - inv2 * (1.0 / 120 - inv2 * (
+                   1.0 / 252 - inv2 * (1.0 / 240 - inv2 / 132)))))
+    return result
+
+
+def dirichlet_expectation(gamma):
+    """
+    E[log theta] for theta ~ Dir(gamma), for every row of gamma.
+
+    :param gamma: (num_docs, num_topics) array
+    :return: array of the same shape and dtype
+    """
+    digamma_fn = psi if psi is not None else digamma
+    result = digamma_fn(gamma) - digamma_fn(gamma.sum(axis=1))[:, np.newaxis]
+    return result.astype(gamma.dtype, copy=False)
+
+
+class SparseTermWeights:
+    """
+    Topic-word weights keeping only the top_n largest topics of every term,
+    stored term-major: (num_terms, top_n) topic ids and weights, so the
+    weights of a term are one contiguous row.
+
+    Indexing it like the dense (num_topics, num_terms) array,
+    weights[:, term_ids], gives those columns back with zeros for the
+    dropped topics, so it can stand in for expElogbeta in TopicInferencer.
+    """
+
+    def __init__(self, topic_ids, weights, num_topics):
+        """
+
+        :param topic_ids: (num_terms, top_n) integer array
+        :param weights: (num_terms, top_n) array, may be memory mapped
+        :param num_topics: number of topics of the model
+        """
+        self.topic_ids = topic_ids
+        self.weights = weights
+        self.num_topics = num_topics
+        self.shape = (num_topics, weights.shape[0])
+        self.dtype = weights.dtype
+
+    @property
+    def nbytes(self):
+        return self.topic_ids.nbytes + self.weights.nbytes
+
+    @classmethod
+    def from_dense(cls, expElogbeta, top_n, dtype=None):
+        """
+
+        :param expElogbeta: (num_topics, num_terms) array
+        :param top_n: topics kept per term
+        :param dtype: dtype to store the weights in, expElogbeta's if None
+        :return: SparseTermWeights
+        """
+        num_topics = expElogbeta.shape[0]
+        term_major = np.ascontiguousarray(expElogbeta.T)
+        topic_ids = np.argpartition(-term_major, top_n - 1, axis=1)[:, :top_n]
+        weights = np.take_along_axis(term_major, topic_ids, axis=1)
+        id_dtype = np.int16 if num_topics <= np.iinfo(np.int16).max \
+            else np.int32
+        return cls(topic_ids.astype(id_dtype),
+                   weights.astype(dtype or expElogbeta.dtype), num_topics)
+
+    def __getitem__(self, key):
+        rows, term_ids = key
+        if rows != slice(None):
+            raise IndexError("only [:, term_ids] indexing is supported")
+        term_ids = np.asarray(term_ids)
+        columns = np.zeros((len(term_ids), self.num_topics), dtype=self.dtype)
+        np.put_along_axis(columns, self.topic_ids[term_ids].astype(np.intp),
+                          self.weights[term_ids], axis=1)
+        return columns.T
+
+
+def quantize_topic_words(expElogbeta, dtype=None, top_n=None):
+    """
+    Reduced precision copy of a topic-word matrix for a ModelBundle.
+
+    Inference only uses the ratios between the topics of a term (every
+    term's weights are normalized by phinorm), so the weights can be
+    rescaled per term. For float16 every term is divided by its largest
+    weight first, which keeps small weights out of float16's subnormal
+    range without changing any inference result.
+
+    :param expElogbeta: (num_topics, num_terms) array
+    :param dtype: float dtype to store in, expElogbeta's if None
+    :param top_n: only keep the top_n largest topics of every term, see
+        SparseTermWeights
+    :return: (weights, term_scaled) where weights is a term-major dense
+        array (C order of expElogbeta.T, shape (num_topics, num_terms)) or
+        SparseTermWeights, and term_scaled tells if terms were rescaled
+    """
+    dtype = np.dtype(dtype or expElogbeta.dtype)
+    term_scaled = dtype == np.float16
+    if term_scaled:
+        expElogbeta = expElogbeta / np.maximum(expElogbeta.max(axis=0),
+                                               np.finfo(np.float64).tiny)
+    if top_n:
+        return SparseTermWeights.from_dense(expElogbeta, top_n,
+                                            dtype), term_scaled
+    # term-major, so gathering a document's terms reads whole rows
+    return np.asfortranarray(expElogbeta, dtype=dtype), term_scaled
+
+
+class TopicInferencer:
+    """
+    Variational E-step of online LDA (the same updates as gensim's
+    LdaModel.inference), run on a whole chunk of documents at once: every
+    iteration is two batched matmuls over the chunk instead of a Python
+    loop over its documents.
+
+    Each document stops updating once its mean gamma change drops below
+    gamma_threshold, like in gensim. Only numpy is needed.
+    """
+
+    def __init__(self, expElogbeta, alpha, iterations=50,
+                 gamma_threshold=0.001, chunk_size=64, random_state=None):
+        """
+
+        :param expElogbeta: (num_topics, num_terms) topic-word weights, may
+            be memory mapped, or SparseTermWeights
+        :param alpha: (num_topics,) document-topic prior
+        :param iterations: maximum E-step iterations per document
+        :param gamma_threshold: mean gamma change at which a document counts
+            as converged
+        :param chunk_size: documents inferred together, bounds the
+            (chunk_size, longest document, num_topics) working array
+        :param random_state: numpy RandomState to draw the initial gamma
+            from, the way gensim does. If None every document starts from
+            the mean of that distribution (all ones), which makes results
+            deterministic and safe to compute from several threads.
+        """
+        self.expElogbeta = expElogbeta
+        # float16 storage is widened for the arithmetic
+        self.dtype = np.promote_types(expElogbeta.dtype, np.float32)
+        self.alpha = np.asarray(alpha, dtype=self.dtype)
+        self.num_topics = expElogbeta.shape[0]
+        self.iterations = iterations
+        self.gamma_threshold = gamma_threshold
+        self.chunk_size = chunk_size
+        self.random_state = random_state
+
+    @classmethod
+    def from_bundle(cls, bundle, **kwargs):
+        """
+
+        :param bundle: ModelBundle
+        :param kwargs: passed on to the constructor
+        :return: TopicInferencer
+        """
+        kwargs.setdefault('iterations', bundle.meta['iterations'])
+        kwargs.setdefault('gamma_threshold', bundle.meta['gamma_threshold'])
+        return cls(bundle.expElogbeta, bundle.alpha, **kwargs)
+
+    def inference(self, corpus, collect_sstats=False):
+        """
+        Same interface as gensim's LdaModel.inference, without sufficient
+        statistics.
+
+        :param corpus: list of bag of words documents
+        :param collect_sstats: must be False
+        :return: ((num_docs, num_topics) gamma array, None)
+        """
+        if collect_sstats:
+            raise ValueError("TopicInferencer can't collect sufficient "
+                             "statistics, it is for inference only")
+
+        num_docs = len(corpus)
+        if self.random_state is None:
+            gamma = np.ones((num_docs, self.num_topics), dtype=self.dtype)
+        else:
+            # one draw for the whole corpus, in corpus order, like gensim
+            gamma = self.random_state.gamma(
+                100., 1. / 100., (num_docs, self.num_topics)).astype(
+                    self.dtype, copy=False)
+
+        # chunks of similar length documents waste the least padding
+        order = np.argsort([len(doc) for doc in corpus], kind='stable')
+        for start in range(0, num_docs, self.chunk_size):
+            rows = order[start:start + self.chunk_size]
+            gamma[rows] = self._infer_chunk([corpus[i] for i in rows],
+                                            gamma[rows])
+        return gamma, None
+
+    def topic_matrix(self, corpus):
+        """
+
+        :param corpus: list of bag of words documents
+        :return: (num_docs, num_topics) normalized topic distributions
+        """
+        gamma, _ = self.inference(corpus)
+        return gamma / gamma.sum(axis=1)[:, np.newaxis]
+
+    def _infer_chunk(self, chunk, gamma):
+        num_docs = len(chunk)
+        max_length = max(len(doc) for doc in chunk)
+        if not max_length:
+            gamma[:] = self.alpha
+            return gamma
+
+        # documents padded to the same length, padding has a zero count
+        ids = np.zeros((num_docs, max_length), dtype=np.int64)
+        cts = np.zeros((num_docs, max_length), dtype=self.dtype)
+        for i, doc in enumerate(chunk):
+            if doc:
+                ids[i, :len(doc)], cts[i, :len(doc)] = zip(*doc)
+
+        # (num_docs, max_length, num_topics), each document's expElogbeta
+        # columns, so both products below are one batched matmul
+        expElogbetad = np.asarray(self.expElogbeta[:, ids.ravel()].T,
+                                  dtype=self.dtype).reshape(
+                                      num_docs, max_length, self.num_topics)
+        expElogbetad[cts == 0] = 0
+        epsilon = np.finfo(self.dtype).eps
+
+        active = np.arange(num_docs)
+        converged = np.zeros(num_docs, dtype=bool)
+        expElogtheta = np.exp(dirichlet_expectation(gamma))
+
+        for _ in range(self.iterations):
+            phinorm = np.matmul(expElogbetad,
+                                expElogtheta[:, :, np.newaxis])[:, :, 0] + epsilon
+            sstats = np.matmul((cts / phinorm)[:, np.newaxis, :],
+                               expElogbetad)[:, 0, :]
+
+            last_gamma = gamma[active]
+            new_gamma = self.alpha + expElogtheta * sstats
+            # converged documents keep their gamma, as in gensim
+            new_gamma[converged] = last_gamma[converged]
+            gamma[active] = new_gamma
+            expElogtheta = np.exp(dirichlet_expectation(new_gamma))
+
+            converged |= np.abs(new_gamma - last_gamma).mean(axis=1) < self.gamma_threshold
+            if converged.all():
+                break
+            # copying the working arrays only pays off once enough are done
+            if converged.sum() * 4 >= len(converged):
+                keep = ~converged
+                active = active[keep]
+                expElogbetad = expElogbetad[keep]
+                cts = cts[keep]
+                expElogtheta = expElogtheta[keep]
+                converged = converged[keep]
+
+        return gamma
+
+
+def random_corpus(num_terms, num_docs, doc_length=200, seed=0):
+    """
+    Random bag of words documents, for parity checks and benchmarks that
+    shouldn't depend on spacy.
+
+    :param num_terms: vocabulary size
+    :param num_docs: number of documents
+    :param doc_length: number of tokens per document
+    :param seed: random seed
+    :return: list of bag of words documents
+    """
+    rng = np.random.RandomState(seed)
+    corpus = []
+    for _ in range(num_docs):
+        ids, cts = np.unique(rng.randint(0, num_terms, doc_length),
+                             return_counts=True)
+        corpus.append(list(zip(ids.tolist(), cts.tolist())))
+    return corpus
+
+
+def parity_check(lda_model, classifier_model, bundle, corpus, seed=0):
+    """
+    Compare the numpy engine against gensim and sklearn on corpus, starting
+    both E-steps from the same random gamma.
+
+    :param lda_model: gensim LdaModel the bundle was exported from
+    :param classifier_model: sklearn classifier the bundle was exported from
+    :param bundle: ModelBundle
+    :param corpus: list of bag of words documents
+    :param seed: seed for the initial gamma
+    :return: dict of the largest differences found
+    """
+    lda_model.random_state = np.random.RandomState(seed)
+    gensim_gamma, _ = lda_model.inference(corpus)
+    gensim_topics = gensim_gamma / gensim_gamma.sum(axis=1)[:, np.newaxis]
+
+    inferencer = TopicInferencer.from_bundle(
+        bundle, chunk_size=len(corpus), random_state=np.random.RandomState(seed))
+    numpy_topics = inferencer.topic_matrix(corpus)
+
+    sklearn_proba = classifier_model.predict_proba(gensim_topics)
+    numpy_proba = bundle.classifier.predict_proba(gensim_topics)
+
+    # deterministic start, as used when serving
+    default_topics = TopicInferencer.from_bundle(bundle).topic_matrix(corpus)
+
+    return {'max_topic_diff': float(np.abs(numpy_topics - gensim_topics).max()),
+            'max_topic_diff_default_init':
+                float(np.abs(default_topics - gensim_topics).max()),
+            'max_proba_diff': float(np.abs(numpy_proba - sklearn_proba).max()),
+            'label_agreement': float(np.mean(
+                bundle.classifier.predict(numpy_topics)
+                == classifier_model.predict(gensim_topics)))}
+
+
+def benchmark(bundle, corpus, lda_model=None, chunk_size=64):
+    """
+    Per document latency of topic inference plus classification.
+
+    :param bundle: ModelBundle
+    :param corpus: list of bag of words documents
+    :param lda_model: also time gensim's get_document_topics one document at
+        a time, as get_json_prediction_output used to
+    :param chunk_size: documents per numpy chunk
+    :return: dict of milliseconds per document
+    """
+    inferencer = TopicInferencer.from_bundle(bundle, chunk_size=chunk_size)
+    results = {}
+
+    start = time.perf_counter()
+    topic_matrix = inferencer.topic_matrix(corpus)
+    bundle.classifier.predict(topic_matrix)
+    results['numpy_batch_ms_per_doc'] = \
+        (time.perf_counter() - start) * 1000.0 / len(corpus)
+
+    start = time.perf_counter()
+    for bow in corpus:
+        bundle.classifier.predict(inferencer.topic_matrix([bow]))
+    results['numpy_single_ms_per_doc'] = \
+        (time.perf_counter() - start) * 1000.0 / len(corpus)
+
+    if lda_model is not None:
+        start = time.perf_counter()
+        for bow in corpus:
+            lda_model.get_document_topics(bow, minimum_probability=0)
+        results['gensim_single_ms_per_doc'] = \
+            (time.perf_counter() - start) * 1000.0 / len(corpus)
+
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=("Check the numpy inference engine against gensim and "
+                     "sklearn, and measure its per document latency."))
+
+    parser.add_argument("bundle_dir",
+                        type=str,
+                        help=("The model bundle to load"))
+
+    parser.add_argument("--lda-model",
+                        type=str,
+                        default=None,
+                        help=("LDA model the bundle was exported from, "
+                              "enables the parity check and the gensim "
+                              "timing"))
+
+    parser.add_argument("--classifier-model",
+                        type=str,
+                        default=None,
+                        help=("Classifier the bundle was exported from"))
+
+    parser.add_argument("--docs",
+                        type=int,
+                        default=500,
+                        help=("Number of random documents to use"))
+
+    parser.add_argument("--doc-length",
+                        type=int,
+                        default=300,
+                        help=("Tokens per random document"))
+
+    inputs = parser.parse_args()
+
+    from ModelBundle import ModelBundle
+    bundle = ModelBundle(inputs.bundle_dir)
+    corpus = random_corpus(bundle.num_terms, inputs.docs, inputs.doc_length)
+
+    lda = None
+    if inputs.lda_model:
+        from gensim.models.ldamodel import LdaModel
+        import pickle
+
+        lda = LdaModel.load(inputs.lda_model)
+        if inputs.classifier_model:
+            with open(inputs.classifier_model, 'rb') as f:
+                classifier = pickle.load(f)
+            print("parity:", parity_check(lda, classifier, bundle, corpus))
+
+    print("latency:", benchmark(bundle, corpus, lda_model=lda))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import json
+
+# Joins the two tokens of a phrase, "white house" -> "white_house"
+PHRASE_DELIMITER = '_'
+
+
+class PhraseModel:
+    """
+    Bigram phrases learned from the training documents with gensim's
+    Phrases, kept as a plain {phrase: score} dict.
+
+    The same apply() runs when the corpus is built and when a text is
+    scored, so a phrase token the model was trained on is produced the
+    same way at inference time. Applying the phrases only needs this
+    module, not gensim.
+
+    The trained phrases are stored on the gensim Dictionary as its
+    'phrasegrams' attribute, so they are saved and loaded together with
+    the vocabulary they belong to.
+    """
+
+    def __init__(self, phrasegrams):
+        """
+
+        :param phrasegrams: {"first_second": score} of the phrases to join
+        """
+        self.phrasegrams = phrasegrams
+
+    def __len__(self):
+        return len(self.phrasegrams)
+
+    @classmethod
+    def train(cls, documents, min_count=5, threshold=10.0):
+        """
+        Learn phrases from a stream of token lists.
+
+        :param documents: iterable of token lists
+        :param min_count: ignore pairs seen fewer times than this
+        :param threshold: minimum phrase score, higher means fewer phrases
+        :return: PhraseModel
+        """
+        from gensim.models.phrases import Phrases
+
+        phrases = Phrases(min_count=min_count, threshold=threshold,
+                          delimiter=PHRASE_DELIMITER)
+        for document in documents:
+            phrases.add_vocab([document])
+        return cls({phrase: float(score)
+                    for phrase, score in phrases.export_phrases().items()})
+
+    @classmethod
+    def for_vocabulary(cls, id2word):
+        """
+
+        :param id2word: gensim Dictionary or bundle Vocabulary
+        :return: the PhraseModel stored on it, or None if it has none
+        """
+        phrasegrams = getattr(id2word, 'phrasegrams', None)
+        if not phrasegrams:
+            return None
+        return cls(phrasegrams)
+
+    def apply(self, tokens):
+        """
+        Join every known phrase in tokens, left to right, like gensim's
+        FrozenPhrases does for bigrams.
+
+        :param tokens: list of tokens
+        :return: new list of tokens
+        """
+        phrasegrams = self.phrasegrams
+        output = []
+        i = 0
+        while i < len(tokens):
+            if i + 1 < len(tokens):
+                phrase = tokens[i] + PHRASE_DELIMITER + tokens[i + 1]
+                if phrase in phrasegrams:
+                    output.append(phrase)
+                    i += 2
+                    continue
+            output.append(tokens[i])
+            i += 1
+        return output
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.phrasegrams, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
@@ -0,0 +1,226 @@
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import json
+import sqlite3
+import threading
+import unicodedata
+import numpy as np
+
+
+def json_default(obj):
+    """
+    Let json.dumps handle the numpy scalars/arrays found in prediction output.
+    """
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError("{} is not JSON serializable".format(type(obj)))
+
+
+def normalize_text(text):
+    """
+    Canonical form of an article for cache lookups. Syndicated copies often
+    only differ in line breaks and spacing, which don't change the tokens
+    spacy produces.
+
+    :param text: raw article text
+    :return: text in NFC form with every whitespace run turned into one space
+    """
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def text_key(text):
+    """
+
+    :param text: raw article text
+    :return: hex digest of normalize_text(text)
+    """
+    return hashlib.sha1(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+def model_version(*paths, settings=None):
+    """
+    Content hash of the files a model was loaded from, so that retraining
+    or swapping models never serves stale cached predictions.
+
+    A directory (model bundle) stands for every file in it. A file also
+    covers the sidecar files gensim saves next to it (<path>.*).
+
+    :param paths: model files or directories
+    :param settings: string hashed in as well, for what changes the
+        outputs besides the model files, e.g. Preprocessor.fingerprint()
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    if settings is not None:
+        digest.update(settings.encode('utf-8'))
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files = sorted(p for p in path.rglob('*') if p.is_file())
+        else:
+            files = [path] + sorted(path.parent.glob(path.name + '.*'))
+        for file_path in files:
+            digest.update(file_path.name.encode('utf-8'))
+            with file_path.open('rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    Cache of prediction outputs keyed by text_key and the model version.
+
+    Two tiers:
+
+        memory  - LRU of the most recent outputs, bounded by max_entries
+                  and by max_bytes of serialized output
+        sqlite  - optional database at db_path, unbounded, shared by every
+                  process pointed at it and kept across restarts
+
+    Memory misses fall through to sqlite, and sqlite hits are promoted into
+    memory. Outputs are stored as JSON, so cached results come back with
+    lists where the original had tuples and plain Python scalars where it
+    had numpy ones.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, model_version, max_entries=10000, max_bytes=64 << 20,
+                 db_path=None):
+        """
+
+        :param model_version: identifies the models the outputs came from,
+            see model_version()
+        :param max_entries: most outputs kept in memory, 0 disables the
+            memory tier
+        :param max_bytes: most bytes of serialized output kept in memory
+        :param db_path: sqlite database file for the on-disk tier, None to
+            only cache in memory
+        """
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS predictions ("
+                             "model_version TEXT NOT NULL, "
+                             "text_key TEXT NOT NULL, "
+                             "output TEXT NOT NULL, "
+                             "PRIMARY KEY (model_version, text_key))")
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Look up a cached output.
+
+        :param key: text_key of the input text
+        :return: output, or None on a miss
+        """
+        with self._lock:
+            serialized = self._entries.get(key)
+            if serialized is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(serialized)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT output FROM predictions "
+                    "WHERE model_version = ? AND text_key = ?",
+                    (self.model_version, key)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._remember(key, row[0])
+                    return json.loads(row[0])
+
+            self.misses += 1
+            return None
+
+    def put_many(self, items):
+        """
+        Store outputs, in one sqlite transaction.
+
+        :param items: iterable of (text_key, output)
+        :return: {text_key: serialized output}, the JSON get() will decode
+        """
+        rows = [(key, json.dumps(output, default=json_default))
+                for key, output in items]
+        with self._lock:
+            for key, serialized in rows:
+                self._remember(key, serialized)
+            if self._db is not None and rows:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO predictions "
+                        "(model_version, text_key, output) VALUES (?, ?, ?)",
+                        [(self.model_version, key, serialized)
+                         for key, serialized in rows])
+        return dict(rows)
+
+    def put(self, key, output):
+        """
+
+        :param key: text_key of the input text
+        :param output: prediction output, anything json serializable
+        :return:
+        """
+        self.put_many([(key, output)])
+
+    def _remember(self, key, serialized):
+        if not self.max_entries or len(serialized) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._num_bytes -= len(old)
+        self._entries[key] = serialized
+        self._num_bytes += len(serialized)
+        while len(self._entries) > self.max_entries \
+                or self._num_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._num_bytes -= len(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        """
+
+        :return: dict of hit/miss counters and memory tier size
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {'model_version': self.model_version,
+                    'memory_hits': self.memory_hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'hit_rate': (round((lookups - self.misses) / lookups, 4)
+                                 if lookups else None),
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self._num_bytes,
+                    'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes,
+                    'db_path': self.db_path}
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,365 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import argparse
+import json
+import threading
+import time
+import numpy as np
+from LoadModelAndPredict import load_models, load_bundle_models, \
+    get_json_prediction_output, get_json_prediction_output_batch, \
+    TopKExplanation
+from PredictionCache import PredictionCache, json_default, model_version
+from Preprocessing import BACKENDS
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the most recent requests and reports percentiles
+    over them.
+    """
+
+    PERCENTILES = (50, 90, 95, 99)
+
+    def __init__(self, window=1000):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_errors = 0
+
+    def record(self, seconds, error=False):
+        with self._lock:
+            self._latencies.append(seconds)
+            self.num_requests += 1
+            if error:
+                self.num_errors += 1
+
+    def summary(self):
+        """
+
+        :return: dict of request counts and latency percentiles in ms
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000.0
+            stats = {'requests': self.num_requests,
+                     'errors': self.num_errors,
+                     'window': len(latencies)}
+
+        if len(latencies):
+            for p, value in zip(self.PERCENTILES,
+                                np.percentile(latencies, self.PERCENTILES)):
+                stats['p{}_ms'.format(p)] = round(float(value), 3)
+            stats['max_ms'] = round(float(latencies.max()), 3)
+        return stats
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /predict  {"text": "..."}  -> get_json_prediction_output result
+    POST /predict  {"texts": [...]} -> list of results, scored as one batch
+    GET  /stats                     -> request count, latency percentiles
+                                       and prediction cache counters
+    GET  /health                    -> {"status": "ok"}
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # keep-alive connections hold on to a worker, drop them once idle
+    timeout = 10
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj, default=json_default).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin',
+                         self.server.allow_origin)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        # CORS preflight from the angular dev server
+        self.send_response(204)
+        self.send_header('Access-Control-Allow-Origin',
+                         self.server.allow_origin)
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, {'error': 'not found'})
+            return
+
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(request, dict):
+                request = {}
+            text = request.get('text')
+            texts = request.get('texts')
+            if not isinstance(text, str) and not (
+                    isinstance(texts, list)
+                    and all(isinstance(t, str) for t in texts)):
+                raise ValueError("expected a JSON object with a 'text' or "
+                                 "'texts' field")
+        except ValueError as e:
+            self.server.latency.record(time.perf_counter() - start,
+                                       error=True)
+            self._send_json(400, {'error': str(e)})
+            return
+
+        try:
+            if isinstance(text, str):
+                output = self.server.predict(text)
+            else:
+                output = self.server.predict_batch(texts)
+        except Exception as e:
+            self.server.latency.record(time.perf_counter() - start,
+                                       error=True)
+            self._send_json(500, {'error': str(e)})
+            raise
+
+        self.server.latency.record(time.perf_counter() - start)
+        self._send_json(200, output)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class PredictionServer(HTTPServer):
+    """
+    HTTP server that holds the loaded models and answers requests on a
+    fixed size pool of worker threads.
+
+    At most num_workers requests are handled at once and at most
+    max_pending more wait for a worker. Connections beyond that get a 503
+    straight away instead of piling up.
+    """
+
+    # listen backlog, the socketserver default of 5 resets bursts of clients
+    request_queue_size = 128
+
+    def __init__(self, server_address, nlp, lda_model, classifier_model,
+                 topic_index, num_workers=4, max_pending=64, allow_origin='*',
+                 verbose=False, cache=None, explanation=None):
+        super().__init__(server_address, PredictionRequestHandler)
+        self.nlp = nlp
+        self.lda_model = lda_model
+        self.classifier_model = classifier_model
+        self.topic_index = topic_index
+        self.allow_origin = allow_origin
+        self.verbose = verbose
+        self.cache = cache
+        self.explanation = explanation
+        self.latency = LatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers,
+                                            thread_name_prefix='predict')
+        self._slots = threading.BoundedSemaphore(num_workers + max_pending)
+
+    def predict(self, text):
+        return get_json_prediction_output(nlp=self.nlp,
+                                          lda_model=self.lda_model,
+                                          classifier_model=self.classifier_model,
+                                          input_raw_text=text,
+                                          topic_index=self.topic_index,
+                                          cache=self.cache,
+                                          explanation=self.explanation)
+
+    def predict_batch(self, texts):
+        return get_json_prediction_output_batch(
+            nlp=self.nlp,
+            lda_model=self.lda_model,
+            classifier_model=self.classifier_model,
+            input_raw_texts=texts,
+            topic_index=self.topic_index,
+            cache=self.cache,
+            explanation=self.explanation)
+
+    def stats(self):
+        stats = self.latency.summary()
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\n"
+                                b"Content-Length: 0\r\n"
+                                b"Connection: close\r\n\r\n")
+            finally:
+                self.shutdown_request(request)
+            return
+        self._executor.submit(self._process_request_worker, request,
+                              client_address)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
+        if self.cache is not None:
+            self.cache.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=("Serve bias predictions over HTTP, loading the models "
+                     "once at startup."))
+
+    parser.add_argument("lda_model",
+                        type=str,
+                        nargs='?',
+                        help=("The LDA model file to load"))
+
+    parser.add_argument("classifier_model",
+                        type=str,
+                        nargs='?',
+                        help=("The classifier model file to load"))
+
+    parser.add_argument("--bundle",
+                        type=str,
+                        default=None,
+                        help=("Serve from a model bundle directory instead "
+                              "of the two model files, using the numpy "
+                              "inference engine."))
+
+    parser.add_argument("--preprocessing",
+                        choices=BACKENDS,
+                        default='spacy',
+                        help=("Tokenizer backend, 'lookup' trades some "
+                              "accuracy for much higher throughput. See "
+                              "Preprocessing.py."))
+
+    parser.add_argument("--host",
+                        type=str,
+                        default='127.0.0.1',
+                        help=("Address to listen on, localhost by default."))
+
+    parser.add_argument("--port",
+                        type=int,
+                        default=8765,
+                        help=("Port to listen on."))
+
+    parser.add_argument("--workers",
+                        type=int,
+                        default=4,
+                        help=("Number of requests handled concurrently."))
+
+    parser.add_argument("--max-pending",
+                        type=int,
+                        default=64,
+                        help=("Number of requests allowed to wait for a "
+                              "worker before new ones are rejected."))
+
+    parser.add_argument("--top-topics",
+                        type=int,
+                        default=None,
+                        help=("Return bounded explanations: this many "
+                              "topics, --top-words words per topic and "
+                              "--max-words word contributions to the "
+                              "label. The full output otherwise."))
+
+    parser.add_argument("--top-words",
+                        type=int,
+                        default=5,
+                        help=("Terms and article words per topic with "
+                              "--top-topics."))
+
+    parser.add_argument("--max-words",
+                        type=int,
+                        default=25,
+                        help=("Word contributions with --top-topics."))
+
+    parser.add_argument("--cache-size",
+                        type=int,
+                        default=10000,
+                        help=("Number of predictions kept in the in-memory "
+                              "cache, 0 to disable it."))
+
+    parser.add_argument("--cache-mb",
+                        type=int,
+                        default=64,
+                        help=("Memory the in-memory cache may use, in MB."))
+
+    parser.add_argument("--cache-db",
+                        type=str,
+                        default=None,
+                        help=("Also cache predictions in this sqlite file, "
+                              "kept across restarts."))
+
+    parser.add_argument("-v",
+                        action='store_true',
+                        help=("Log every request."))
+
+    inputs = parser.parse_args()
+    if not inputs.bundle and not (inputs.lda_model and inputs.classifier_model):
+        parser.error("give either both model files or --bundle")
+
+    if inputs.bundle:
+        nlp, lda, classifier, topic_index = load_bundle_models(
+            inputs.bundle, preprocessing=inputs.preprocessing)
+    else:
+        nlp, lda, classifier, topic_index = load_models(
+            inputs.lda_model, inputs.classifier_model,
+            preprocessing=inputs.preprocessing)
+
+    explanation = None
+    settings = nlp.fingerprint()
+    if inputs.top_topics:
+        explanation = TopKExplanation(top_topics=inputs.top_topics,
+                                      top_words=inputs.top_words,
+                                      max_words=inputs.max_words)
+        settings += explanation.settings()
+
+    cache = None
+    if inputs.cache_size or inputs.cache_db:
+        if inputs.bundle:
+            version = model_version(inputs.bundle, settings=settings)
+        else:
+            version = model_version(inputs.lda_model, inputs.classifier_model,
+                                    settings=settings)
+        cache = PredictionCache(version,
+                                max_entries=inputs.cache_size,
+                                max_bytes=inputs.cache_mb << 20,
+                                db_path=inputs.cache_db)
+
+    server = PredictionServer((inputs.host, inputs.port), nlp, lda, classifier,
+                              topic_index,
+                              num_workers=inputs.workers,
+                              max_pending=inputs.max_pending,
+                              verbose=inputs.v,
+                              cache=cache,
+                              explanation=explanation)
+    print("serving predictions on http://{}:{}/predict".format(inputs.host,
+                                                                inputs.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats()))
+
+
+if __name__ == "__main__":
+    main()
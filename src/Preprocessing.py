@@ -0,0 +1,379 @@
+import argparse
+import hashlib
+import json
+import time
+import unicodedata
+import numpy as np
+import spacy
+
+try:
+    # lemma tables for the 'lookup' backend
+    import spacy_lookups_data
+except ImportError:
+    spacy_lookups_data = None
+
+# Constants
+SPACY_MODEL = 'en_core_web_md'
+STOPWORDS = {
+    'say', 'not', 'like', 'go', "be", "have", "s", #original
+    "and", "when", "where", "who", "let", "look", "time", "use", "him", "her",
+    "she", "he"
+}
+
+# The lemma/stopword/POS filter only reads lemma_ and pos_, so these are the
+# only pipes it needs. Everything else (parser, ner, ...) is switched off.
+LEMMA_POS_PIPES = ("tok2vec", "tagger", "attribute_ruler", "lemmatizer")
+
+# spacy:  the en_core_web_md tagger and rule lemmatizer, NUM and SYM tokens
+#         are dropped by their POS tag
+# lookup: tokenizer and lookup table lemmatizer only, no tagger or parser.
+#         Much faster, numbers and symbols are recognized from the token
+#         text instead of the tag
+BACKENDS = ('spacy', 'lookup')
+
+
+def filter_tokens(doc):
+    """
+    Apply the lemma/stopword/POS filter to a doc parsed by the spacy
+    backend.
+
+    :param doc: spacy Doc
+    :return: list of lower-cased lemmas
+    """
+    return [token.lemma_.lower() for token in doc
+            if not token.is_stop
+            and not token.is_punct
+            and not token.is_space
+            and not token.lemma_.lower() in STOPWORDS
+            and not token.pos_ == 'SYM'
+            and not token.pos_ == 'NUM']
+
+
+def is_symbol(text):
+    """
+
+    :param text: token text
+    :return: True if every character is a unicode symbol, e.g. $, % or +
+    """
+    return all(unicodedata.category(c).startswith('S') for c in text)
+
+
+def filter_lookup_tokens(doc):
+    """
+    The filter of filter_tokens for a doc parsed by the lookup backend,
+    which has no POS tags: numbers and symbols are told apart by their text.
+
+    :param doc: spacy Doc
+    :return: list of lower-cased lemmas
+    """
+    lemmas = []
+    for token in doc:
+        if token.is_stop or token.is_punct or token.is_space \
+                or token.like_num or is_symbol(token.text):
+            continue
+        # without lemma tables the lemma is left empty
+        lemma = (token.lemma_ or token.text).lower()
+        if lemma not in STOPWORDS:
+            lemmas.append(lemma)
+    return lemmas
+
+
+def load_pipeline(backend='spacy'):
+    """
+
+    :param backend: one of BACKENDS
+    :return: spacy pipeline with only the pipes the backend's filter needs
+    """
+    if backend == 'spacy':
+        nlp = spacy.load(SPACY_MODEL)
+        nlp.select_pipes(enable=[p for p in nlp.pipe_names
+                                 if p in LEMMA_POS_PIPES])
+        return nlp
+
+    nlp = spacy.blank('en')
+    if spacy_lookups_data is None:
+        print("WARNING: spacy-lookups-data is not installed, the lookup "
+              "backend falls back to lower-cased tokens as lemmas")
+        return nlp
+    nlp.add_pipe('lemmatizer', config={'mode': 'lookup'})
+    nlp.initialize()
+    return nlp
+
+
+class Preprocessor:
+    """
+    Turns raw article text into the token lists the LDA model is trained
+    on and scores. Training (BiasDetector) and inference
+    (LoadModelAndPredict) both go through this class, so a model is always
+    fed tokens produced by the same filter and stopwords.
+
+    The spacy pipeline is loaded on first use.
+    """
+
+    def __init__(self, backend='spacy', nlp=None):
+        """
+
+        :param backend: one of BACKENDS
+        :param nlp: already loaded pipeline to use instead of loading one
+        """
+        if backend not in BACKENDS:
+            raise ValueError("unknown preprocessing backend {!r}, expected "
+                             "one of {}".format(backend, BACKENDS))
+        self.backend = backend
+        self._nlp = nlp
+        self._filter = filter_tokens if backend == 'spacy' \
+            else filter_lookup_tokens
+
+    @property
+    def nlp(self):
+        return self.load()._nlp
+
+    def load(self):
+        """
+        Load the spacy pipeline now rather than on first use.
+
+        :return: self
+        """
+        if self._nlp is None:
+            self._nlp = load_pipeline(self.backend)
+        return self
+
+    def fingerprint(self):
+        """
+        Identify everything that changes the produced tokens, so that a
+        TokenCache built with another backend, other stopwords or another
+        spacy model is thrown away instead of reused.
+
+        :return: hex digest
+        """
+        settings = {'stopwords': sorted(STOPWORDS),
+                    'spacy': spacy.__version__}
+        if self.backend == 'spacy':
+            settings.update({'pipes': LEMMA_POS_PIPES,
+                             'model': SPACY_MODEL,
+                             'model_version':
+                                 spacy.util.get_package_version(SPACY_MODEL)})
+        else:
+            settings.update({'backend': self.backend,
+                             'lookups': getattr(spacy_lookups_data,
+                                                '__version__', None)})
+        return hashlib.sha1(
+            json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def __call__(self, text):
+        """
+
+        :param text: raw article text
+        :return: list of lemmas
+        """
+        return self._filter(self.nlp(text.replace("\n", " ")))
+
+    def pipe(self, texts, batch_size=64, n_process=1, as_tuples=False):
+        """
+        Stream texts through spacy in batches, yielding the lemmas of each
+        of them in input order.
+
+        :param texts: iterable of raw texts, or of (text, context) tuples
+            with as_tuples
+        :param batch_size: number of texts spacy buffers per batch
+        :param n_process: number of worker processes, -1 for all cores
+        :param as_tuples: pass a context along with every text
+        :return: generator of token lists, or of (lemmas, context) with
+            as_tuples
+        """
+        if as_tuples:
+            texts = ((text.replace("\n", " "), context)
+                     for text, context in texts)
+        else:
+            texts = (text.replace("\n", " ") for text in texts)
+
+        for item in self.nlp.pipe(texts, as_tuples=as_tuples,
+                                  batch_size=batch_size,
+                                  n_process=n_process):
+            if as_tuples:
+                doc, context = item
+                yield self._filter(doc), context
+            else:
+                yield self._filter(item)
+
+
+def hellinger(p, q):
+    """
+
+    :param p: (num_docs, num_topics) topic distributions
+    :param q: array of the same shape
+    :return: (num_docs,) Hellinger distance between matching rows
+    """
+    return np.sqrt(0.5 * ((np.sqrt(p) - np.sqrt(q)) ** 2).sum(axis=1))
+
+
+def compare_backends(lda_model, classifier_model, texts, labels,
+                     backends=BACKENDS, batch_size=64):
+    """
+    Score the same articles with every backend against one trained model
+    pair, to see what the faster backends cost in accuracy. The first
+    backend is the reference the others are compared with.
+
+    :param lda_model: LdaModel or ModelBundle
+    :param classifier_model: classifier trained on its topic vectors
+    :param texts: raw article texts
+    :param labels: their true labels
+    :param backends: backends to compare
+    :param batch_size: spacy batch size
+    :return: dict of results per backend
+    """
+    from LoadModelAndPredict import infer_topic_matrix
+    from Evaluation import classification_metrics
+    from PhraseModel import PhraseModel
+
+    phrases = PhraseModel.for_vocabulary(lda_model.id2word)
+    results = {}
+    reference = None
+    for backend in backends:
+        # loading the pipeline isn't part of the throughput
+        preprocessor = Preprocessor(backend).load()
+
+        start = time.perf_counter()
+        documents = list(preprocessor.pipe(texts, batch_size=batch_size))
+        elapsed = time.perf_counter() - start
+        if phrases is not None:
+            documents = [phrases.apply(tokens) for tokens in documents]
+
+        if hasattr(lda_model, 'random_state'):
+            # gensim starts inference from a random gamma, the same start
+            # for every backend keeps the differences down to the tokens
+            lda_model.random_state = np.random.RandomState(0)
+        topic_matrix = infer_topic_matrix(
+            lda_model, [lda_model.id2word.doc2bow(tokens)
+                        for tokens in documents])
+        metrics = classification_metrics(classifier_model, topic_matrix,
+                                         labels)
+        result = {'docs_per_sec': round(len(texts) / elapsed, 1),
+                  'tokens_per_doc': round(float(np.mean(
+                      [len(tokens) for tokens in documents])), 1),
+                  'accuracy': metrics['accuracy'],
+                  'f1_weighted': metrics['f1_weighted'],
+                  'f1_macro': metrics['f1_macro']}
+
+        if reference is None:
+            reference = (documents, topic_matrix,
+                         classifier_model.predict(topic_matrix))
+        else:
+            ref_documents, ref_topics, ref_labels = reference
+            result['token_jaccard'] = round(float(np.mean(
+                [len(set(a) & set(b)) / max(len(set(a) | set(b)), 1)
+                 for a, b in zip(documents, ref_documents)])), 4)
+            result['topic_hellinger'] = round(float(
+                hellinger(topic_matrix, ref_topics).mean()), 4)
+            result['label_agreement'] = round(float(np.mean(
+                classifier_model.predict(topic_matrix) == ref_labels)), 4)
+            result['speedup'] = round(result['docs_per_sec']
+                                      / results[backends[0]]['docs_per_sec'],
+                                      2)
+        results[backend] = result
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=("Compare the preprocessing backends on the same "
+                     "articles: throughput, and the topic vectors and F1 "
+                     "one trained model pair gets from each."))
+
+    parser.add_argument("data_dir",
+                        type=str,
+                        help=("Directory holding labels.csv."))
+
+    parser.add_argument("article_dir",
+                        type=str,
+                        help=("Directory the articles live in."))
+
+    parser.add_argument("lda_model",
+                        type=str,
+                        help=("LDA model to score with, or a model bundle "
+                              "directory"))
+
+    parser.add_argument("classifier_model",
+                        type=str,
+                        nargs='?',
+                        default=None,
+                        help=("Classifier to score with, not needed with a "
+                              "model bundle"))
+
+    parser.add_argument("--max-days",
+                        type=int,
+                        default=30,
+                        help=("Number of days of articles to load, 0 for "
+                              "all of them."))
+
+    parser.add_argument("--after-date",
+                        type=str,
+                        default=None,
+                        help=("Only load days after this one, e.g. the "
+                              "last training day, so the model is scored "
+                              "on articles it hasn't seen."))
+
+    parser.add_argument("--articles-per-publisher",
+                        type=int,
+                        default=1,
+                        help=("Number of articles to load per publisher "
+                              "and day, 0 for all of them."))
+
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=64,
+                        help=("Number of articles spacy parses per batch."))
+
+    parser.add_argument("--output",
+                        type=str,
+                        default=None,
+                        help=("Also write the comparison to this JSON "
+                              "file."))
+
+    inputs = parser.parse_args()
+
+    from pathlib import Path
+    import pickle
+    import BiasDetector
+
+    if Path(inputs.lda_model).is_dir():
+        from ModelBundle import ModelBundle
+        lda = ModelBundle(inputs.lda_model)
+        classifier = lda.classifier
+    else:
+        from gensim.models.ldamodel import LdaModel
+        lda = LdaModel.load(inputs.lda_model)
+        with open(inputs.classifier_model, 'rb') as f:
+            classifier = pickle.load(f)
+
+    mbfc_labels, _ = BiasDetector.load_labels(inputs.data_dir)
+    articles = list(BiasDetector.iter_articles(
+        BiasDetector.resolve_articles_dir(inputs.article_dir), mbfc_labels,
+        max_days=inputs.max_days or None,
+        after_date=inputs.after_date,
+        articles_per_publisher=inputs.articles_per_publisher or None))
+    texts = [text for _, text, _ in articles]
+    labels = [label for _, _, label in articles]
+
+    results = compare_backends(lda, classifier, texts, labels,
+                               batch_size=inputs.batch_size)
+    print("{:>8} {:>9} {:>8} {:>7} {:>8} {:>8} {:>9} {:>9}".format(
+        'backend', 'docs/sec', 'speedup', 'tokens', 'f1', 'jaccard',
+        'hellinger', 'agreement'))
+    for backend, result in results.items():
+        print("{:>8} {:>9} {:>8} {:>7} {:>8} {:>8} {:>9} {:>9}".format(
+            backend, result['docs_per_sec'], result.get('speedup', '-'),
+            result['tokens_per_doc'], result['f1_weighted'],
+            result.get('token_jaccard', '-'),
+            result.get('topic_hellinger', '-'),
+            result.get('label_agreement', '-')))
+
+    if inputs.output:
+        with open(inputs.output, 'w') as f:
+            json.dump({'documents': len(texts), 'backends': results}, f,
+                      indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import cProfile
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak RSS is reported as None there
+    resource = None
+
+
+def process_peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in MB. This is the high
+    water mark since the process started, it never goes down again, so it
+    can't tell which stage used the memory.
+
+    :return: float, or None where it can't be measured
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process right now, in MB, from
+    /proc/self/statm.
+
+    :return: float, or None where it can't be measured (not linux)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+
+
+class StageProfiler:
+    """
+    Records wall time, CPU time, memory and throughput for named pipeline
+    stages, and writes them out as a JSON report.
+
+    Memory is the resident set size when a stage starts and ends and the
+    change in between, plus the peak of the whole process so far. RSS is
+    shared by every thread, so the change of a stage also includes stages
+    running alongside it in other threads.
+
+    Stages nest, a stage opened inside another one is recorded as
+    "outer/inner":
+
+        profiler = StageProfiler()
+        with profiler.stage('train_model', items=len(corpus)):
+            with profiler.stage('lda'):
+                ...
+        profiler.write_report('profile.json')
+
+    If cprofile_dir is given every stage is also run under cProfile and its
+    stats are dumped to <cprofile_dir>/<stage>.prof, for snakeviz or pstats.
+    Only the outermost stage of each thread is profiled, cProfile can't be
+    nested.
+
+    A disabled profiler does nothing, so callers can always take one.
+    """
+
+    def __init__(self, enabled=True, cprofile_dir=None):
+        self.enabled = enabled
+        self.cprofile_dir = cprofile_dir
+        self.started = datetime.now(timezone.utc)
+        self.stages = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if cprofile_dir:
+            os.makedirs(cprofile_dir, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name, items=None):
+        """
+        Time the enclosed block as a stage.
+
+        :param name: stage name
+        :param items: number of items processed, can also be set later
+            through the yielded record's 'items' key
+        :return: context manager yielding the stage's record dict
+        """
+        record = {'name': name, 'items': items}
+        if not self.enabled:
+            yield record
+            return
+
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        record['name'] = '/'.join(stack + [name])
+        stack.append(name)
+
+        profile = None
+        if self.cprofile_dir and len(stack) == 1:
+            profile = cProfile.Profile()
+
+        rss_start = current_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            stack.pop()
+
+            record['wall_s'] = round(wall, 6)
+            record['cpu_s'] = round(cpu, 6)
+            rss_end = current_rss_mb()
+            if rss_start is not None:
+                record['rss_start_mb'] = round(rss_start, 3)
+                record['rss_end_mb'] = round(rss_end, 3)
+                record['rss_delta_mb'] = round(rss_end - rss_start, 3)
+            else:
+                record['rss_start_mb'] = record['rss_end_mb'] = None
+                record['rss_delta_mb'] = None
+            record['process_peak_rss_mb'] = process_peak_rss_mb()
+            items = record['items']
+            record['items_per_sec'] = (round(items / wall, 3)
+                                       if items and wall > 0 else None)
+            if profile is not None:
+                profile.dump_stats(os.path.join(
+                    self.cprofile_dir,
+                    record['name'].replace('/', '.') + '.prof'))
+            with self._lock:
+                self.stages.append(record)
+
+    def report(self):
+        """
+
+        :return: dict describing the run and every recorded stage, in the
+            order the stages finished
+        """
+        with self._lock:
+            stages = list(self.stages)
+        return {'run': {'started': self.started.isoformat(),
+                        'argv': sys.argv,
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+                'rss_mb': current_rss_mb(),
+                'process_peak_rss_mb': process_peak_rss_mb(),
+                'stages': stages}
+
+    def write_report(self, path):
+        """
+        Write report() to path as JSON.
+
+        :param path: output file
+        :return:
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        print("wrote profile report to", path)
+
+
+# shared do-nothing instance for callers that weren't given a profiler
+NO_PROFILER = StageProfiler(enabled=False)
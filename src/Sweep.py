@@ -0,0 +1,432 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import copy
+import csv
+import itertools
+import json
+import pickle
+import time
+import numpy as np
+from gensim.corpora import Dictionary, MmCorpus
+from gensim.models.ldamodel import LdaModel
+from sklearn.metrics import accuracy_score, f1_score
+import BiasDetector
+from BiasDetector import CLASSIFIERS, get_topic_vecs, train_classifier
+from Evaluation import split_by_date
+from Preprocessing import BACKENDS, Preprocessor
+from TokenCache import TokenCache
+
+LEADERBOARD_FIELDS = ['rank', 'num_topics', 'max_passes', 'classifier',
+                      'passes_run', 'best_pass', 'stopped_early',
+                      'selection_f1', 'holdout_f1', 'holdout_accuracy',
+                      'holdout_perplexity', 'train_s',
+                      'latency_ms_per_doc']
+
+
+def split_holdout(keys, holdout=0.2, seed=0):
+    """
+    Hold out the most recent days, see split_by_date. Falls back to a
+    random split of the documents when they all come from one day.
+
+    :param keys: article key of every corpus document
+    :param holdout: fraction of days (or documents) held out
+    :param seed: random seed of the fallback split
+    :return: (train positions, holdout positions), both sorted
+    """
+    try:
+        train_ids, holdout_ids, _ = split_by_date(keys, holdout)
+        return train_ids, holdout_ids
+    except ValueError as e:
+        print("WARNING: random holdout split,", e)
+
+    num_docs = len(keys)
+    order = np.random.RandomState(seed).permutation(num_docs)
+    num_holdout = max(1, int(round(num_docs * holdout)))
+    return np.sort(order[num_holdout:]), np.sort(order[:num_holdout])
+
+
+def evaluate(lda, classifier, corpus, labels):
+    """
+
+    :return: (weighted f1, accuracy) of classifier on corpus
+    """
+    pred_labels = classifier.predict(get_topic_vecs(lda, corpus))
+    return (f1_score(labels, pred_labels, average='weighted'),
+            accuracy_score(labels, pred_labels))
+
+
+def inference_latency(lda, classifier, corpus, num_docs=100):
+    """
+    Time scoring documents one at a time, the way a prediction request
+    does.
+
+    :return: milliseconds per document
+    """
+    sample = list(itertools.islice(corpus, num_docs))
+    start = time.perf_counter()
+    for bow in sample:
+        classifier.predict(get_topic_vecs(lda, [bow]))
+    return (time.perf_counter() - start) * 1000.0 / max(len(sample), 1)
+
+
+def run_trial(config, dictionary_path, corpus_path, labels, train_ids,
+              selection_ids, holdout_ids, patience=2, eval_every_passes=1,
+              seed=0):
+    """
+    Train and evaluate one LDA + classifier configuration. Runs in a sweep
+    worker process.
+
+    LDA is trained one pass at a time. Every eval_every_passes passes a
+    classifier is fitted on the training documents and scored on the
+    selection documents, and training stops once patience evaluations in a
+    row didn't beat the best weighted F1 so far. The best pass is then
+    scored once on the holdout documents, which played no part in picking
+    it.
+
+    :param config: dict with 'num_topics', 'max_passes' and 'classifier'
+    :param dictionary_path: saved gensim Dictionary
+    :param corpus_path: serialized MmCorpus
+    :param labels: label of every corpus document
+    :param train_ids: corpus positions to train on
+    :param selection_ids: corpus positions to stop early on
+    :param holdout_ids: corpus positions to evaluate on
+    :param patience: evaluations without improvement before stopping
+    :param eval_every_passes: passes between evaluations
+    :param seed: LDA random seed, the same for every trial
+    :return: (result dict for the leaderboard, best LdaModel, its
+        classifier)
+    """
+    id2word = Dictionary.load(dictionary_path)
+    corpus = MmCorpus(corpus_path)
+    # read from disk on every pass rather than held in memory
+    train_corpus = corpus[train_ids]
+    selection_corpus = corpus[selection_ids]
+    holdout_corpus = corpus[holdout_ids]
+    train_labels = [labels[i] for i in train_ids]
+    selection_labels = [labels[i] for i in selection_ids]
+    holdout_labels = [labels[i] for i in holdout_ids]
+
+    start = time.perf_counter()
+    lda = LdaModel(num_topics=config['num_topics'],
+                   id2word=id2word,
+                   passes=1,
+                   eval_every=None,
+                   random_state=seed)
+
+    best = None
+    evaluations_since_best = 0
+    passes_run = 0
+    while passes_run < config['max_passes']:
+        lda.update(train_corpus)
+        passes_run += 1
+        if passes_run % eval_every_passes and passes_run < config['max_passes']:
+            continue
+
+        classifier = train_classifier(get_topic_vecs(lda, train_corpus),
+                                      train_labels,
+                                      classifier=config['classifier'])
+        f1, _ = evaluate(lda, classifier, selection_corpus, selection_labels)
+        if best is None or f1 > best['selection_f1']:
+            # a copy, further passes keep training lda itself
+            best = {'selection_f1': f1,
+                    'best_pass': passes_run,
+                    'lda': copy.deepcopy(lda),
+                    'classifier': classifier}
+            evaluations_since_best = 0
+        else:
+            evaluations_since_best += 1
+            if evaluations_since_best >= patience:
+                break
+    train_s = time.perf_counter() - start
+    holdout_f1, holdout_accuracy = evaluate(best['lda'], best['classifier'],
+                                            holdout_corpus, holdout_labels)
+
+    result = dict(config)
+    result.update({'passes_run': passes_run,
+                   'best_pass': best['best_pass'],
+                   'stopped_early': passes_run < config['max_passes'],
+                   'selection_f1': round(best['selection_f1'], 4),
+                   'holdout_f1': round(holdout_f1, 4),
+                   'holdout_accuracy': round(holdout_accuracy, 4),
+                   'holdout_perplexity': round(float(np.exp2(
+                       -best['lda'].log_perplexity(holdout_corpus))), 2),
+                   'train_s': round(train_s, 2),
+                   'latency_ms_per_doc': round(inference_latency(
+                       best['lda'], best['classifier'], holdout_corpus), 3)})
+    return result, best['lda'], best['classifier']
+
+
+def sweep_configs(num_topics, passes, classifiers):
+    """
+
+    :return: list of config dicts, one per combination
+    """
+    return [{'num_topics': k, 'max_passes': p, 'classifier': c}
+            for k, p, c in itertools.product(num_topics, passes, classifiers)]
+
+
+def run_sweep(configs, dictionary_path, corpus_path, labels, keys, output_dir,
+              workers=None, holdout=0.2, patience=2, eval_every_passes=1,
+              seed=0, save_models=False):
+    """
+    Run every configuration against the same prebuilt dictionary and
+    corpus, in parallel worker processes.
+
+    :param configs: list of config dicts, see sweep_configs
+    :param dictionary_path: saved gensim Dictionary
+    :param corpus_path: serialized MmCorpus
+    :param labels: label of every corpus document
+    :param keys: article key of every corpus document
+    :param output_dir: directory for the leaderboard and saved models
+    :param workers: worker processes, None for one per core
+    :param holdout: fraction of days held out, the earlier half of them to
+        stop early and rank the configurations on, the later half to
+        evaluate on
+    :param patience: see run_trial
+    :param eval_every_passes: see run_trial
+    :param seed: seed of the holdout split and of LDA
+    :param save_models: save every trial's best model pair under
+        <output_dir>/trial_<n>
+    :return: leaderboard, list of result dicts sorted by selection F1
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    train_ids, held_out_ids = split_holdout(keys, holdout, seed)
+    selection_ids, holdout_ids = split_holdout(
+        [keys[i] for i in held_out_ids], 0.5, seed)
+    selection_ids = held_out_ids[selection_ids]
+    holdout_ids = held_out_ids[holdout_ids]
+    print("{} configurations, {} training, {} selection and {} holdout "
+          "documents".format(len(configs), len(train_ids), len(selection_ids),
+                             len(holdout_ids)))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_trial, config, dictionary_path,
+                                   corpus_path, labels, train_ids,
+                                   selection_ids, holdout_ids,
+                                   patience=patience,
+                                   eval_every_passes=eval_every_passes,
+                                   seed=seed): trial
+                   for trial, config in enumerate(configs)}
+        for future in as_completed(futures):
+            trial = futures[future]
+            try:
+                result, lda, classifier = future.result()
+            except Exception as e:
+                print("ERROR: trial", trial, configs[trial], e)
+                continue
+            result['trial'] = trial
+            if save_models:
+                trial_dir = output_dir / 'trial_{}'.format(trial)
+                trial_dir.mkdir(exist_ok=True)
+                lda.save(str(trial_dir / 'trained_ldamodel.model'))
+                with (trial_dir / 'trained_logreg_model.pkl').open('wb') as f:
+                    pickle.dump(classifier, f)
+            print("trial {}: {}".format(trial, json.dumps(result)))
+            results.append(result)
+
+    # ranked on the selection days, the holdout days only report
+    results.sort(key=lambda r: (-r['selection_f1'], r['train_s']))
+    for rank, result in enumerate(results, 1):
+        result['rank'] = rank
+    write_leaderboard(results, output_dir)
+    return results
+
+
+def write_leaderboard(results, output_dir):
+    """
+    Write the leaderboard as leaderboard.csv and leaderboard.json.
+
+    :param results: ranked result dicts
+    :param output_dir: directory to write to
+    :return:
+    """
+    output_dir = Path(output_dir)
+    with (output_dir / 'leaderboard.json').open('w') as f:
+        json.dump(results, f, indent=2)
+    with (output_dir / 'leaderboard.csv').open('w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['trial'] + LEADERBOARD_FIELDS)
+        writer.writeheader()
+        for result in results:
+            writer.writerow({field: result[field]
+                             for field in ['trial'] + LEADERBOARD_FIELDS})
+    print("wrote leaderboard to", output_dir / 'leaderboard.csv')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=("Train and compare many LDA/classifier configurations "
+                     "on one corpus. The articles are parsed and the corpus "
+                     "built once, then every configuration trains in a "
+                     "worker process and is scored on held out documents."))
+
+    parser.add_argument("data_dir",
+                        type=str,
+                        help=("Directory with labels.csv."))
+
+    parser.add_argument("article_dir",
+                        type=str,
+                        help=("Directory the articles live in."))
+
+    parser.add_argument("output_dir",
+                        type=str,
+                        help=("Directory for the corpus, the leaderboard and "
+                              "saved models."))
+
+    parser.add_argument("--num-topics",
+                        type=int,
+                        nargs='+',
+                        default=[20, 100, 400],
+                        help=("Numbers of topics to try."))
+
+    parser.add_argument("--passes",
+                        type=int,
+                        nargs='+',
+                        default=[50],
+                        help=("Maximum LDA passes to try."))
+
+    parser.add_argument("--classifiers",
+                        choices=CLASSIFIERS,
+                        nargs='+',
+                        default=['logreg'],
+                        help=("Classifiers to try."))
+
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help=("Trials run at once, defaults to one per "
+                              "core."))
+
+    parser.add_argument("--holdout",
+                        type=float,
+                        default=0.2,
+                        help=("Fraction of the days, the most recent ones, "
+                              "held out. The earlier half of them picks the "
+                              "best pass and ranks the configurations, the "
+                              "later half scores them."))
+
+    parser.add_argument("--patience",
+                        type=int,
+                        default=2,
+                        help=("Stop a trial after this many evaluations "
+                              "without a better selection F1."))
+
+    parser.add_argument("--eval-every-passes",
+                        type=int,
+                        default=5,
+                        help=("LDA passes between selection evaluations."))
+
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help=("Seed of the holdout split and of LDA."))
+
+    parser.add_argument("--save-models",
+                        action='store_true',
+                        help=("Save the best model pair of every trial."))
+
+    parser.add_argument("--max-days",
+                        type=int,
+                        default=30,
+                        help=("Number of days of articles to use, 0 for "
+                              "the full corpus."))
+
+    parser.add_argument("--articles-per-publisher",
+                        type=int,
+                        default=1,
+                        help=("Number of articles to use per publisher and "
+                              "day, 0 for all of them."))
+
+    parser.add_argument("--read-workers",
+                        type=int,
+                        default=4,
+                        help=("Threads reading articles from disk while "
+                              "spacy parses."))
+
+    parser.add_argument("--preprocessing",
+                        choices=BACKENDS,
+                        default='spacy',
+                        help=("Tokenizer backend, see BiasDetector."))
+
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=64,
+                        help=("Number of articles spacy parses per batch."))
+
+    parser.add_argument("--n-process",
+                        type=int,
+                        default=1,
+                        help=("Number of spacy worker processes."))
+
+    parser.add_argument("--token-cache",
+                        type=str,
+                        default=None,
+                        help=("Directory to cache lemmatized articles in, "
+                              "see BiasDetector."))
+
+    parser.add_argument("--reuse-corpus",
+                        action='store_true',
+                        help=("Use the corpus and dictionary already in "
+                              "output_dir instead of loading the articles."))
+
+    inputs = parser.parse_args()
+
+    output_dir = Path(inputs.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    corpus_path = str(output_dir / 'sweep_corpus.mm')
+    dictionary_path = str(output_dir / 'sweep_dictionary.dict')
+    labels_path = output_dir / 'sweep_labels.json'
+
+    if inputs.reuse_corpus:
+        with labels_path.open() as f:
+            saved = json.load(f)
+        labels, keys = saved['labels'], saved['keys']
+    else:
+        preprocessor = Preprocessor(inputs.preprocessing)
+        token_cache = None
+        if inputs.token_cache:
+            token_cache = TokenCache(inputs.token_cache,
+                                     preprocessor.fingerprint())
+        id2word, corpus, labels, _, keys = BiasDetector.load_data(
+            inputs.data_dir,
+            inputs.article_dir,
+            corpus_path,
+            max_days=inputs.max_days or None,
+            batch_size=inputs.batch_size,
+            n_process=inputs.n_process,
+            token_cache=token_cache,
+            articles_per_publisher=inputs.articles_per_publisher or None,
+            read_workers=inputs.read_workers,
+            preprocessor=preprocessor,
+            validation_fraction=inputs.holdout)
+        id2word.save(dictionary_path)
+        with labels_path.open('w') as f:
+            json.dump({'labels': labels, 'keys': keys}, f)
+
+    configs = sweep_configs(inputs.num_topics, inputs.passes,
+                            inputs.classifiers)
+    results = run_sweep(configs, dictionary_path, corpus_path, labels, keys,
+                        output_dir,
+                        workers=inputs.workers,
+                        holdout=inputs.holdout,
+                        patience=inputs.patience,
+                        eval_every_passes=inputs.eval_every_passes,
+                        seed=inputs.seed,
+                        save_models=inputs.save_models)
+
+    print("{:>4} {:>7} {:>7} {:>8} {:>7} {:>7} {:>8} {:>9} {:>11}".format(
+        'rank', 'topics', 'passes', 'clf', 'sel_f1', 'f1', 'acc', 'train_s',
+        'latency_ms'))
+    for r in results:
+        print("{:>4} {:>7} {:>7} {:>8} {:>7.4f} {:>7.4f} {:>8.4f} {:>9.2f} "
+              "{:>11.3f}".format(r['rank'], r['num_topics'], r['passes_run'],
+                                 r['classifier'], r['selection_f1'],
+                                 r['holdout_f1'], r['holdout_accuracy'],
+                                 r['train_s'], r['latency_ms_per_doc']))
+
+
+if __name__ == "__main__":
+    main()
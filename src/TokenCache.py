@@ -0,0 +1,191 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import numpy as np
+
+# Bump this whenever the layout of the files below changes.
+CACHE_FORMAT_VERSION = 1
+
+
+class TokenCache:
+    """
+    Persistent cache of lemmatized articles, so that repeat training runs
+    only send new or modified articles through spacy.
+
+    The cache is a directory with three files:
+
+        index.json  - fingerprint plus {article key: [content digest,
+                      offset, length]}
+        vocab.json  - list of token strings, the position is the token id
+        tokens.bin  - every cached document's token ids back to back as
+                      raw int32, read through a numpy memmap
+
+    New documents are appended to tokens.bin. Entries for modified articles
+    leave their old span behind until the file is compacted on save.
+
+    The fingerprint describes everything that affects the token lists
+    (stopwords, spacy and model version, ...). Opening the cache with a
+    different fingerprint throws away everything in it.
+    """
+
+    TOKEN_DTYPE = np.int32
+
+    def __init__(self, cache_dir, fingerprint):
+        """
+
+        :param cache_dir: directory to keep the cache in, created if missing
+        :param fingerprint: string identifying the preprocessing settings
+        """
+        self.cache_dir = Path(cache_dir)
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._index_path = self.cache_dir / 'index.json'
+        self._vocab_path = self.cache_dir / 'vocab.json'
+        self._tokens_path = self.cache_dir / 'tokens.bin'
+
+        self._entries = {}
+        self._vocab = []
+        if self._index_path.is_file() and self._vocab_path.is_file():
+            with self._index_path.open() as f:
+                index = json.load(f)
+            if index.get('fingerprint') == fingerprint:
+                self._entries = index['entries']
+                with self._vocab_path.open() as f:
+                    self._vocab = json.load(f)
+            else:
+                print("token cache fingerprint changed, invalidating",
+                      self.cache_dir)
+
+        if not self._entries:
+            self.clear()
+
+        self._token_ids = {token: i for i, token in enumerate(self._vocab)}
+        self._open_tokens()
+
+    @staticmethod
+    def content_digest(text):
+        """
+        Hash of an article's text, used to notice modified articles.
+
+        :param text: article text
+        :return: hex digest
+        """
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _open_tokens(self):
+        self._num_tokens = (os.path.getsize(self._tokens_path)
+                            // np.dtype(self.TOKEN_DTYPE).itemsize)
+        if self._num_tokens:
+            self._tokens = np.memmap(self._tokens_path,
+                                     dtype=self.TOKEN_DTYPE,
+                                     mode='r',
+                                     shape=(self._num_tokens,))
+        else:
+            self._tokens = np.zeros(0, dtype=self.TOKEN_DTYPE)
+        self._appended = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, digest):
+        """
+        Look up the cached tokens for an article.
+
+        :param key: article path relative to the articles root
+        :param digest: content_digest of the article text
+        :return: list of tokens, or None if missing or stale
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != digest \
+                or entry[1] + entry[2] > len(self._tokens):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        _, offset, length = entry
+        vocab = self._vocab
+        return [vocab[i] for i in self._tokens[offset:offset + length]]
+
+    def put(self, key, digest, tokens):
+        """
+        Store the tokens for an article, replacing any older entry.
+
+        :param key: article path relative to the articles root
+        :param digest: content_digest of the article text
+        :param tokens: list of token strings
+        :return:
+        """
+        token_ids = self._token_ids
+        ids = []
+        for token in tokens:
+            token_id = token_ids.get(token)
+            if token_id is None:
+                token_id = token_ids[token] = len(self._vocab)
+                self._vocab.append(token)
+            ids.append(token_id)
+
+        self._entries[key] = [digest, self._num_tokens, len(ids)]
+        self._num_tokens += len(ids)
+        self._appended.append(np.asarray(ids, dtype=self.TOKEN_DTYPE))
+
+    def save(self):
+        """
+        Flush newly added documents and the index to disk.
+
+        :return:
+        """
+        if self._appended:
+            with self._tokens_path.open('ab') as f:
+                for ids in self._appended:
+                    ids.tofile(f)
+
+        live_tokens = sum(entry[2] for entry in self._entries.values())
+        if live_tokens * 2 < self._num_tokens:
+            self._compact()
+
+        self._write_json(self._vocab_path, self._vocab)
+        self._write_json(self._index_path, {'format': CACHE_FORMAT_VERSION,
+                                            'fingerprint': self.fingerprint,
+                                            'entries': self._entries})
+        self._open_tokens()
+
+    def clear(self):
+        """
+        Drop every cached document.
+
+        :return:
+        """
+        self._entries = {}
+        self._vocab = []
+        self._token_ids = {}
+        self._tokens_path.write_bytes(b'')
+        for path in (self._index_path, self._vocab_path):
+            if path.exists():
+                path.unlink()
+        self._open_tokens()
+
+    def _compact(self):
+        """
+        Rewrite tokens.bin without the spans of replaced entries.
+        """
+        tokens = np.fromfile(self._tokens_path, dtype=self.TOKEN_DTYPE)
+        tmp_path = self._tokens_path.with_suffix('.tmp')
+        offset = 0
+        with tmp_path.open('wb') as f:
+            for entry in self._entries.values():
+                tokens[entry[1]:entry[1] + entry[2]].tofile(f)
+                entry[1] = offset
+                offset += entry[2]
+        os.replace(tmp_path, self._tokens_path)
+        self._num_tokens = offset
+
+    @staticmethod
+    def _write_json(path, obj):
+        tmp_path = path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
@@ -1,6 +1,7 @@
 import { Injectable } from '@angular/core';
 import { HttpClient, HttpHeaders } from '@angular/common/http';
 import { Observable, Subject } from 'rxjs';
+import { environment } from '../environments/environment';
 @Injectable({
   providedIn: 'root'
 })
@@ -18,6 +19,12 @@ getNewsInformation(){
 
 }
 
+predictBias(text: string){
+
+    return this.http.post<any>(environment.predictionApiUrl + '/predict', { text: text });
+
+}
+
 
 
 
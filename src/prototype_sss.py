@@ -6,21 +6,16 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.preprocessing import LabelBinarizer
 import csv
 import numpy as np
-import spacy
-import en_core_web_md
+from Preprocessing import Preprocessor
 
 # expecting labels.csv in the ../data folder, and articles to be in ../data/articles/articles/ etc.
 PROJ_ROOT = Path(__file__).parent.parent
 DATA_DIR = (PROJ_ROOT / 'data').resolve()
 ARTICLES_DIR = (DATA_DIR / 'articles' / 'articles').resolve()
 
-# loading the spacy model is alternatively done by importing spacy then calling spacy.load('en
-# change to en_core_web_lg or en_core_web_sm depending on what model you have downloaded
-nlp = en_core_web_md.load()
-# adding a few more stopwords / words we aren't interested in given the kinds of things that often show up in news articles
-my_stopwords = {
-    'say', 'not', 'like', 'go', "be", "have", "s"
-}
+# the same spacy model, stopwords and token filter BiasDetector trains with,
+# see Preprocessing.py
+preprocessor = Preprocessor()
 
 # get data from labels csv into a couple dictionaries
 labels = dict()
@@ -62,40 +57,31 @@ dates = [f for f in ARTICLES_DIR.iterdir() if f.is_dir()]
 # store raw text / processed text to use later to look at result example
 testing_text_raw = []
 
-with nlp.disable_pipes("ner"):
-    for date in dates[:2]: # parsing documents can take a while.
-        smalltest_dir = (ARTICLES_DIR / date).resolve()
-
-        publishers = [f for f in smalltest_dir.iterdir() if f.is_dir()]
-
-        for pub_articles in publishers:
-            articles = [f for f in pub_articles.iterdir() if f.is_file()]
-            if articles:
-                this_publisher = str(articles[0].parent.relative_to(smalltest_dir))
-                # print(this_publisher)
-                # skip if no label for publisher
-                if str(this_publisher) not in mbfc_labels.keys():
-                    continue
-                else:
-                    text = articles[0].read_text()
-
-                    # save raw text of first document, just for looking at results later
-                    if not testing_text_raw:
-                        testing_text_raw = text
-
-                    text = text.replace("\n", " ")
-
-                    # preprocessing text
-                    lem_text = [token.lemma_.lower() for token in nlp(text)
-                                if not token.is_stop
-                                and not token.is_punct
-                                and not token.is_space
-                                and not token.lemma_.lower() in my_stopwords
-                                and not token.pos_ == 'SYM'
-                                and not token.pos_ == 'NUM']
-                    # print(lem_text)
-                    documents.append(lem_text)
-                    labels.append(mbfc_labels[this_publisher])
+for date in dates[:2]: # parsing documents can take a while.
+    smalltest_dir = (ARTICLES_DIR / date).resolve()
+
+    publishers = [f for f in smalltest_dir.iterdir() if f.is_dir()]
+
+    for pub_articles in publishers:
+        articles = [f for f in pub_articles.iterdir() if f.is_file()]
+        if articles:
+            this_publisher = str(articles[0].parent.relative_to(smalltest_dir))
+            # print(this_publisher)
+            # skip if no label for publisher
+            if str(this_publisher) not in mbfc_labels.keys():
+                continue
+            else:
+                text = articles[0].read_text()
+
+                # save raw text of first document, just for looking at results later
+                if not testing_text_raw:
+                    testing_text_raw = text
+
+                # preprocessing text
+                lem_text = preprocessor(text)
+                # print(lem_text)
+                documents.append(lem_text)
+                labels.append(mbfc_labels[this_publisher])
 
 print('number of documents: ', len(documents))
 
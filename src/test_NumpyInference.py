@@ -0,0 +1,36 @@
+from gensim.corpora import Dictionary
+from gensim.models.ldamodel import LdaModel
+from sklearn.linear_model import LogisticRegression
+from BiasDetector import get_topic_vecs
+from ModelBundle import ModelBundle, export_bundle
+from NumpyInference import parity_check, random_corpus
+
+NUM_TERMS = 300
+
+
+def train_models():
+    """
+    Tiny seeded LDA model and a classifier fitted on its topic vectors.
+
+    :return: (LdaModel, LogisticRegression)
+    """
+    corpus = random_corpus(NUM_TERMS, 60, doc_length=50, seed=0)
+    lda = LdaModel(corpus, id2word=Dictionary.from_corpus(corpus),
+                   num_topics=5, passes=5, random_state=0)
+    topic_vecs = get_topic_vecs(lda, corpus)
+    labels = ['label_{}'.format(topic % 3)
+              for topic in topic_vecs.argmax(axis=1)]
+    classifier = LogisticRegression(max_iter=1000).fit(topic_vecs, labels)
+    return lda, classifier
+
+
+def test_parity_check(tmp_path):
+    lda, classifier = train_models()
+    bundle = ModelBundle(export_bundle(lda, classifier, tmp_path / 'bundle'))
+
+    parity = parity_check(lda, classifier, bundle,
+                          random_corpus(NUM_TERMS, 40, doc_length=50, seed=1))
+
+    assert parity['max_topic_diff'] < 1e-5
+    assert parity['max_proba_diff'] < 1e-5
+    assert parity['label_agreement'] == 1.0